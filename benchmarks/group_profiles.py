@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Times get_groups.py turning a synthetic group_profiles XML document into its groups and participants CSVs. By
+# default the document has 5,000 groups of 100 participants, plus a director, coach and main leader each (520,000
+# records). collect_groups() takes the same arguments before and after the XML record extraction moved to
+# util.iter_xml_records(), so running this at a commit before that change gives the 'before' numbers
+
+import sys
+import os
+import argparse
+import tempfile
+import time
+import statistics
+import xml.sax.saxutils
+try:
+    import resource
+except ImportError: # Not available on Windows, where peak memory is then not reported
+    resource = None
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import get_groups
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--groups', type=int, default=5000, help='Number of groups. Defaults to 5000')
+    parser.add_argument('--participants-per-group', type=int, default=100, help='Number of participants in each ' +
+        'group. Defaults to 100')
+    parser.add_argument('--runs', type=int, default=3, help='Number of timed runs, of which the median CPU time is ' +
+        'reported. Defaults to 3')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        input_filename = temp_directory + '/group_profiles.xml'
+        write_group_profiles_xml(input_filename, args.groups, args.participants_per_group)
+        print('group_profiles XML: {:.0f} MB, {} groups, {} participants'.format(
+            os.path.getsize(input_filename) / 1e6, args.groups, args.groups * args.participants_per_group))
+        cpu_seconds = []
+        for run_num in range(args.runs):
+            start_cpu_time = time.process_time()
+            get_groups.collect_groups(None, None, None, temp_directory + '/groups.csv',
+                temp_directory + '/group_participants.csv', input_filename)
+            cpu_seconds.append(time.process_time() - start_cpu_time)
+            print('Run {}: {:.2f} CPU seconds'.format(run_num + 1, cpu_seconds[-1]))
+    print('Median: {:.2f} CPU seconds'.format(statistics.median(cpu_seconds)))
+    if resource is not None:
+        # ru_maxrss is in KB on Linux, bytes on MacOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('Peak RSS: {:.0f} MB'.format(max_rss / (1e6 if sys.platform == 'darwin' else 1e3)))
+
+
+def write_group_profiles_xml(filename, num_groups, participants_per_group):
+    group_props = ['description', 'campus', 'group_type', 'department', 'area', 'group_capacity', 'meeting_day',
+        'meeting_time', 'childcare_provided', 'interaction_type', 'membership_type', 'notification', 'listed',
+        'public_search_listed', 'inactive']
+    with open(filename, 'w', encoding='utf-8') as output_file:
+        output_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<ccb_api>\n<response>\n<groups count="' +
+            str(num_groups) + '">\n')
+        individual_id = 0
+        for group_id in range(1, num_groups + 1):
+            output_file.write('<group id="' + str(group_id) + '">\n<name>' +
+                xml.sax.saxutils.escape('Group & Class ' + str(group_id)) + '</name>\n')
+            for prop in group_props:
+                output_file.write('<' + prop + '>' + prop + ' ' + str(group_id % 7) + '</' + prop + '>\n')
+            for leader_tag in ['director', 'coach', 'main_leader']:
+                individual_id += 1
+                output_file.write('<' + leader_tag + ' id="' + str(individual_id) + '">\n<first_name>First' +
+                    '</first_name>\n<last_name>Last</last_name>\n<full_name>First Last</full_name>\n' +
+                    '<email>first.last@example.com</email>\n</' + leader_tag + '>\n')
+            output_file.write('<participants>\n')
+            for _ in range(participants_per_group):
+                individual_id += 1
+                output_file.write('<participant id="' + str(individual_id) + '">\n<name>Participant ' +
+                    str(individual_id) + '</name>\n</participant>\n')
+            output_file.write('</participants>\n</group>\n')
+        output_file.write('</groups>\n</response>\n</ccb_api>\n')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,12 +8,25 @@ import os
 import shutil
 import tempfile
 import subprocess
-import configparser
 import re
 import calendar
-import boto3
+import time
+import threading
+import concurrent.futures
+import importlib
+import struct
+import base64
+import hashlib
+import json
+import sqlite3
+from collections import namedtuple
 from util import util
+import ccb_backup_delta
 import pytz
+try:
+    import resource
+except ImportError: # Not available on Windows, where CPU time of the zip utility is then not reported
+    resource = None
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
@@ -28,6 +41,24 @@ class g:
     reuse_output_filename = None
     backup_data_sets_dict = None
     run_util_errors = None
+    run_util_errors_lock = threading.Lock()
+    util_modules = None
+    http_session = None
+    ccb_subdomain = None
+    ccb_api_username = None
+    ccb_api_password = None
+    in_process_util = threading.local()
+    archive_stats = None
+    compression_executor = None
+    compression_parts_directory = None
+    file_checksums = {}
+    s3_catalog = None
+    s3_client = None
+    incremental_manifest = None
+    incremental_state = None
+    incremental_state_directory = None
+    incremental_baseline_reason = None
+    checkpoint_journal = None
 
 
 def main(argv):
@@ -56,10 +87,20 @@ def main(argv):
     parser.add_argument('--source-directory', required=False, help='If provided, then get_*.py utilities are not ' +
         'executed to create new output data, but instead files in this specified directory are used ' +
         'to zip and optionally post to AWS S3')
+    parser.add_argument('--output-directory', required=False, help='If provided, get_*.py utilities output and ' \
+        'messages log are written into this new or empty directory and kept there, and no zip file is created')
+    parser.add_argument('--incremental', action='store_true', help='If specified, each CSV is stored as a delta ' \
+        '(rows inserted, updated, or deleted since the previous --incremental backup) with a periodic full ' \
+        'baseline. See ccb_backup_delta.py to reconstruct full CSVs')
+    parser.add_argument('--resume', action='store_true', help='If specified, get_*.py utilities output (and units ' \
+        'of work within get_attendance.py, get_transactions.py, and get_pledges.py) completed by an interrupted ' \
+        'earlier run is reused rather than collected again. Requires [checkpoints] in ccb_backup.ini')
     parser.add_argument('--retain-temp-directory', action='store_true', help='If specified, the temp directory ' +
         'without output from get_*.py utilities is not deleted')
     parser.add_argument('--show-backups-to-do', action='store_true', help='If specified, the ONLY thing that is ' +
         'done is backup posts and deletions to S3 are calculated and displayed')
+    parser.add_argument('--dry-run-deletes', action='store_true', help='If specified, expired backups that would ' \
+        'be deleted from S3 are only listed, not deleted')
     parser.add_argument('--all-time', action='store_true', help='Normally, attendance data is only archived for ' + \
         'current year (figuring earlier backups covered earlier years). But specifying this flag, collects ' \
         'attendance data not just for this year but across all years')
@@ -70,6 +111,21 @@ def main(argv):
         'zip file that is created that was specified in ccb_backup.ini')
     parser.add_argument('--aws-s3-bucket-name', required=False, help='If provided, overrides AWS S3 bucket where ' \
         'output backup zip files are stored')
+    parser.add_argument('--parallel-workers', required=False, type=int, default=1, help='Number of get_*.py ' \
+        'utilities to run concurrently. Defaults to 1 (run utilities one after another)')
+    parser.add_argument('--in-process', action='store_true', help='If specified, get_*.py utilities are run ' \
+        'inside this process sharing one CCB login and one parsed ccb_backup.ini, rather than each being started ' \
+        'as its own Python process')
+    parser.add_argument('--archive-writer', required=False, choices=['aes', 'zip'], default='aes',
+        help='How the backup zip file is written. \'aes\' (default) writes it inside this process with AES-256 ' \
+        'encryption, adding each get_*.py utility\'s output as soon as that utility finishes (requires the ' \
+        'pyzipper package). \'zip\' runs /usr/bin/zip with legacy ZipCrypto encryption after all utilities finish')
+    parser.add_argument('--compression-level', required=False, type=int, default=6, choices=range(0, 10),
+        metavar='{0-9}', help='Deflate compression level for the backup zip file, from 0 (store only) to 9 ' \
+        '(smallest). Defaults to 6')
+    parser.add_argument('--compression-workers', required=False, type=int, default=1, help='Number of CPU ' \
+        'cores used to compress members of the backup zip file in parallel with --archive-writer aes. Defaults ' \
+        'to 1')
     parser.add_argument('--notification-emails', required=False, nargs='*', default=argparse.SUPPRESS,
         help='If specified, list of email addresses that are emailed upon successful upload to AWS S3, along with ' \
         'accessor link to get at the backup zip file (which is encrypted)')
@@ -82,7 +138,15 @@ def main(argv):
 
     message_level = util.get_ini_setting('logging', 'level')
 
-    g.temp_directory = tempfile.mkdtemp(prefix='ccb_backup_')
+    if g.args.output_directory is not None:
+        g.temp_directory = os.path.abspath(g.args.output_directory)
+        if not os.path.isdir(g.temp_directory):
+            os.makedirs(g.temp_directory)
+        elif len(os.listdir(g.temp_directory)) > 0:
+            print('Specified --output-directory ' + g.temp_directory + ' is not empty. Aborting!', file=sys.stderr)
+            util.sys_exit(1)
+    else:
+        g.temp_directory = tempfile.mkdtemp(prefix='ccb_backup_')
 
     if g.args.message_output_filename is None:
         g.message_output_filename = g.temp_directory + '/messages_' + \
@@ -106,6 +170,32 @@ def main(argv):
             else:
                 g.backup_data_sets_dict[backup_data_set_str][0] = True
 
+    if g.args.parallel_workers < 1:
+        message_error('Specified --parallel-workers value must be a positive integer. Aborting!')
+        util.sys_exit(1)
+    if g.args.compression_workers < 1:
+        message_error('Specified --compression-workers value must be a positive integer. Aborting!')
+        util.sys_exit(1)
+
+    if g.args.output_directory is not None and (g.args.output_filename is not None or g.args.post_to_s3 or \
+       g.args.source_directory is not None):
+        message_error('--output-directory cannot be combined with --output-filename, --post-to-s3, or ' \
+            '--source-directory. Aborting!')
+        util.sys_exit(1)
+
+    if g.args.incremental and g.args.source_directory is not None:
+        message_error('--incremental cannot be combined with --source-directory. Aborting!')
+        util.sys_exit(1)
+    if g.args.incremental:
+        start_incremental()
+
+    if g.args.resume and g.args.source_directory is not None:
+        message_error('--resume cannot be combined with --source-directory. Aborting!')
+        util.sys_exit(1)
+    if g.args.resume and util.get_ini_setting('checkpoints', 'directory') is None:
+        message_error("--resume requires setting '[checkpoints]directory' in ccb_backup.ini. Aborting!")
+        util.sys_exit(1)
+
     # Don't do work that'd just get deleted
     if not g.args.post_to_s3 and g.args.delete_zip:
         message_error('Does not make sense to create zip file and delete it without posting to AWS S3. Aborting!')
@@ -147,22 +237,22 @@ def main(argv):
         if g.args.delete_zip and backups_to_do is None:
             message_info('Backups in S3 are already up-to-date. Nothing to do. Exiting!')
             util.sys_exit(0)
+    elif g.args.incremental:
+        # Backup goes into no S3 folder
+        plan_incremental_backup([])
 
-    # If user specified a directory with set of already-created get_*.py utilities output files to use, then
-    # do not run get_*.py data collection utilities, just use that
-    if g.args.source_directory is not None:
-        g.temp_directory = g.args.source_directory
-    else:
-        # Run get_XXX.py utilities into datetime_stamped CSV output files and messages_output.log output in
-        # temp directory
-        print('Running ccb_backup with output to temp directory: ' + g.temp_directory)
+    # Leave data collection results in the specified directory rather than zipping them
+    if g.args.output_directory is not None:
         g.run_util_errors = []
-        for data_set_name in g.backup_data_sets_dict:
-            if g.backup_data_sets_dict[data_set_name][0]:
-                run_util(data_set_name, g.backup_data_sets_dict[data_set_name][1])
-        message_info('Finished all data collection')
+        run_utils(None)
+        if g.args.incremental:
+            write_incremental_manifest()
+            commit_incremental_state([])
+        util.remove_checkpoint_journal(g.checkpoint_journal)
+        message_info('Finished all data collection into ' + g.temp_directory)
+        util.sys_exit(0)
 
-    # Create output ZIP file
+    # Determine output ZIP filename
     if g.args.output_filename is not None:
         output_filename = g.args.output_filename
     elif g.args.delete_zip:
@@ -175,13 +265,26 @@ def main(argv):
     else:
         output_filename = os.path.dirname(os.path.abspath(__file__)) + '/tmp/ccb_backup_' + \
             datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.zip'
-    exec_zip_list = ['/usr/bin/zip', '-P', g.zip_file_password, '-j', '-r', output_filename, g.temp_directory + '/']
-    message_info('Zipping data collection results files')
-    exit_status = subprocess.call(exec_zip_list)
-    if exit_status == 0:
-        message_info('Successfully zipped get_*.py utilities output and messages log to ' + output_filename)
+    archive = open_archive(output_filename)
+
+    # If user specified a directory with set of already-created get_*.py utilities output files to use, then
+    # do not run get_*.py data collection utilities, just use that
+    if g.args.source_directory is not None:
+        g.temp_directory = g.args.source_directory
     else:
-        message_warning('Error running zip. Exit status ' + str(exit_status))
+        # Run get_XXX.py utilities into datetime_stamped CSV output files and messages_output.log output in
+        # temp directory
+        print('Running ccb_backup with output to temp directory: ' + g.temp_directory)
+        g.run_util_errors = []
+        run_utils(archive)
+        message_info('Finished all data collection')
+
+    # Finish output ZIP file with whatever isn't in it yet (messages log, --source-directory files)
+    if g.args.incremental:
+        write_incremental_manifest()
+    close_archive(archive, output_filename)
+    if g.args.incremental and backups_to_do is None:
+        commit_incremental_state([])
 
     # Push ZIP file into appropriate schedule folders (daily, weekly, monthly, etc.) and then delete excess
     # backups in each folder
@@ -191,10 +294,16 @@ def main(argv):
     else:
         list_notification_emails = None
     if backups_to_do is not None:
+        # ZIP file is uploaded once, into the first folder needing it, and copied within S3 into the others
+        uploaded_s3_key = None
         for folder_name in backups_to_do:
             if backups_to_do[folder_name]['do_backup']:
                 try:
-                    s3_key = upload_to_s3(folder_name, output_filename)
+                    if uploaded_s3_key is None:
+                        s3_key = upload_to_s3(folder_name, output_filename)
+                        uploaded_s3_key = s3_key
+                    else:
+                        s3_key = copy_in_s3(uploaded_s3_key, folder_name, output_filename)
                 except:
                     message_error('Error uploading ccb_backup zip to S3')
                     if list_notification_emails is not None:
@@ -208,8 +317,11 @@ def main(argv):
                 expiring_url = gen_s3_expiring_url(s3_key, expiry_days)
                 message_info('Backup URL ' + expiring_url + ' is valid for ' + str(expiry_days) + ' days')
                 list_completed_backups.append([folder_name, expiring_url, expiry_days])
-            for item_to_delete in backups_to_do[folder_name]['files_to_delete']:
-                delete_from_s3(item_to_delete)
+        # The next incremental backup is diffed against this one only once it's safely in S3
+        if g.args.incremental:
+            commit_incremental_state([x for x in backups_to_do if backups_to_do[x]['do_backup']])
+        # Expired backups across all folders are deleted together, in as few requests as possible
+        delete_from_s3([x for folder_name in backups_to_do for x in backups_to_do[folder_name]['files_to_delete']])
         if list_notification_emails is not None:
             send_email_notification(list_completed_backups, list_notification_emails)
 
@@ -222,40 +334,380 @@ def main(argv):
             shutil.rmtree(g.temp_directory)
             message_info('Temporary output directory deleted')
 
+    # Backup is complete (and posted, if asked), so there is nothing left to resume
+    util.remove_checkpoint_journal(g.checkpoint_journal)
+
     util.sys_exit(0)
 
 
+def get_s3_client():
+    global g
+
+    # One S3 client is shared (across threads too) by all S3 operations in a run, so credentials, endpoint and
+    # connections are set up once. boto3 is only imported when S3 is actually used
+    if g.s3_client is None:
+        import boto3
+        import botocore.config
+
+        max_concurrency = util.get_ini_setting_int('s3_upload', 'max_concurrency', 4, 1)
+        max_pool_connections = util.get_ini_setting_int('aws', 'max_pool_connections', 10, 1)
+        addressing_style = util.get_ini_setting('s3_upload', 'addressing_style')
+        if addressing_style is None:
+            addressing_style = 'auto'
+        if addressing_style not in ['auto', 'virtual', 'path']:
+            message_error("Setting in ccb_backup.ini '[s3_upload]addressing_style' must be auto, virtual or path")
+            util.sys_exit(1)
+        config = botocore.config.Config(max_pool_connections=max(max_pool_connections, max_concurrency),
+            retries={'max_attempts': util.get_ini_setting_int('aws', 'retry_max_attempts', 5, 1),
+            'mode': 'standard'}, s3={'addressing_style': addressing_style})
+        g.s3_client = boto3.client('s3', aws_access_key_id=g.aws_access_key_id,
+            aws_secret_access_key=g.aws_secret_access_key, region_name=g.aws_region_name,
+            endpoint_url=util.get_ini_setting('s3_upload', 'endpoint_url'), config=config)
+    return g.s3_client
+
+
 def upload_to_s3(folder_name, output_filename):
     global g
 
-    # Cache and reuse exact same S3 filename even if upload_to_s3 called multiple times for daily, weekly, etc.
+    file_size = os.path.getsize(output_filename)
+    file_sha256 = get_file_md5_and_sha256(output_filename)[1]
+    settings = get_s3_upload_settings()
+    s3_client = get_s3_client()
+    upload_state = abort_stale_s3_uploads(s3_client, settings['state_filename'], file_sha256)
+
+    # Cache and reuse exact same S3 filename even if upload_to_s3 called multiple times for daily, weekly, etc. If
+    # an earlier multipart upload of a ZIP file with these same contents to this folder failed part way, resume it
+    # under its S3 key
+    if g.reuse_output_filename is None:
+        for s3_key in upload_state:
+            if s3_key.startswith(folder_name + '/'):
+                g.reuse_output_filename = s3_key[len(folder_name) + 1:]
+                break
     if g.reuse_output_filename is None:
         g.reuse_output_filename = datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.zip'
 
     s3_key = folder_name + '/' + g.reuse_output_filename
-    s3 = boto3.resource('s3', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key,
-        region_name=g.aws_region_name)
-    data = open(output_filename, 'rb')
-    bucket = s3.Bucket(g.aws_s3_bucket_name)
-    bucket.put_object(Key=s3_key, Body=data)
-    message_info('Uploaded to S3: ' + s3_key)
+    start_time = time.time()
+    if file_size < settings['multipart_threshold']:
+        upload_single_part_to_s3(s3_client, s3_key, output_filename)
+    else:
+        upload_multipart_to_s3(s3_client, s3_key, output_filename, settings)
+    head_response = verify_s3_upload(s3_client, s3_key, output_filename)
+    add_to_s3_catalog(s3_key, head_response)
+    seconds = max(time.time() - start_time, 0.001)
+    message_info('Uploaded to S3: ' + s3_key + ' ({:.1f} MB in {:.2f} seconds, {:.1f} MB/s)'.format(file_size / 1e6,
+        seconds, file_size / 1e6 / seconds))
+    return s3_key
+
+
+def copy_in_s3(source_s3_key, folder_name, output_filename):
+    global g
+
+    # Server-side copy of an already uploaded ZIP file, so it's only sent over the network once. Same filename is
+    # used in every folder
+    s3_key = folder_name + '/' + g.reuse_output_filename
+    s3_client = get_s3_client()
+    start_time = time.time()
+    copy_source = {'Bucket': g.aws_s3_bucket_name, 'Key': source_s3_key}
+    file_size = os.path.getsize(output_filename)
+    # Single CopyObject calls are limited to 5 GB
+    if file_size <= 5 * 1024 * 1024 * 1024:
+        s3_client.copy_object(Bucket=g.aws_s3_bucket_name, Key=s3_key, CopySource=copy_source,
+            MetadataDirective='COPY')
+    else:
+        copy_multipart_in_s3(s3_client, copy_source, s3_key, output_filename, get_s3_upload_settings())
+    head_response = verify_s3_upload(s3_client, s3_key, output_filename)
+    add_to_s3_catalog(s3_key, head_response)
+    message_info('Copied in S3: ' + source_s3_key + ' to ' + s3_key + ' in {:.2f} seconds'.format(time.time() -
+        start_time))
     return s3_key
 
 
+def copy_multipart_in_s3(s3_client, copy_source, s3_key, output_filename, settings):
+    global g
+
+    file_size = os.path.getsize(output_filename)
+    part_size = settings['part_size']
+    while (file_size + part_size - 1) // part_size > 10000:
+        part_size *= 2
+    num_parts = (file_size + part_size - 1) // part_size
+    response = s3_client.create_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key,
+        Metadata=get_s3_metadata(get_file_md5_and_sha256(output_filename)[1]))
+    upload_id = response['UploadId']
+
+    def do_copy_part(part_number):
+        first_byte = (part_number - 1) * part_size
+        last_byte = min(first_byte + part_size, file_size) - 1
+        response = s3_client.upload_part_copy(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id,
+            PartNumber=part_number, CopySource=copy_source,
+            CopySourceRange='bytes=' + str(first_byte) + '-' + str(last_byte))
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings['max_concurrency']) as executor:
+        try:
+            parts = list(executor.map(do_copy_part, range(1, num_parts + 1)))
+        except:
+            executor.shutdown(wait=False, cancel_futures=True)
+            s3_client.abort_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id)
+            raise
+    s3_client.complete_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id,
+        MultipartUpload={'Parts': parts})
+
+
+def get_s3_metadata(file_sha256):
+    global g
+
+    # Incremental backups are marked as deltas or full baselines, so retention knows which backups others need (see
+    # get_files_to_delete())
+    metadata = {'sha256': file_sha256}
+    if g.incremental_manifest is not None:
+        metadata['incremental'] = 'delta' if is_incremental_delta() else 'baseline'
+    return metadata
+
+
+def is_delta_in_s3(s3_client, s3_key):
+    global g
+
+    # A backup the catalog lists but S3 no longer has can't be anyone's baseline
+    try:
+        metadata = s3_client.head_object(Bucket=g.aws_s3_bucket_name, Key=s3_key).get('Metadata', {})
+    except s3_client.exceptions.ClientError:
+        return False
+    return metadata.get('incremental') == 'delta'
+
+
+def get_s3_upload_settings():
+    settings = {
+        'multipart_threshold': util.get_ini_setting_int('s3_upload', 'multipart_threshold_mb', 64, 5) * 1024 * 1024,
+        'part_size': util.get_ini_setting_int('s3_upload', 'part_size_mb', 16, 5) * 1024 * 1024,
+        'max_concurrency': util.get_ini_setting_int('s3_upload', 'max_concurrency', 4, 1),
+        'part_retries': util.get_ini_setting_int('s3_upload', 'part_retries', 3, 0),
+        'state_filename': util.get_ini_setting('s3_upload', 'state_filename')
+    }
+    if settings['state_filename'] is not None and not os.path.isabs(settings['state_filename']):
+        settings['state_filename'] = os.path.dirname(os.path.abspath(__file__)) + '/' + settings['state_filename']
+    return settings
+
+
+def upload_single_part_to_s3(s3_client, s3_key, output_filename):
+    global g
+
+    file_md5, file_sha256 = get_file_md5_and_sha256(output_filename)
+    with open(output_filename, 'rb') as data:
+        # S3 rejects the PUT if the body received doesn't match Content-MD5
+        response = s3_client.put_object(Bucket=g.aws_s3_bucket_name, Key=s3_key, Body=data,
+            ContentMD5=base64.b64encode(file_md5.digest()).decode('ascii'), Metadata=get_s3_metadata(file_sha256))
+    check_s3_etag(response, file_md5.hexdigest(), s3_key)
+
+
+def upload_multipart_to_s3(s3_client, s3_key, output_filename, settings):
+    global g
+
+    file_size = os.path.getsize(output_filename)
+    part_size = settings['part_size']
+    # S3 allows at most 10,000 parts per upload
+    while (file_size + part_size - 1) // part_size > 10000:
+        part_size *= 2
+    num_parts = (file_size + part_size - 1) // part_size
+    file_sha256 = get_file_md5_and_sha256(output_filename)[1]
+
+    # Resume an earlier failed upload of this same file if S3 still has it, keeping parts that made it
+    upload_state = load_s3_upload_state(settings['state_filename'])
+    uploaded_etags = {}
+    upload_id = None
+    if s3_key in upload_state and upload_state[s3_key]['sha256'] == file_sha256 and \
+       upload_state[s3_key]['part_size'] == part_size:
+        upload_id = upload_state[s3_key]['upload_id']
+        try:
+            paginator = s3_client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    uploaded_etags[part['PartNumber']] = part['ETag']
+            message_info('Resuming multipart upload of ' + s3_key + ' with ' + str(len(uploaded_etags)) + ' of ' + \
+                str(num_parts) + ' parts already uploaded')
+        except s3_client.exceptions.ClientError:
+            message_warning('Earlier multipart upload of ' + s3_key + ' no longer exists in S3. Starting over')
+            upload_id = None
+            uploaded_etags = {}
+    if upload_id is None:
+        response = s3_client.create_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key,
+            Metadata=get_s3_metadata(file_sha256))
+        upload_id = response['UploadId']
+        upload_state[s3_key] = {'upload_id': upload_id, 'part_size': part_size, 'sha256': file_sha256}
+        save_s3_upload_state(settings['state_filename'], upload_state)
+
+    def do_upload_part(part_number):
+        return upload_part_to_s3(s3_client, s3_key, upload_id, output_filename, part_number, part_size,
+            uploaded_etags.get(part_number), settings['part_retries'])
+
+    # Parts are uploaded concurrently, each read from the file on its own handle. A part that still fails after
+    # its retries fails the upload but leaves it open in S3, so the next run resumes with the parts that made it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings['max_concurrency']) as executor:
+        try:
+            part_md5s = list(executor.map(do_upload_part, range(1, num_parts + 1)))
+        except:
+            executor.shutdown(wait=False, cancel_futures=True)
+            message_error('Multipart upload of ' + s3_key + ' failed. Upload ID ' + upload_id + ' is kept for ' \
+                'resuming on the next run')
+            raise
+
+    parts = [{'PartNumber': x + 1, 'ETag': '"' + part_md5s[x].hexdigest() + '"'} for x in range(num_parts)]
+    response = s3_client.complete_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id,
+        MultipartUpload={'Parts': parts})
+    del upload_state[s3_key]
+    save_s3_upload_state(settings['state_filename'], upload_state)
+
+    # A multipart object's ETag is the MD5 of its parts' MD5s followed by its number of parts
+    multipart_md5 = hashlib.md5(b''.join([x.digest() for x in part_md5s]))
+    check_s3_etag(response, multipart_md5.hexdigest() + '-' + str(num_parts), s3_key)
+
+
+def upload_part_to_s3(s3_client, s3_key, upload_id, output_filename, part_number, part_size, uploaded_etag,
+    part_retries):
+    global g
+
+    with open(output_filename, 'rb') as input_file:
+        input_file.seek((part_number - 1) * part_size)
+        data = input_file.read(part_size)
+    part_md5 = hashlib.md5(data)
+    if uploaded_etag == '"' + part_md5.hexdigest() + '"':
+        return part_md5
+    retry_num = 0
+    while True:
+        try:
+            # S3 rejects the part if the body received doesn't match Content-MD5
+            response = s3_client.upload_part(Bucket=g.aws_s3_bucket_name, Key=s3_key, UploadId=upload_id,
+                PartNumber=part_number, Body=data, ContentMD5=base64.b64encode(part_md5.digest()).decode('ascii'))
+            check_s3_etag(response, part_md5.hexdigest(), s3_key + ' part ' + str(part_number))
+            return part_md5
+        except Exception as e:
+            if retry_num >= part_retries:
+                raise
+            retry_num += 1
+            message_warning('Upload of ' + s3_key + ' part ' + str(part_number) + ' failed (' + str(e) + \
+                '). Retry ' + str(retry_num) + ' of ' + str(part_retries))
+            time.sleep(2 ** retry_num)
+
+
+def verify_s3_upload(s3_client, s3_key, output_filename):
+    global g
+
+    # Whole-object check: size and SHA-256 (stored in the object's metadata for checking restores) must match
+    response = s3_client.head_object(Bucket=g.aws_s3_bucket_name, Key=s3_key)
+    file_sha256 = get_file_md5_and_sha256(output_filename)[1]
+    if response['ContentLength'] != os.path.getsize(output_filename) or \
+       response.get('Metadata', {}).get('sha256') != file_sha256:
+        raise Exception('S3 object ' + s3_key + ' does not match ' + output_filename + ' after upload')
+    return response
+
+
+def check_s3_etag(response, expected_etag, description):
+    # With SSE-KMS or SSE-C encryption, S3 ETags aren't MD5s, but S3 has already checked Content-MD5 on receipt
+    if response.get('ServerSideEncryption') == 'aws:kms' or 'SSECustomerAlgorithm' in response:
+        return
+    if response['ETag'].strip('"') != expected_etag:
+        raise Exception('Checksum mismatch uploading ' + description + ': S3 ETag ' + response['ETag'] + \
+            ', expected ' + expected_etag)
+
+
+def get_file_md5_and_sha256(filename):
+    global g
+
+    # Cached since the same ZIP file may be uploaded to several schedule folders
+    source = get_s3_upload_source(filename)
+    if source not in g.file_checksums:
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+                md5.update(chunk)
+                sha256.update(chunk)
+        g.file_checksums[source] = (md5, sha256.hexdigest())
+    return g.file_checksums[source]
+
+
+def abort_stale_s3_uploads(s3_client, state_filename, file_sha256):
+    global g
+
+    # S3 bills the parts of an open multipart upload until it's completed or aborted. Only an upload of the same
+    # contents (file_sha256) can be resumed, and each run's ZIP file differs, so abort every other upload kept in
+    # state_filename. Returns the remaining upload state
+    upload_state = load_s3_upload_state(state_filename)
+    stale_s3_keys = [x for x in upload_state if upload_state[x].get('sha256') != file_sha256]
+    for s3_key in stale_s3_keys:
+        try:
+            s3_client.abort_multipart_upload(Bucket=g.aws_s3_bucket_name, Key=s3_key,
+                UploadId=upload_state[s3_key]['upload_id'])
+            message_info('Aborted stale multipart upload of ' + s3_key)
+        except s3_client.exceptions.ClientError as e:
+            # Already completed, aborted or expired by a bucket lifecycle rule. Otherwise retried on the next run
+            if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                message_warning('Unable to abort stale multipart upload of ' + s3_key + ' (' + str(e) + ')')
+                continue
+        del upload_state[s3_key]
+    if len(stale_s3_keys) > 0:
+        save_s3_upload_state(state_filename, upload_state)
+    return upload_state
+
+
+def get_s3_upload_source(filename):
+    return os.path.abspath(filename) + ':' + str(os.path.getsize(filename)) + ':' + str(os.path.getmtime(filename))
+
+
+def load_s3_upload_state(state_filename):
+    if state_filename is None or not os.path.isfile(state_filename):
+        return {}
+    try:
+        with open(state_filename) as state_file:
+            return json.load(state_file)
+    except ValueError:
+        message_warning('Ignoring unreadable S3 upload state file ' + state_filename)
+        return {}
+
+
+def save_s3_upload_state(state_filename, upload_state):
+    if state_filename is None:
+        return
+    state_directory = os.path.dirname(state_filename)
+    if not os.path.isdir(state_directory):
+        os.makedirs(state_directory)
+    with tempfile.NamedTemporaryFile(mode='w', dir=state_directory, delete=False) as temp:
+        json.dump(upload_state, temp, indent=2, sort_keys=True)
+    os.replace(temp.name, state_filename)
+
+
 def gen_s3_expiring_url(s3_key, expiry_days):
     global g
 
-    s3Client = boto3.client('s3', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key,
-        region_name=g.aws_region_name)
-    url = s3Client.generate_presigned_url('get_object', Params = {'Bucket': g.aws_s3_bucket_name, 'Key': s3_key},
+    url = get_s3_client().generate_presigned_url('get_object', Params = {'Bucket': g.aws_s3_bucket_name, 'Key': s3_key},
         ExpiresIn = expiry_days * 24 * 60 * 60)
     return url
 
 
-def delete_from_s3(item_to_delete):
-    item_to_delete_key = item_to_delete.key
-    item_to_delete.delete()
-    message_info('Deleted from S3: ' + item_to_delete_key)
+def delete_from_s3(items_to_delete):
+    global g
+
+    if len(items_to_delete) == 0:
+        return
+    if g.args.dry_run_deletes:
+        for item_to_delete in items_to_delete:
+            message_info('Would delete from S3 (dry run): ' + item_to_delete.key)
+        return
+    s3_client = get_s3_client()
+    # DeleteObjects takes at most 1000 keys per request
+    for i in range(0, len(items_to_delete), 1000):
+        keys = [x.key for x in items_to_delete[i:i + 1000]]
+        response = s3_client.delete_objects(Bucket=g.aws_s3_bucket_name, Delete={'Objects': [{'Key': x} for x in keys],
+            'Quiet': True})
+        failed_keys = set()
+        for error in response.get('Errors', []):
+            failed_keys.add(error['Key'])
+            message_warning('Error deleting from S3: ' + error['Key'] + ' (' + error.get('Code', '') + ': ' + \
+                error.get('Message', '') + ')')
+        deleted_keys = [x for x in keys if x not in failed_keys]
+        remove_from_s3_catalog(deleted_keys)
+        for key in deleted_keys:
+            message_info('Deleted from S3: ' + key)
 
 
 def send_email_notification(list_completed_backups, list_notification_emails):
@@ -279,68 +731,64 @@ def send_email_notification(list_completed_backups, list_notification_emails):
     util.send_email(list_notification_emails, backup_completed_str, body)
 
 
+# Lightweight record of a backup ZIP file in S3. backup_datetime is parsed from its YYYYMMDDHHMMSS.zip filename
+S3Object = namedtuple('S3Object', ['key', 'last_modified', 'size', 'backup_datetime'])
+
+
 def get_backups_to_do():
     global g
 
     schedules_by_folder_name = {x['folder_name']:x for x in get_schedules_from_ini()}
-    s3 = boto3.resource('s3', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key,
-        region_name=g.aws_region_name)
+    s3_client = get_s3_client()
 
-    # In S3, folder items end with '/', whereas files do not
-    file_items = [item for item in s3.Bucket(g.aws_s3_bucket_name).objects.all() if item.key[-1] != '/']
+    # Folders reconciled against S3 recently enough are planned from the local catalog. Only the other schedule
+    # folders are listed, concurrently, rather than the whole bucket
     files_per_folder_dict = {}
-    for file_item in file_items:
-        path_sects = file_item.key.split('/')
-        if len(path_sects) == 2:
-            if path_sects[0] in schedules_by_folder_name:
-                filename = path_sects[1]
-                match = re.match('([0-9]{14})\.zip', filename)
-                if match is not None:
-                    valid_date = True
-                    try:
-                        datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
-                    except:
-                        valid_date = False
-                    if valid_date:
-                        if path_sects[0] not in files_per_folder_dict:
-                            files_per_folder_dict[path_sects[0]] = [file_item]
-                        else:
-                            files_per_folder_dict[path_sects[0]].append(file_item)
-                    else:
-                        message_info('ZIP file with invalid datetime format...ignoring: ' + file_item.key)
-                else:
-                    message_info('Unrecognized file in backup folder...ignoring: ' + file_item.key)
-            else:
-                message_info('Unrecognized folder or file in ccb_backups S3 bucket...ignoring: ' + file_item.key)
+    folder_names = []
+    for folder_name in schedules_by_folder_name:
+        files = get_s3_catalog_files(folder_name)
+        if files is not None:
+            files_per_folder_dict[folder_name] = files
         else:
-            message_info('Unrecognized folder or file in ccb_backups S3 bucket with long path...ignoring: ' +
-                file_item.key)
-    backups_to_post_dict = {}
+            folder_names.append(folder_name)
+    if len(files_per_folder_dict) > 0:
+        message_info('Using local S3 catalog for folder(s): ' + ', '.join(files_per_folder_dict))
+    if len(folder_names) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(folder_names)) as executor:
+            for folder_name, files in zip(folder_names, executor.map(lambda x: list_s3_folder(s3_client, x),
+                folder_names)):
+                files_per_folder_dict[folder_name] = files
+                reconcile_s3_catalog(folder_name, files)
+
+    do_backup_dict = {}
     for folder_name in schedules_by_folder_name:
-        num_files_to_keep = schedules_by_folder_name[folder_name]['num_files_to_keep']
-        files_to_delete = []
         do_backup = True
-        if folder_name in files_per_folder_dict:
-            sorted_by_last_modified_list = sorted(files_per_folder_dict[folder_name], key=lambda x: x.last_modified)
-            num_files = len(sorted_by_last_modified_list)
-            if schedules_by_folder_name[folder_name]['backup_after_datetime'] < \
-               sorted_by_last_modified_list[num_files - 1].last_modified:
+        files = files_per_folder_dict[folder_name]
+        if len(files) > 0:
+            # Backups are dated by their (local time) filenames, since S3 LastModified changes on re-upload
+            latest_backup_datetime = max([x.backup_datetime for x in files]).astimezone(pytz.UTC)
+            if schedules_by_folder_name[folder_name]['backup_after_datetime'] < latest_backup_datetime:
                 do_backup = False
                 message_info(folder_name + ': ' + \
                     str(schedules_by_folder_name[folder_name]['backup_after_datetime']) + ' < ' + \
-                    str(sorted_by_last_modified_list[num_files - 1].last_modified) + ', no backup to do')
+                    str(latest_backup_datetime) + ', no backup to do')
             else:
                 message_info(folder_name + ': ' + \
                     str(schedules_by_folder_name[folder_name]['backup_after_datetime']) + ' > ' + \
-                    str(sorted_by_last_modified_list[num_files - 1].last_modified) + ', doing backup')
-            # TODO deleted 2 out of weekly, should have deleted 3
-            if num_files_to_keep > 0 and num_files >= num_files_to_keep:
-                if do_backup:
-                    kicker = 1
-                else:
-                    kicker = 0
-                if num_files - num_files_to_keep + kicker > 0:
-                    files_to_delete = sorted_by_last_modified_list[0:num_files - num_files_to_keep + kicker]
+                    str(latest_backup_datetime) + ', doing backup')
+        do_backup_dict[folder_name] = do_backup
+
+    # Whether this backup is an incremental delta depends on which folders it goes into
+    new_backup_is_delta = False
+    if g.args.incremental:
+        new_backup_is_delta = plan_incremental_backup([x for x in do_backup_dict if do_backup_dict[x]])
+
+    backups_to_post_dict = {}
+    for folder_name in schedules_by_folder_name:
+        num_files_to_keep = schedules_by_folder_name[folder_name]['num_files_to_keep']
+        do_backup = do_backup_dict[folder_name]
+        files_to_delete = get_files_to_delete(files_per_folder_dict[folder_name], num_files_to_keep, do_backup,
+            lambda x: is_delta_in_s3(s3_client, x.key), new_backup_is_delta)
         if do_backup or len(files_to_delete) > 0:
             backups_to_post_dict[folder_name] = {'do_backup': do_backup, 'files_to_delete': files_to_delete}
     if len(backups_to_post_dict) > 0:
@@ -349,14 +797,143 @@ def get_backups_to_do():
         return None
 
 
+def list_s3_folder(s3_client, folder_name):
+    global g
+
+    files = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=g.aws_s3_bucket_name, Prefix=folder_name + '/', Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            message_info('Unrecognized folder in backup folder...ignoring: ' + common_prefix['Prefix'])
+        for item in page.get('Contents', []):
+            filename = item['Key'][len(folder_name) + 1:]
+            # In S3, folder items end with '/', whereas files do not
+            if filename == '':
+                continue
+            match = re.match(r'^([0-9]{14})\.zip$', filename)
+            if match is None:
+                message_info('Unrecognized file in backup folder...ignoring: ' + item['Key'])
+                continue
+            try:
+                backup_datetime = datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
+            except ValueError:
+                message_info('ZIP file with invalid datetime format...ignoring: ' + item['Key'])
+                continue
+            files.append(S3Object(item['Key'], item['LastModified'], item['Size'], backup_datetime))
+    return files
+
+
+def get_files_to_delete(files, num_files_to_keep, do_backup, is_delta=None, new_backup_is_delta=False):
+    # Keep the newest num_files_to_keep backups, counting the one about to be posted (0 keeps all of them). Backups
+    # are ordered by the datetime in their filenames, since LastModified is reset whenever an object is re-uploaded
+    # or restored. An incremental delta backup (per is_delta(file), or new_backup_is_delta for the one about to be
+    # posted) can only be restored along with every backup before it back to a full baseline, so those are kept too
+    if num_files_to_keep == 0:
+        return []
+    num_files_after_backup = len(files) + (1 if do_backup else 0)
+    num_files_to_delete = min(max(num_files_after_backup - num_files_to_keep, 0), len(files))
+    sorted_files = sorted(files, key=lambda x: (x.backup_datetime, x.last_modified))
+    if is_delta is not None and num_files_to_delete > 0:
+        # Newer deltas' chains end at the same or a later baseline than the oldest kept backup's chain
+        if num_files_to_delete < len(sorted_files):
+            needs_baseline = is_delta(sorted_files[num_files_to_delete])
+        else:
+            needs_baseline = do_backup and new_backup_is_delta
+        while needs_baseline and num_files_to_delete > 0:
+            num_files_to_delete -= 1
+            needs_baseline = is_delta(sorted_files[num_files_to_delete])
+    return sorted_files[0:num_files_to_delete]
+
+
+def get_s3_catalog():
+    global g
+
+    if g.s3_catalog is None:
+        catalog_filename = util.get_ini_setting('s3_catalog', 'filename')
+        if catalog_filename is None:
+            return None
+        if not os.path.isabs(catalog_filename):
+            catalog_filename = os.path.dirname(os.path.abspath(__file__)) + '/' + catalog_filename
+        if not os.path.isdir(os.path.dirname(catalog_filename)):
+            os.makedirs(os.path.dirname(catalog_filename))
+        g.s3_catalog = sqlite3.connect(catalog_filename)
+        with g.s3_catalog:
+            g.s3_catalog.execute('CREATE TABLE IF NOT EXISTS backups (bucket TEXT, key TEXT, size INTEGER, ' \
+                'last_modified TEXT, sha256 TEXT, backup_datetime TEXT, PRIMARY KEY (bucket, key))')
+            g.s3_catalog.execute('CREATE TABLE IF NOT EXISTS reconciliations (bucket TEXT, folder_name TEXT, ' \
+                'reconciled_at TEXT, PRIMARY KEY (bucket, folder_name))')
+    return g.s3_catalog
+
+
+def get_s3_catalog_files(folder_name):
+    global g
+
+    # Returns None if there's no catalog or folder_name wasn't reconciled against S3 within reconcile_hours
+    catalog = get_s3_catalog()
+    if catalog is None:
+        return None
+    reconcile_hours = util.get_ini_setting_int('s3_catalog', 'reconcile_hours', 24, 0)
+    row = catalog.execute('SELECT reconciled_at FROM reconciliations WHERE bucket = ? AND folder_name = ?',
+        (g.aws_s3_bucket_name, folder_name)).fetchone()
+    if row is None or datetime.datetime.fromisoformat(row[0]) < datetime.datetime.now(pytz.UTC) - \
+       datetime.timedelta(hours=reconcile_hours):
+        return None
+    files = []
+    for key, size, last_modified, backup_datetime in catalog.execute('SELECT key, size, last_modified, ' \
+        'backup_datetime FROM backups WHERE bucket = ? AND substr(key, 1, ?) = ?', (g.aws_s3_bucket_name,
+        len(folder_name) + 1, folder_name + '/')):
+        files.append(S3Object(key, datetime.datetime.fromisoformat(last_modified), size,
+            datetime.datetime.fromisoformat(backup_datetime)))
+    return files
+
+
+def reconcile_s3_catalog(folder_name, files):
+    global g
+
+    # Replace the catalog's view of folder_name with what was just listed in S3
+    catalog = get_s3_catalog()
+    if catalog is None:
+        return
+    with catalog:
+        catalog.execute('DELETE FROM backups WHERE bucket = ? AND substr(key, 1, ?) = ?', (g.aws_s3_bucket_name,
+            len(folder_name) + 1, folder_name + '/'))
+        catalog.executemany('INSERT INTO backups (bucket, key, size, last_modified, backup_datetime) VALUES ' \
+            '(?, ?, ?, ?, ?)', [(g.aws_s3_bucket_name, x.key, x.size, x.last_modified.isoformat(),
+            x.backup_datetime.isoformat()) for x in files])
+        catalog.execute('INSERT OR REPLACE INTO reconciliations (bucket, folder_name, reconciled_at) VALUES ' \
+            '(?, ?, ?)', (g.aws_s3_bucket_name, folder_name, datetime.datetime.now(pytz.UTC).isoformat()))
+
+
+def add_to_s3_catalog(s3_key, head_response):
+    global g
+
+    catalog = get_s3_catalog()
+    if catalog is None:
+        return
+    backup_datetime = datetime.datetime.strptime(s3_key.split('/')[-1][0:14], '%Y%m%d%H%M%S')
+    with catalog:
+        catalog.execute('INSERT OR REPLACE INTO backups (bucket, key, size, last_modified, sha256, ' \
+            'backup_datetime) VALUES (?, ?, ?, ?, ?, ?)', (g.aws_s3_bucket_name, s3_key,
+            head_response['ContentLength'], head_response['LastModified'].isoformat(),
+            head_response.get('Metadata', {}).get('sha256'), backup_datetime.isoformat()))
+
+
+def remove_from_s3_catalog(s3_keys):
+    global g
+
+    catalog = get_s3_catalog()
+    if catalog is None:
+        return
+    with catalog:
+        catalog.executemany('DELETE FROM backups WHERE bucket = ? AND key = ?', [(g.aws_s3_bucket_name, x) for x in
+            s3_keys])
+
+
 def get_schedules_from_ini():
-    config_file_path = os.path.dirname(os.path.abspath(__file__)) + '/ccb_backup.ini'
-    config_parser = configparser.ConfigParser()
-    config_parser.read(config_file_path)
     schedules = []
     curr_datetime = datetime.datetime.now(pytz.UTC)
     message_info('Current UTC datetime: ' + str(curr_datetime))
-    for schedule in config_parser.items('schedules'):
+    for schedule in util.get_ini_section_items('schedules'):
         schedule_parms = schedule[1].split(',')
         if len(schedule_parms) != 3:
             message_error("ccb_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' is invalid. " \
@@ -405,9 +982,208 @@ def now_minus_delta_time(delta_time_string):
         return datetime.datetime(year, month, day, curr_datetime.hour, curr_datetime.minute, curr_datetime.second,
             tzinfo=pytz.UTC) - datetime.timedelta(seconds=slop)
     else: # unit_char == 'Y'
-        return datetime.datetime(curr_datetime.year + num_units, curr_datetime.month, curr_datetime.day,
-            curr_datetime.hour, curr_datetime.minute, curr_datetime.second, tzinfo=pytz.UTC) - \
-            datetime.timedelta(seconds=slop)
+        year = curr_datetime.year - num_units
+        day = min(curr_datetime.day, calendar.monthrange(year, curr_datetime.month)[1])
+        return datetime.datetime(year, curr_datetime.month, day, curr_datetime.hour, curr_datetime.minute,
+            curr_datetime.second, tzinfo=pytz.UTC) - datetime.timedelta(seconds=slop)
+
+
+def run_utils(archive):
+    global g
+
+    data_set_names = [x for x in g.backup_data_sets_dict if g.backup_data_sets_dict[x][0]]
+    g.checkpoint_journal = util.open_checkpoint_journal('ccb_backup', g.args.resume, {'all_time': g.args.all_time})
+    if g.args.in_process:
+        start_in_process_utils(data_set_names)
+        run_util_function = lambda *x: run_checkpointed_util(run_util_in_process, *x)
+    else:
+        run_util_function = lambda *x: run_checkpointed_util(run_util, *x)
+    start_time = time.time()
+    elapsed_times = []
+    rest_api_totals = util.get_rest_api_metrics(totals=True)
+    if g.args.parallel_workers > 1:
+        message_info('Running ' + str(len(data_set_names)) + ' get_*.py utilities with up to ' + \
+            str(g.args.parallel_workers) + ' running concurrently')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=g.args.parallel_workers) as executor:
+            futures = {executor.submit(run_util_function, x, g.backup_data_sets_dict[x][1]): x for x in
+                data_set_names}
+            # Archive each utility's output as soon as it finishes, while the others are still running
+            for future in concurrent.futures.as_completed(futures):
+                elapsed_time, output_filenames = future.result()
+                elapsed_times.append(elapsed_time)
+                if g.args.incremental:
+                    output_filenames = make_incremental_files(futures[future], output_filenames)
+                add_to_archive(archive, output_filenames)
+    else:
+        for data_set_name in data_set_names:
+            elapsed_time, output_filenames = run_util_function(data_set_name, g.backup_data_sets_dict[data_set_name][1])
+            elapsed_times.append(elapsed_time)
+            if g.args.incremental:
+                output_filenames = make_incremental_files(data_set_name, output_filenames)
+            add_to_archive(archive, output_filenames)
+    wall_clock_time = time.time() - start_time
+    if g.http_session is not None:
+        g.http_session.close()
+
+    # Sum of per-utility times is what running the same utilities serially would have cost
+    message_info('Data collection wall-clock time {:.1f} seconds versus {:.1f} seconds summed across '
+        'utilities (serial equivalent)'.format(wall_clock_time, sum(elapsed_times)))
+
+    # With [ccb_rest_api]state_filename set, the totals include calls made by get_*.py utilities run as subprocesses.
+    # Much time waiting on the rate limit but no HTTP 429s suggests requests_per_minute could be raised
+    rest_api_metrics = util.get_rest_api_metrics(totals=True)
+    message_info(util.format_rest_api_metrics({x: rest_api_metrics[x] - rest_api_totals[x] for x in rest_api_metrics}))
+
+
+def start_incremental():
+    global g
+
+    g.incremental_state_directory = util.get_ini_setting('incremental', 'state_directory', False)
+    if not os.path.isabs(g.incremental_state_directory):
+        g.incremental_state_directory = os.path.dirname(os.path.abspath(__file__)) + '/' + \
+            g.incremental_state_directory
+    if not os.path.isdir(g.incremental_state_directory):
+        os.makedirs(g.incremental_state_directory)
+    g.incremental_state = {'chain': None, 'data_sets': {}}
+    if os.path.isfile(g.incremental_state_directory + '/state.json'):
+        with open(g.incremental_state_directory + '/state.json') as state_file:
+            g.incremental_state.update(json.load(state_file))
+    g.incremental_manifest = {'stamp': datetime.datetime.now().strftime('%Y%m%d%H%M%S'), 'data_sets': {}}
+
+
+def plan_incremental_backup(folder_names):
+    global g
+
+    # Returns True if this backup, going into S3 folder_names, can be an incremental delta. A delta can only be
+    # restored along with every backup since the last full baseline, so a full baseline is stored instead every
+    # baseline_every backups, and whenever one of folder_names didn't get every backup since the last baseline (e.g.
+    # weekly and monthly folders, which get only some of the backups)
+    baseline_every = util.get_ini_setting_int('incremental', 'baseline_every', 24, 1)
+    chain = g.incremental_state['chain']
+    if chain is None:
+        g.incremental_baseline_reason = 'there is no earlier incremental backup'
+    elif chain['deltas_since_baseline'] + 1 >= baseline_every:
+        g.incremental_baseline_reason = '[incremental]baseline_every is ' + str(baseline_every)
+    else:
+        missing_folder_names = [x for x in folder_names if x not in chain['folder_names']]
+        if len(missing_folder_names) > 0:
+            g.incremental_baseline_reason = 'S3 folder(s) ' + ', '.join(missing_folder_names) + ' lack earlier ' \
+                'backups it would depend on'
+        else:
+            g.incremental_baseline_reason = None
+    if g.incremental_baseline_reason is not None:
+        message_info('Storing full incremental baseline, since ' + g.incremental_baseline_reason)
+    return g.incremental_baseline_reason is None
+
+
+def is_incremental_delta():
+    global g
+
+    return any([x['mode'] == 'delta' for x in g.incremental_manifest['data_sets'].values()])
+
+
+def make_incremental_files(data_set_name, output_filenames):
+    global g
+
+    # Replaces each of a utility's output CSVs with a delta against the CSV of the previous incremental backup,
+    # unless a full baseline is due. Returns the filenames now to be archived
+    if g.run_util_errors is not None and 'get_' + data_set_name + '.py' in g.run_util_errors:
+        message_warning('Keeping full output of get_' + data_set_name + '.py, which had errors, out of incremental ' \
+            'backup chain')
+        return output_filenames
+    key_columns_dict = dict(ccb_backup_delta.DEFAULT_KEY_COLUMNS)
+    for name, key_columns in util.get_ini_section_items('incremental_key_columns'):
+        key_columns_dict[name] = [x.strip() for x in key_columns.split(',')]
+    incremental_filenames = []
+    for output_filename in output_filenames:
+        if not os.path.isfile(output_filename):
+            continue
+        name = os.path.basename(output_filename).rsplit('_', 1)[0]
+        previous_filename = g.incremental_state_directory + '/' + name + '.csv'
+        state = g.incremental_state['data_sets'].get(name)
+        entry = {'mode': 'baseline', 'filename': os.path.basename(output_filename), 'base_stamp': None,
+            'sha256': ccb_backup_delta.get_file_sha256(output_filename)}
+        if g.incremental_baseline_reason is None and state is not None and os.path.isfile(previous_filename):
+            delta_filename = output_filename[:-len('.csv')] + '.delta.csv'
+            counts = ccb_backup_delta.write_delta_csv(previous_filename, output_filename, delta_filename,
+                key_columns_dict.get(name, []))
+            if counts is not None:
+                entry.update({'mode': 'delta', 'filename': os.path.basename(delta_filename),
+                    'base_stamp': state['stamp']}, **counts)
+                message_info('Incremental ' + name + ': {inserted} inserted, {updated} updated, {deleted} deleted ' \
+                    'rows'.format(**counts) + ' ({:.1f} MB full CSV, {:.3f} MB delta)'.format(
+                    os.path.getsize(output_filename) / 1e6, os.path.getsize(delta_filename) / 1e6))
+            else:
+                message_info('Incremental ' + name + ': header changed or rows reordered, so storing full baseline')
+        # Full CSV becomes what the next incremental backup is diffed against, once this backup is complete
+        os.replace(output_filename, previous_filename + '.pending')
+        if entry['mode'] == 'baseline':
+            shutil.copyfile(previous_filename + '.pending', output_filename)
+            incremental_filenames.append(output_filename)
+        else:
+            incremental_filenames.append(delta_filename)
+        g.incremental_manifest['data_sets'][name] = entry
+    return incremental_filenames
+
+
+def write_incremental_manifest():
+    global g
+
+    with open(g.temp_directory + '/incremental_' + g.incremental_manifest['stamp'] + '.json', 'w') as manifest_file:
+        json.dump(g.incremental_manifest, manifest_file, indent=2, sort_keys=True)
+
+
+def commit_incremental_state(folder_names):
+    global g
+
+    # Called once this backup is stored in S3 folder_names (if any), so following backups can depend on it
+    if is_incremental_delta():
+        chain = {'deltas_since_baseline': g.incremental_state['chain']['deltas_since_baseline'] + 1,
+            'folder_names': folder_names}
+    else:
+        # Nothing after a full baseline may depend on backups before it, including data sets left out of it
+        chain = {'deltas_since_baseline': 0, 'folder_names': folder_names}
+        g.incremental_state['data_sets'] = {}
+    for name in g.incremental_manifest['data_sets']:
+        previous_filename = g.incremental_state_directory + '/' + name + '.csv'
+        os.replace(previous_filename + '.pending', previous_filename)
+        g.incremental_state['data_sets'][name] = {'stamp': g.incremental_manifest['stamp']}
+    g.incremental_state['chain'] = chain
+    with tempfile.NamedTemporaryFile(mode='w', dir=g.incremental_state_directory, delete=False) as temp:
+        json.dump(g.incremental_state, temp, indent=2, sort_keys=True)
+    os.replace(temp.name, g.incremental_state_directory + '/state.json')
+
+
+def run_checkpointed_util(run_util_function, util_name, second_util_name=None):
+    global g
+
+    # Output of a utility that completed in an interrupted earlier run (see --resume) is reused. Otherwise, the
+    # utility is run and, if it succeeds, its output is kept (hard linked) in the checkpoint journal's directory
+    checkpoint = util.get_checkpoint(g.checkpoint_journal, util_name)
+    if checkpoint is not None:
+        output_filenames = get_util_output_filenames(util_name, second_util_name)
+        for checkpoint_filename, output_filename in zip(checkpoint['filenames'], output_filenames):
+            util.link_or_copy_file(g.checkpoint_journal['directory'] + '/' + checkpoint_filename, output_filename)
+        message_info('Reusing output of get_' + util_name + '.py completed by interrupted earlier run')
+        return 0.0, output_filenames
+    elapsed_time, output_filenames = run_util_function(util_name, second_util_name)
+    if g.checkpoint_journal is not None and 'get_' + util_name + '.py' not in g.run_util_errors:
+        for output_filename in output_filenames:
+            util.link_or_copy_file(output_filename, g.checkpoint_journal['directory'] + '/' + \
+                os.path.basename(output_filename))
+        util.add_checkpoint(g.checkpoint_journal, util_name,
+            {'filenames': [os.path.basename(x) for x in output_filenames]})
+    return elapsed_time, output_filenames
+
+
+def get_util_output_filenames(util_name, second_util_name=None):
+    global g
+
+    datetime_stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    output_filenames = [g.temp_directory + '/' + util_name + '_' + datetime_stamp + '.csv']
+    if second_util_name is not None:
+        output_filenames.append(g.temp_directory + '/' + second_util_name + '_' + datetime_stamp + '.csv')
+    return output_filenames
 
 
 def run_util(util_name, second_util_name=None):
@@ -418,28 +1194,303 @@ def run_util(util_name, second_util_name=None):
     else:
         all_time_list = []
 
-    datetime_stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     util_py = 'get_' + util_name + '.py'
     fullpath_util_py = os.path.dirname(os.path.realpath(__file__)) + '/' + util_py
+    output_filenames = get_util_output_filenames(util_name, second_util_name)
     if second_util_name is not None:
-        output_filename1 = g.temp_directory + '/' + util_name + '_' + datetime_stamp + '.csv'
-        output_filename2 = g.temp_directory + '/' + second_util_name + '_' + datetime_stamp + '.csv'
-        outputs_list = ['--output-' + util_name + '-filename', output_filename1,
-            '--output-' + second_util_name + '-filename', output_filename2]
-        message_info('Running ' + util_py + ' with output files ' + output_filename1 + ' and ' + \
-            output_filename2)
+        outputs_list = ['--output-' + util_name + '-filename', output_filenames[0],
+            '--output-' + second_util_name + '-filename', output_filenames[1]]
+        message_info('Running ' + util_py + ' with output files ' + output_filenames[0] + ' and ' + \
+            output_filenames[1])
     else:
-        output_filename = g.temp_directory + '/' + util_name + '_' + datetime_stamp + '.csv'
-        outputs_list = ['--output-filename', output_filename]
-        message_info('Running ' + util_py + ' with output file ' + output_filename)
-    exec_list = [fullpath_util_py] + all_time_list + ['--message-output-filename', g.message_output_filename] + \
-        outputs_list
+        outputs_list = ['--output-filename', output_filenames[0]]
+        message_info('Running ' + util_py + ' with output file ' + output_filenames[0])
+    if util_name in ['attendance', 'transactions', 'pledges'] and g.args.resume:
+        resume_list = ['--resume']
+    else:
+        resume_list = []
+    exec_list = [fullpath_util_py] + all_time_list + resume_list + ['--message-output-filename',
+        g.message_output_filename] + outputs_list
+    start_time = time.time()
     exit_status = subprocess.call(exec_list)
+    elapsed_time = time.time() - start_time
     if exit_status == 0:
-        message_info('Successfully ran ' + util_py)
+        message_info('Successfully ran ' + util_py + ' in {:.1f} seconds'.format(elapsed_time))
     else:
         message_warning('Error running ' + util_py + '. Exit status ' + str(exit_status))
-        g.run_util_errors.append(util_py)
+        with g.run_util_errors_lock:
+            g.run_util_errors.append(util_py)
+    return elapsed_time, output_filenames
+
+
+def start_in_process_utils(data_set_names):
+    global g
+
+    g.ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
+    g.ccb_api_username = util.get_ini_setting('ccb', 'api_username', False)
+    g.ccb_api_password = util.get_ini_setting('ccb', 'api_password', False)
+
+    # Tag messages logged by each in-process utility with its name, as its own process would have
+    logging.getLogger().addFilter(InProcessUtilLogFilter())
+
+    start_time = time.time()
+    g.util_modules = {x: importlib.import_module('get_' + x) for x in data_set_names}
+    import_time = time.time() - start_time
+
+    message_info('Loaded {} get_*.py utilities in-process in {:.2f} seconds'.format(len(data_set_names),
+        import_time))
+
+    # Every utility except groups (which only uses the REST API) needs a CCB UI login
+    num_ui_utils = len([x for x in data_set_names if x != 'groups'])
+    if num_ui_utils > 0:
+        start_time = time.time()
+        g.http_session = util.get_ccb_ui_session(g.ccb_subdomain, util.get_ini_setting('ccb', 'app_username', False),
+            util.get_ini_setting('ccb', 'app_password', False))
+        login_time = time.time() - start_time
+        message_info('Started one CCB UI session in {:.2f} seconds for {} utilities, saving about {:.1f} seconds of '
+            'repeated session setup'.format(login_time, num_ui_utils, (num_ui_utils - 1) * login_time))
+
+
+def run_util_in_process(util_name, second_util_name=None):
+    global g
+
+    util_py = 'get_' + util_name + '.py'
+    output_filenames = get_util_output_filenames(util_name, second_util_name)
+    message_info('Running ' + util_py + ' in-process with output file(s) ' + ' and '.join(output_filenames))
+    util_module = g.util_modules[util_name]
+    g.in_process_util.name = util_py[:-3]
+    start_time = time.time()
+    succeeded = True
+    try:
+        if util_name == 'individuals':
+            util_module.collect_individuals(g.http_session, g.ccb_subdomain, output_filenames[0])
+        elif util_name == 'groups':
+            util_module.collect_groups(g.ccb_subdomain, g.ccb_api_username, g.ccb_api_password, output_filenames[0],
+                output_filenames[1])
+        elif util_name == 'attendance':
+            util_module.collect_attendance(g.http_session, g.ccb_subdomain, g.ccb_api_username,
+                g.ccb_api_password, output_filenames[0], output_filenames[1],
+                util_module.get_start_date_str(g.args.all_time), resume=g.args.resume)
+        elif util_name == 'pledges':
+            util_module.collect_pledges(g.http_session, g.ccb_subdomain, output_filenames[0], resume=g.args.resume)
+        else: # util_name == 'transactions'
+            util_module.collect_transactions(g.http_session, g.ccb_subdomain, output_filenames[0],
+                resume=g.args.resume)
+    except SystemExit as e:
+        # get_*.py utilities abort with util.sys_exit() on errors
+        succeeded = False
+        exit_status = e.code
+    except Exception:
+        logging.exception('Unhandled exception')
+        succeeded = False
+        exit_status = None
+    finally:
+        g.in_process_util.name = None
+    elapsed_time = time.time() - start_time
+    if succeeded:
+        message_info('Successfully ran ' + util_py + ' in {:.1f} seconds'.format(elapsed_time))
+    else:
+        message_warning('Error running ' + util_py + '. Exit status ' + str(exit_status))
+        with g.run_util_errors_lock:
+            g.run_util_errors.append(util_py)
+    return elapsed_time, output_filenames
+
+
+class InProcessUtilLogFilter(logging.Filter):
+    # The utility a thread runs is noted in g.in_process_util. Threads of the utilities' own worker pools are named
+    # after their utility (thread_name_prefix), so their messages are tagged too
+    def filter(self, record):
+        util_name = getattr(g.in_process_util, 'name', None)
+        if util_name is None and record.threadName.startswith('get_'):
+            util_name = record.threadName.rsplit('_', 1)[0]
+        if util_name is not None:
+            record.msg = util_name + ':' + str(record.msg)
+        return True
+
+
+def open_archive(output_filename):
+    global g
+
+    g.archive_stats = {'bytes_in': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'archived_filenames': set(),
+        'pending_parts': []}
+    if g.args.archive_writer == 'zip':
+        # /usr/bin/zip is run over the whole temp directory in close_archive()
+        return None
+    try:
+        import pyzipper
+    except ImportError:
+        message_warning('Python package pyzipper is not installed, so falling back to /usr/bin/zip with legacy ' \
+            'ZipCrypto encryption. Install pyzipper (pip install pyzipper) for AES encryption')
+        g.args.archive_writer = 'zip'
+        return None
+    if g.args.compression_workers > 1 and not pyzipper.__version__.startswith(('0.3.', '0.4.')):
+        # merge_archive_member() relies on zipfile internals, as pyzipper has no public API for adding members that
+        # are already compressed and encrypted
+        message_warning('--compression-workers needs pyzipper 0.3.x or 0.4.x, but pyzipper ' + pyzipper.__version__ +
+            ' is installed. Compressing in this process instead')
+        g.args.compression_workers = 1
+    message_info('Writing AES-256 encrypted zip file ' + output_filename + ' at compression level ' + \
+        str(g.args.compression_level) + ' using ' + str(g.args.compression_workers) + ' compression worker(s)')
+    if g.args.compression_workers > 1:
+        # Each member is compressed and encrypted into its own single-member zip file by a worker process, on its
+        # own core, then copied into the backup zip file as is
+        g.compression_executor = concurrent.futures.ProcessPoolExecutor(max_workers=g.args.compression_workers)
+        g.compression_parts_directory = tempfile.mkdtemp(prefix='ccb_backup_parts_')
+    return open_aes_zip_file(output_filename, g.zip_file_password, g.args.compression_level)
+
+
+def open_aes_zip_file(output_filename, password, compression_level):
+    import pyzipper
+
+    if compression_level == 0:
+        compression = pyzipper.ZIP_STORED
+    else:
+        compression = pyzipper.ZIP_DEFLATED
+    archive = pyzipper.AESZipFile(output_filename, 'w', compression=compression, compresslevel=compression_level,
+        encryption=pyzipper.WZ_AES)
+    archive.setpassword(password.encode('utf-8'))
+    return archive
+
+
+def add_to_archive(archive, filenames):
+    global g
+
+    if archive is None:
+        return
+    for filename in filenames:
+        if not os.path.isfile(filename) or filename in g.archive_stats['archived_filenames']:
+            continue
+        g.archive_stats['bytes_in'] += os.path.getsize(filename)
+        g.archive_stats['archived_filenames'].add(filename)
+        if g.compression_executor is not None:
+            part_filename = g.compression_parts_directory + '/' + str(len(g.archive_stats['pending_parts'])) + '.zip'
+            future = g.compression_executor.submit(compress_archive_member, filename, part_filename,
+                g.zip_file_password, g.args.compression_level)
+            g.archive_stats['pending_parts'].append([future, part_filename])
+            message_info('Compressing ' + os.path.basename(filename) + ' for zip file')
+        else:
+            start_time = time.time()
+            start_cpu_time = time.thread_time()
+            # Store without directory, as 'zip -j' does
+            archive.write(filename, arcname=os.path.basename(filename))
+            g.archive_stats['seconds'] += time.time() - start_time
+            g.archive_stats['cpu_seconds'] += time.thread_time() - start_cpu_time
+            message_info('Added ' + os.path.basename(filename) + ' to zip file')
+
+
+def compress_archive_member(filename, part_filename, password, compression_level):
+    # Runs in a compression worker process. Returns CPU seconds spent
+    start_cpu_time = time.process_time()
+    with open_aes_zip_file(part_filename, password, compression_level) as part_archive:
+        part_archive.write(filename, arcname=os.path.basename(filename))
+    return time.process_time() - start_cpu_time
+
+
+def merge_archive_member(archive, part_filename):
+    # Copy the already compressed and encrypted member of a single-member zip file into archive byte for byte, and
+    # list it in archive's central directory at its new offset. This reaches into zipfile internals (start_dir, fp,
+    # NameToInfo, _didModify) of the pyzipper versions open_archive() allows, and verify_archive_members() checks the
+    # result
+    import pyzipper
+
+    with pyzipper.AESZipFile(part_filename) as part_archive:
+        zinfo = part_archive.infolist()[0]
+        member_length = part_archive.start_dir
+    # pyzipper adds the WinZip AES extra field itself when writing the central directory
+    zinfo.extra = strip_zip_extra_field(zinfo.extra, 0x9901)
+    zinfo.header_offset = archive.start_dir
+    archive.fp.seek(archive.start_dir)
+    with open(part_filename, 'rb') as part_file:
+        while member_length > 0:
+            chunk = part_file.read(min(member_length, 1024 * 1024))
+            archive.fp.write(chunk)
+            member_length -= len(chunk)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    archive._didModify = True
+
+
+def verify_archive_members(output_filename, password):
+    # Opening each member checks that its local header sits where the central directory says, with the same name,
+    # and that password unlocks it, without decompressing any data
+    import pyzipper
+
+    try:
+        with pyzipper.AESZipFile(output_filename) as archive:
+            archive.setpassword(password.encode('utf-8'))
+            for zinfo in archive.infolist():
+                with archive.open(zinfo):
+                    pass
+    except (pyzipper.BadZipFile, RuntimeError) as e:
+        message_error('Merged zip file ' + output_filename + ' is corrupt (' + str(e) + '). Rerun with ' +
+            '--compression-workers 1')
+        util.sys_exit(1)
+
+
+def strip_zip_extra_field(extra, header_id):
+    stripped_extra = b''
+    i = 0
+    while i + 4 <= len(extra):
+        field_header_id, field_length = struct.unpack('<HH', extra[i:i + 4])
+        if field_header_id != header_id:
+            stripped_extra += extra[i:i + 4 + field_length]
+        i += 4 + field_length
+    return stripped_extra
+
+
+def close_archive(archive, output_filename):
+    global g
+
+    remaining_filenames = []
+    for dir_path, dir_names, filenames in os.walk(g.temp_directory):
+        remaining_filenames += sorted([os.path.join(dir_path, x) for x in filenames])
+    if archive is not None:
+        message_info('Zipping data collection results files')
+        add_to_archive(archive, remaining_filenames)
+        start_time = time.time()
+        for future, part_filename in g.archive_stats['pending_parts']:
+            g.archive_stats['cpu_seconds'] += future.result()
+            merge_archive_member(archive, part_filename)
+            os.remove(part_filename)
+        archive.close()
+        if g.compression_executor is not None:
+            verify_archive_members(output_filename, g.zip_file_password)
+        g.archive_stats['seconds'] += time.time() - start_time
+        if g.compression_executor is not None:
+            g.compression_executor.shutdown()
+            os.rmdir(g.compression_parts_directory)
+        message_info('Successfully zipped get_*.py utilities output and messages log to ' + output_filename)
+    else:
+        g.archive_stats['bytes_in'] = sum([os.path.getsize(x) for x in remaining_filenames])
+        exec_zip_list = ['/usr/bin/zip', '-' + str(g.args.compression_level), '-P', g.zip_file_password, '-j',
+            '-r', output_filename, g.temp_directory + '/']
+        message_info('Zipping data collection results files')
+        start_time = time.time()
+        start_cpu_time = get_children_cpu_time()
+        exit_status = subprocess.call(exec_zip_list)
+        g.archive_stats['seconds'] = time.time() - start_time
+        g.archive_stats['cpu_seconds'] = get_children_cpu_time() - start_cpu_time
+        if exit_status == 0:
+            message_info('Successfully zipped get_*.py utilities output and messages log to ' + output_filename)
+        else:
+            message_warning('Error running zip. Exit status ' + str(exit_status))
+            return
+
+    # Wall time counts only time spent waiting on the zip file, not compression overlapped with data collection
+    bytes_in = g.archive_stats['bytes_in']
+    seconds = max(g.archive_stats['seconds'], 0.001)
+    message_info('Zip file writer \'{}\' compressed {:.1f} MB to {:.1f} MB in {:.2f} seconds wall time, {:.2f} ' \
+        'seconds CPU time ({:.1f} MB/s)'.format(g.args.archive_writer, bytes_in / 1e6,
+        os.path.getsize(output_filename) / 1e6, seconds, g.archive_stats['cpu_seconds'], bytes_in / 1e6 / seconds))
+
+
+def get_children_cpu_time():
+    # CPU seconds used by finished child processes (e.g. zip utility), or 0.0 where that's unknown (Windows)
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
 
 
 def message_info(s):
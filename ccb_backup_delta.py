@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+#######################################################################################################################
+# Incremental (delta) CSVs for ccb_backup.py --incremental.  A delta CSV holds only the rows inserted, updated, or
+# deleted since the previous backup's CSV for the same data set, matched up by primary key columns.  Each delta row
+# has two extra leading columns: '_change' (insert, update, or delete) and '_position' (the row's index, not counting
+# the header row, in the new CSV for inserts, or in the previous CSV for updates and deletes).  Applying the deltas
+# since the latest full 'baseline' CSV, in order, reproduces the point-in-time CSV byte for byte.
+#
+# Each incremental backup also holds an incremental_[datetime_stamp].json manifest saying which CSVs are baselines
+# and which are deltas (and against which backup).  To reconstruct a full CSV, extract the backups' files into one
+# directory and run e.g.:
+#     ccb_backup_delta.py --input-directory ./extracted --data-set individuals --as-of 20240101020000 \
+#         --output-filename individuals.csv
+#######################################################################################################################
+
+import sys
+import os
+import csv
+import json
+import hashlib
+import argparse
+
+
+# Primary key columns of each data set's CSV. If a CSV lacks any of them, the whole row is used as its key (so a
+# changed row shows up as a delete plus an insert). Overridable in ccb_backup.ini [incremental_key_columns]
+DEFAULT_KEY_COLUMNS = {
+    'individuals': ['Ind ID'],
+    'groups': ['id'],
+    'participants': ['group_id', 'participant_id', 'participant_type'],
+    'events': ['event_id'],
+    'attendance': ['event_id', 'event_occurrence', 'individual_id'],
+    'pledges': ['COA ID', 'Name'],
+    'transactions': ['Transaction ID']
+}
+
+DELTA_COLUMNS = ['_change', '_position']
+
+
+def read_csv(filename):
+    with open(filename, newline='', encoding='utf-8') as input_file:
+        rows = list(csv.reader(input_file))
+    if len(rows) == 0:
+        return [], []
+    return rows[0], rows[1:]
+
+
+def write_csv(filename, header, rows):
+    # An empty header is an empty data set (e.g. no pledge categories), which is written back as an empty file
+    with open(filename, 'w', newline='', encoding='utf-8') as output_file:
+        if len(header) == 0:
+            return
+        csv_writer = csv.writer(output_file)
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows)
+
+
+def get_row_keys(header, rows, key_columns):
+    # Rows sharing a key are told apart by their occurrence number
+    if all([x in header for x in key_columns]) and len(key_columns) > 0:
+        key_indexes = [header.index(x) for x in key_columns]
+    else:
+        key_indexes = list(range(len(header)))
+    occurrences = {}
+    row_keys = []
+    for row in rows:
+        key = tuple([row[x] if x < len(row) else '' for x in key_indexes])
+        occurrences[key] = occurrences.get(key, -1) + 1
+        row_keys.append(key + (occurrences[key],))
+    return row_keys
+
+
+def write_delta_csv(previous_filename, new_filename, delta_filename, key_columns):
+    # Returns counts of rows inserted, updated, and deleted, or None (and writes nothing) if a delta can't reproduce
+    # new_filename, because the header changed or surviving rows were reordered, so a baseline is needed instead
+    previous_header, previous_rows = read_csv(previous_filename)
+    new_header, new_rows = read_csv(new_filename)
+    if previous_header != new_header:
+        return None
+    previous_keys = get_row_keys(previous_header, previous_rows, key_columns)
+    new_keys = get_row_keys(new_header, new_rows, key_columns)
+    previous_positions = {x: i for i, x in enumerate(previous_keys)}
+    new_key_set = set(new_keys)
+    if [x for x in previous_keys if x in new_key_set] != [x for x in new_keys if x in previous_positions]:
+        return None
+
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    delta_rows = []
+    for position, key in enumerate(previous_keys):
+        if key not in new_key_set:
+            delta_rows.append(['delete', str(position)] + previous_rows[position])
+            counts['deleted'] += 1
+    for position, key in enumerate(new_keys):
+        if key not in previous_positions:
+            delta_rows.append(['insert', str(position)] + new_rows[position])
+            counts['inserted'] += 1
+        elif previous_rows[previous_positions[key]] != new_rows[position]:
+            delta_rows.append(['update', str(previous_positions[key])] + new_rows[position])
+            counts['updated'] += 1
+    write_csv(delta_filename, DELTA_COLUMNS + new_header, delta_rows)
+    return counts
+
+
+def apply_delta_csv(header, rows, delta_filename):
+    # Returns the rows of the CSV that delta_filename was made from, given the rows of the CSV it was made against
+    delta_header, delta_rows = read_csv(delta_filename)
+    if delta_header != DELTA_COLUMNS + header:
+        raise Exception('Delta CSV ' + delta_filename + ' does not match header of the CSV it is applied to')
+    deleted_positions = set()
+    updated_rows = {}
+    inserted_rows = []
+    for delta_row in delta_rows:
+        change, position, row = delta_row[0], int(delta_row[1]), delta_row[2:]
+        if change == 'delete':
+            deleted_positions.add(position)
+        elif change == 'update':
+            updated_rows[position] = row
+        else:
+            inserted_rows.append((position, row))
+    surviving_rows = [updated_rows.get(i, x) for i, x in enumerate(rows) if i not in deleted_positions]
+    # Inserts are in ascending position order. Surviving rows fill the gaps between them
+    new_rows = []
+    surviving_index = 0
+    for position, row in inserted_rows:
+        num_surviving_rows = position - len(new_rows)
+        new_rows += surviving_rows[surviving_index:surviving_index + num_surviving_rows]
+        surviving_index += num_surviving_rows
+        new_rows.append(row)
+    new_rows += surviving_rows[surviving_index:]
+    return new_rows
+
+
+def get_file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def reconstruct_csv(input_directory, data_set_name, as_of_stamp, output_filename):
+    # Rebuilds data_set_name's full CSV as of the latest backup at or before as_of_stamp (latest of all if None)
+    # from the baseline and delta CSVs and incremental_*.json manifests in input_directory
+    manifests = []
+    for filename in sorted(os.listdir(input_directory)):
+        if filename.startswith('incremental_') and filename.endswith('.json'):
+            with open(input_directory + '/' + filename) as manifest_file:
+                manifest = json.load(manifest_file)
+            if data_set_name in manifest['data_sets'] and (as_of_stamp is None or manifest['stamp'] <= as_of_stamp):
+                manifests.append(manifest)
+    chain = []
+    for manifest in reversed(manifests):
+        chain.insert(0, manifest)
+        if manifest['data_sets'][data_set_name]['mode'] == 'baseline':
+            break
+    if len(chain) == 0 or chain[0]['data_sets'][data_set_name]['mode'] != 'baseline':
+        raise Exception('No baseline ' + data_set_name + ' CSV found in ' + input_directory)
+
+    header, rows = read_csv(input_directory + '/' + chain[0]['data_sets'][data_set_name]['filename'])
+    for previous_manifest, manifest in zip(chain, chain[1:]):
+        entry = manifest['data_sets'][data_set_name]
+        if entry['base_stamp'] != previous_manifest['stamp']:
+            raise Exception('Backup ' + entry['base_stamp'] + ' needed to reconstruct ' + data_set_name + \
+                ' is missing from ' + input_directory)
+        rows = apply_delta_csv(header, rows, input_directory + '/' + entry['filename'])
+    write_csv(output_filename, header, rows)
+    if get_file_sha256(output_filename) != chain[-1]['data_sets'][data_set_name]['sha256']:
+        raise Exception('Reconstructed ' + output_filename + ' does not match checksum of backup ' + \
+            chain[-1]['stamp'])
+    return chain[-1]['stamp']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Reconstruct a full CSV from ccb_backup.py --incremental backups')
+    parser.add_argument('--input-directory', required=True, help='Directory holding files extracted from the ' \
+        'baseline backup and the incremental backups after it')
+    parser.add_argument('--data-set', required=True, help='Data set to reconstruct: ' + \
+        ', '.join(DEFAULT_KEY_COLUMNS))
+    parser.add_argument('--as-of', required=False, help='YYYYMMDDHHMMSS datetime stamp. Defaults to latest backup')
+    parser.add_argument('--output-filename', required=True, help='Reconstructed CSV filename')
+    args = parser.parse_args(argv)
+
+    stamp = reconstruct_csv(args.input_directory, args.data_set, args.as_of, args.output_filename)
+    print('Reconstructed ' + args.data_set + ' as of backup ' + stamp + ' into ' + args.output_filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -25,6 +25,7 @@ import sys
 import io
 import smtplib
 import errno
+import tempfile
 
 
 app = typer.Typer()
@@ -71,6 +72,9 @@ class g:
     gmail_password = None
     notification_target_email = None
     did_a_backup = None
+    store = None
+    backup_extension = '.zip'
+    resume = False
 
 
 @app.command()
@@ -83,6 +87,8 @@ def process(
             "as this backups_siteground.py utility.")] = None,
         no_email: Annotated[bool, typer.Option("--no-email", help="If specified, then notification emails are " \
             "not sent.")] = False,
+        resume: Annotated[bool, typer.Option("--resume", help="If specified, ccb_backup.py is run with --resume, " \
+            "reusing data collected by an interrupted earlier backup rather than collecting it again.")] = False,
         logging_level: Annotated[
             LoggingLevel, typer.Option(case_sensitive=False)
             ] = LoggingLevel.warning.value):
@@ -94,6 +100,7 @@ def process(
     locale.setlocale(locale.LC_ALL, '')
     g.datetime_start = datetime.datetime.now()
     g.datetime_start_string = g.datetime_start.strftime(TIMESTAMP_FORMAT)
+    g.resume = resume
 
     # Grab directoy path to backups
     if backups_dir:
@@ -177,6 +184,13 @@ def process(
     g.did_a_backup = False
     sites_data = vault_data['sites']
     site_data = sites_data['ccb_backup']
+
+    # If a store password is given, new backups go into the deduplicating backup store as snapshots rather than
+    # into separate zip files
+    if 'store_password' in site_data:
+        import ccb_backup_store
+        g.store = ccb_backup_store.open_store(g.backups_dir_path, site_data['store_password'])
+        g.backup_extension = ccb_backup_store.SNAPSHOT_EXTENSION
     backup_schedule = get_backup_schedule(site_data)
     do_backup_if_time('ccb_backup', site_data, backup_schedule)
 
@@ -223,13 +237,16 @@ def get_backup_schedule(site_data):
 def get_existing_backups(site_name):
     global g
 
+    import ccb_backup_store
+
     backup_path = g.backups_dir_path
     if not os.path.isdir(backup_path):
         return []
 
     backups_for_site = {}
-    for subfolder in [ f.path for f in os.scandir(backup_path) if f.is_dir() or ( f.is_file() and \
-        is_zip_file(f.path) ) ]:
+    for subfolder in [ f.path for f in os.scandir(backup_path) if ( f.is_dir() and \
+        f.name != ccb_backup_store.STORE_DIRECTORY_NAME ) or ( f.is_file() and ( is_zip_file(f.path) or \
+        is_snapshot_file(f.path) ) ) ]:
         subfolder_leaf = os.path.basename(subfolder)
         subfolder_leaf_wo_ext = pathlib.Path(subfolder_leaf).stem
         try:
@@ -246,6 +263,12 @@ def is_zip_file(file_name):
     return os.path.splitext(file_name)[1] == '.zip'
 
 
+def is_snapshot_file(file_name):
+    import ccb_backup_store
+
+    return os.path.splitext(file_name)[1] == ccb_backup_store.SNAPSHOT_EXTENSION
+
+
 def get_current_tracker_and_backups(site_name):
     global g
 
@@ -299,25 +322,25 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
         # Do first backup for this site
         do_new_backup = True
         for backup_interval in backup_schedule.keys():
-            backups_tracker_new[backup_interval] = [g.datetime_start_string + '.zip']
+            backups_tracker_new[backup_interval] = [g.datetime_start_string + g.backup_extension]
 
     else:
         for backup_interval in backup_schedule.keys():
             if backup_interval in backups_tracker_current:
                 # Figure if we have to do backup for any of the backup intervals
                 most_recent_backup_stamp = backups_tracker_current[backup_interval][-1]
-                most_recent_backup_datetime = datetime.datetime.strptime(strip_zip(most_recent_backup_stamp),
+                most_recent_backup_datetime = datetime.datetime.strptime(strip_extension(most_recent_backup_stamp),
                                                                      TIMESTAMP_FORMAT)
                 logging.debug(f'Most recent for {backup_interval} interval was {most_recent_backup_stamp}')
                 logging.debug(f'Time diff in secs for {backup_interval} is '\
                     f'{g.datetime_start - most_recent_backup_datetime}')
                 if g.datetime_start - most_recent_backup_datetime > BACKUP_INTERVALS[backup_interval]:
                     logging.info(f'Doing new backup for site {site_name} on {backup_interval} schedule')
-                    backups_tracker_new[backup_interval] = [g.datetime_start_string + '.zip']
+                    backups_tracker_new[backup_interval] = [g.datetime_start_string + g.backup_extension]
                     do_new_backup = True
             else:
                 # New interval was added to backup schedule and there are no historical backups for that interval
-                backups_tracker_new[backup_interval] = [g.datetime_start_string + '.zip']
+                backups_tracker_new[backup_interval] = [g.datetime_start_string + g.backup_extension]
                 do_new_backup = True
 
     # Actually do the CCB backup
@@ -364,18 +387,23 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
     (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
 
 
-def strip_zip(file_name):
-    if len(file_name) > 4:
-        if file_name[-4:] == '.zip':
-            return file_name[:-4]
+def strip_extension(file_name):
+    if is_zip_file(file_name) or is_snapshot_file(file_name):
+        return os.path.splitext(file_name)[0]
     return file_name
 
 
 def delete_backups(site_name, to_be_deleted):
     global g
+    deleted_snapshot = False
     for delete_backup in to_be_deleted:
         delete_file_path = g.backups_dir_path + '/' + delete_backup
-        if is_zip_file(delete_file_path):
+        if is_snapshot_file(delete_file_path):
+            assert(os.path.isfile(delete_file_path))
+            os.remove(delete_file_path)
+            deleted_snapshot = True
+            logging.info(f"Backup snapshot '{delete_file_path}' deleted")
+        elif is_zip_file(delete_file_path):
             assert(os.path.isfile(delete_file_path))
             os.remove(delete_file_path)
             logging.info(f"Backup zip file '{delete_file_path}' deleted")
@@ -384,6 +412,16 @@ def delete_backups(site_name, to_be_deleted):
             shutil.rmtree(delete_file_path)
             logging.info(f"Backup file directory '{delete_file_path}' deleted")
 
+    # Chunks only go away once no remaining snapshot references them
+    if deleted_snapshot:
+        if g.store is None:
+            raise Exception("'store_password' is required in vault file to delete backup snapshots")
+        import ccb_backup_store
+        snapshot_paths = [ f.path for f in os.scandir(g.backups_dir_path) if f.is_file() and \
+            is_snapshot_file(f.path) ]
+        (num_deleted, bytes_deleted) = ccb_backup_store.delete_unreferenced_chunks(g.store, snapshot_paths)
+        logging.info(f'Deleted {num_deleted} unreferenced chunks ({bytes_deleted} bytes) from backup store')
+
 
 def get_current_backups_tracker(site_name):
     backups_tracker_filename = g.backups_dir_path + '/backups_tracker.json'
@@ -404,13 +442,19 @@ def do_backup(site_name, site_data, existing_backups):
 
     logging.info(f'Starting ccb_backup (tail ./backups/messages.log for status)')
     ccb_program_dir = os.path.dirname(os.path.abspath(__file__))
+    if g.store is not None:
+        # Collect into a scratch directory whose files are then added to the backup store
+        output_dir_path = tempfile.mkdtemp(prefix='ccb_backup_runner_')
+        ccb_backup_args = ' --output-directory ' + output_dir_path
+    else:
+        ccb_backup_args = ' --output-filename ' + g.backups_dir_path + '/' + g.datetime_start_string + '.zip'
+    if g.resume:
+        ccb_backup_args += ' --resume'
     if os.path.isdir(ccb_program_dir + '/venv'):
-        ccb_backup_string = ccb_program_dir + '/venv/bin/python ' + ccb_program_dir + \
-            '/ccb_backup.py --output-filename ' + g.backups_dir_path + '/' + \
-            g.datetime_start_string + '.zip'
+        ccb_backup_string = ccb_program_dir + '/venv/bin/python ' + ccb_program_dir + '/ccb_backup.py' + \
+            ccb_backup_args
     else:
-        ccb_backup_string = ccb_program_dir + '/ccb_backup.py --output-filename ' + g.backups_dir_path + '/' + \
-            g.datetime_start_string + '.zip'
+        ccb_backup_string = ccb_program_dir + '/ccb_backup.py' + ccb_backup_args
     logging.debug(f"Executing '{ccb_backup_string}'")
     try:
         with open(ccb_program_dir + '/backups/messages.log', 'a') as message_file:
@@ -421,6 +465,17 @@ def do_backup(site_name, site_data, existing_backups):
         raise Exception(err_string)
     logging.info(f'Completed execution of ccb_backup.py to pull backup fileset out of CCB')
 
+    if g.store is not None:
+        import ccb_backup_store
+        snapshot_path = g.backups_dir_path + '/' + g.datetime_start_string + g.backup_extension
+        try:
+            stats = ccb_backup_store.write_snapshot(g.store, snapshot_path, output_dir_path)
+        finally:
+            shutil.rmtree(output_dir_path)
+        logging.info(f"Stored snapshot {snapshot_path}: {stats['files']} files, {stats['bytes']} bytes in " \
+            f"{stats['chunks']} chunks, of which {stats['new_chunks']} chunks ({stats['new_bytes']} bytes) were " \
+            f"new and took {stats['stored_bytes']} bytes to store")
+
 
 def merge_backups_trackers(site_name, backups_tracker_starting, backups_tracker_new):
     if backups_tracker_starting is None:
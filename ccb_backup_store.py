@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+#######################################################################################################################
+# Deduplicating, encrypted store for ccb_backup snapshots.  Each backed up file is split into content-defined chunks
+# (cut at CSV line ends chosen by a hash of the line, so an inserted or deleted row only changes the chunks around
+# it).  Each chunk is compressed, AES-256-GCM encrypted and stored once under a keyed hash of its content, no matter
+# how many snapshots contain it.  A snapshot is an encrypted manifest file listing the chunks of each of its files.
+# Deleting a snapshot deletes its manifest, and chunks no longer referenced by any manifest are then removed.
+#
+# ccb_backup_runner.py writes into the store.  This utility lists snapshots in a store and restores them, e.g.:
+#     ccb_backup_store.py restore --backups-dir ./backups --snapshot 20240101020000.snapshot --output-dir /tmp/x
+#######################################################################################################################
+
+import os
+import sys
+import json
+import zlib
+import hmac
+import hashlib
+import base64
+import tempfile
+import argparse
+import getpass
+import logging
+
+
+STORE_DIRECTORY_NAME = 'store'
+SNAPSHOT_EXTENSION = '.snapshot'
+STORE_VERSION = 1
+
+# Chunks are cut at the end of the first line, after MIN_CHUNK_SIZE bytes, whose hash matches CHUNK_BOUNDARY_MASK.
+# Lines longer than MAX_CHUNK_SIZE (not expected in CSVs) are cut at MAX_CHUNK_SIZE
+MIN_CHUNK_SIZE = 32 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+CHUNK_BOUNDARY_MASK = 0x1f
+
+
+def open_store(backups_dir_path, password):
+    # Returns store (dict of path and keys), creating the store on first use.  Keys are derived from password with
+    # scrypt using the salt saved in the store's config.json
+    store_path = backups_dir_path + '/' + STORE_DIRECTORY_NAME
+    config_filename = store_path + '/config.json'
+    if os.path.isfile(config_filename):
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        if config['version'] != STORE_VERSION:
+            raise Exception(f"Unsupported backup store version {config['version']} in {config_filename}")
+        store = get_store_keys(store_path, password, base64.b64decode(config['salt']))
+        try:
+            decrypt_blob(store, base64.b64decode(config['check']))
+        except ValueError:
+            raise Exception(f'Wrong password for backup store {store_path}')
+    else:
+        os.makedirs(store_path + '/chunks', exist_ok=True)
+        salt = os.urandom(16)
+        store = get_store_keys(store_path, password, salt)
+        config = {'version': STORE_VERSION, 'salt': base64.b64encode(salt).decode('ascii'),
+            'check': base64.b64encode(encrypt_blob(store, b'ccb_backup_store')).decode('ascii')}
+        write_file_atomically(config_filename, json.dumps(config).encode('utf-8'))
+        logging.info(f'Created backup store {store_path}')
+    return store
+
+
+def get_store_keys(store_path, password, salt):
+    key_material = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=2**15, r=8, p=1, maxmem=64 * 1024 * 1024,
+        dklen=64)
+    return {'path': store_path, 'encryption_key': key_material[:32], 'id_key': key_material[32:]}
+
+
+def write_snapshot(store, snapshot_filename, source_dir_path):
+    # Stores every file in source_dir_path, and writes the snapshot's manifest to snapshot_filename.  Returns stats
+    stats = {'files': 0, 'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0, 'stored_bytes': 0}
+    manifest = {'version': STORE_VERSION, 'files': []}
+    for file_name in sorted(os.listdir(source_dir_path)):
+        file_path = source_dir_path + '/' + file_name
+        if not os.path.isfile(file_path):
+            continue
+        file_sha256 = hashlib.sha256()
+        chunk_ids = []
+        with open(file_path, 'rb') as input_file:
+            for chunk in get_chunks(input_file):
+                file_sha256.update(chunk)
+                chunk_id = hmac.new(store['id_key'], chunk, hashlib.sha256).hexdigest()
+                chunk_ids.append(chunk_id)
+                stats['chunks'] += 1
+                stats['bytes'] += len(chunk)
+                chunk_filename = get_chunk_filename(store, chunk_id)
+                if not os.path.isfile(chunk_filename):
+                    blob = encrypt_blob(store, zlib.compress(chunk, 6))
+                    os.makedirs(os.path.dirname(chunk_filename), exist_ok=True)
+                    write_file_atomically(chunk_filename, blob)
+                    stats['new_chunks'] += 1
+                    stats['new_bytes'] += len(chunk)
+                    stats['stored_bytes'] += len(blob)
+        manifest['files'].append({'name': file_name, 'size': os.path.getsize(file_path),
+            'sha256': file_sha256.hexdigest(), 'chunks': chunk_ids})
+        stats['files'] += 1
+    # Manifest is written last, so a snapshot only exists once all of its chunks do
+    write_file_atomically(snapshot_filename, encrypt_blob(store, zlib.compress(json.dumps(manifest).encode('utf-8'))))
+    return stats
+
+
+def read_manifest(store, snapshot_filename):
+    with open(snapshot_filename, 'rb') as snapshot_file:
+        return json.loads(zlib.decompress(decrypt_blob(store, snapshot_file.read())).decode('utf-8'))
+
+
+def restore_snapshot(store, snapshot_filename, output_dir_path):
+    # Writes every file in the snapshot into output_dir_path, checking each against its SHA-256
+    manifest = read_manifest(store, snapshot_filename)
+    os.makedirs(output_dir_path, exist_ok=True)
+    for file_entry in manifest['files']:
+        output_filename = output_dir_path + '/' + os.path.basename(file_entry['name'])
+        file_sha256 = hashlib.sha256()
+        with open(output_filename, 'wb') as output_file:
+            for chunk_id in file_entry['chunks']:
+                with open(get_chunk_filename(store, chunk_id), 'rb') as chunk_file:
+                    chunk = zlib.decompress(decrypt_blob(store, chunk_file.read()))
+                file_sha256.update(chunk)
+                output_file.write(chunk)
+        if file_sha256.hexdigest() != file_entry['sha256']:
+            raise Exception(f'Restored file {output_filename} does not match its checksum in {snapshot_filename}')
+        logging.info(f"Restored {output_filename} ({file_entry['size']} bytes)")
+    return manifest
+
+
+def delete_unreferenced_chunks(store, snapshot_filenames):
+    # Deletes chunks not referenced by any of snapshot_filenames (which must be every snapshot in the store).
+    # Returns (number of chunks, bytes) deleted
+    referenced_chunk_ids = set()
+    for snapshot_filename in snapshot_filenames:
+        for file_entry in read_manifest(store, snapshot_filename)['files']:
+            referenced_chunk_ids.update(file_entry['chunks'])
+    num_deleted = 0
+    bytes_deleted = 0
+    for dir_path, dir_names, file_names in os.walk(store['path'] + '/chunks'):
+        for file_name in file_names:
+            if file_name not in referenced_chunk_ids:
+                bytes_deleted += os.path.getsize(dir_path + '/' + file_name)
+                os.remove(dir_path + '/' + file_name)
+                num_deleted += 1
+    return (num_deleted, bytes_deleted)
+
+
+def get_chunks(input_file):
+    chunk = bytearray()
+    for line in input_file:
+        while len(chunk) + len(line) > MAX_CHUNK_SIZE:
+            split_at = MAX_CHUNK_SIZE - len(chunk)
+            chunk += line[:split_at]
+            line = line[split_at:]
+            yield bytes(chunk)
+            chunk = bytearray()
+        chunk += line
+        if len(chunk) >= MIN_CHUNK_SIZE and zlib.crc32(line) & CHUNK_BOUNDARY_MASK == 0:
+            yield bytes(chunk)
+            chunk = bytearray()
+    if len(chunk) > 0:
+        yield bytes(chunk)
+
+
+def get_chunk_filename(store, chunk_id):
+    return store['path'] + '/chunks/' + chunk_id[:2] + '/' + chunk_id
+
+
+def encrypt_blob(store, data):
+    # pycryptodomex is only needed once a store is actually used
+    from Cryptodome.Cipher import AES
+
+    nonce = os.urandom(12)
+    cipher = AES.new(store['encryption_key'], AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + tag + ciphertext
+
+
+def decrypt_blob(store, blob):
+    # Raises ValueError if blob was not encrypted with this store's key or has been altered
+    from Cryptodome.Cipher import AES
+
+    cipher = AES.new(store['encryption_key'], AES.MODE_GCM, nonce=blob[:12])
+    return cipher.decrypt_and_verify(blob[28:], blob[12:28])
+
+
+def write_file_atomically(filename, data):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename), delete=False) as temp:
+        temp.write(data)
+    os.replace(temp.name, filename)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='List or restore snapshots in a ccb_backup_runner.py backup store')
+    parser.add_argument('command', choices=['list', 'restore'])
+    parser.add_argument('--backups-dir', required=True, help='Backups directory holding the store and snapshots')
+    parser.add_argument('--snapshot', required=False, help='Snapshot to restore, e.g. 20240101020000.snapshot')
+    parser.add_argument('--output-dir', required=False, help='Directory to restore the snapshot\'s files into')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s\t%(message)s')
+
+    store = open_store(args.backups_dir, getpass.getpass('Password for backup store: '))
+    if args.command == 'list':
+        for file_name in sorted(os.listdir(args.backups_dir)):
+            if file_name.endswith(SNAPSHOT_EXTENSION):
+                manifest = read_manifest(store, args.backups_dir + '/' + file_name)
+                total_size = sum([x['size'] for x in manifest['files']])
+                print(f"{file_name}\t{len(manifest['files'])} files\t{total_size} bytes")
+    else:
+        if args.snapshot is None or args.output_dir is None:
+            parser.error('restore requires --snapshot and --output-dir')
+        restore_snapshot(store, args.backups_dir + '/' + os.path.basename(args.snapshot), args.output_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
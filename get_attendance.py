@@ -10,6 +10,8 @@ import datetime
 import time
 import csv
 import tempfile
+import concurrent.futures
+import threading
 from util import util
 from xml.etree import ElementTree
 from collections import defaultdict
@@ -18,9 +20,11 @@ import json
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
     args = None
-    ccb_subdomain = None
-    ccb_api_username = None
-    ccb_api_password = None
+    attendance_cache = None
+    attendance_cache_lock = threading.Lock()
+    attendance_cache_stale_days = None
+    attendance_cache_hits = 0
+    checkpoint_journal = None
 
 
 def main(argv):
@@ -43,28 +47,94 @@ def main(argv):
         'attendance data note just for this year but across all years')
     parser.add_argument('--start-date', required=False, help='Date in format YYYYMMDD on which to start ' + \
                         'worship attendance backups. If specified, overrides --all-time.')
+    parser.add_argument('--max-concurrent-requests', required=False, type=int, default=4, help='Maximum number ' + \
+        'of attendance_profile REST API calls in flight at once. Defaults to 4')
+    parser.add_argument('--no-attendance-cache', action='store_true', help='If specified, the attendance ' + \
+        'occurrence cache configured in ccb_backup.ini is neither read nor updated and every occurrence is ' + \
+        'retrieved from CCB REST API')
+    parser.add_argument('--resume', action='store_true', help='If specified, attendance of event occurrences ' + \
+        'retrieved by an interrupted earlier run (see [checkpoints] in ccb_backup.ini) is reused rather than ' + \
+        'retrieved again')
     g.args = parser.parse_args()
 
     message_level = util.get_ini_setting('logging', 'level')
     util.set_logger(message_level, g.args.message_output_filename, os.path.basename(__file__))
 
-    g.ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
+    if g.args.max_concurrent_requests < 1:
+        logging.error('Specified --max-concurrent-requests value must be a positive integer. Aborting!')
+        util.sys_exit(1)
+
+    ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
     ccb_app_username = util.get_ini_setting('ccb', 'app_username', False)
     ccb_app_password = util.get_ini_setting('ccb', 'app_password', False)
-    g.ccb_api_username = util.get_ini_setting('ccb', 'api_username', False)
-    g.ccb_api_password = util.get_ini_setting('ccb', 'api_password', False)
-
-    datetime_now = datetime.datetime.now()
-    curr_date_str = datetime_now.strftime('%m/%d/%Y')
+    ccb_api_username = util.get_ini_setting('ccb', 'api_username', False)
+    ccb_api_password = util.get_ini_setting('ccb', 'api_password', False)
 
     if g.args.start_date is not None:
-        start_date_str = g.args.start_date
-        start_date = datetime.datetime.strptime(start_date_str, '%Y%m%d')
+        start_date = datetime.datetime.strptime(g.args.start_date, '%Y%m%d')
         start_date_str = start_date.strftime('%m/%d/%Y')
-    elif g.args.all_time:
-        start_date_str = '01/01/1990'
     else:
-        start_date_str = '01/01/' + datetime_now.strftime('%Y')
+        start_date_str = get_start_date_str(g.args.all_time)
+
+    # Set events and attendance filenames and test validity
+    if g.args.output_events_filename is not None:
+        output_events_filename = g.args.output_events_filename
+    else:
+        output_events_filename = './tmp/events_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+    util.test_write(output_events_filename)
+    if g.args.output_attendance_filename is not None:
+        output_attendance_filename = g.args.output_attendance_filename
+    else:
+        output_attendance_filename = './tmp/attendance_' + \
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+    util.test_write(output_attendance_filename)
+
+    if g.args.input_events_filename is not None:
+        collect_attendance(None, ccb_subdomain, ccb_api_username, ccb_api_password, output_events_filename,
+            output_attendance_filename, start_date_str, g.args.input_events_filename, g.args.keep_temp_file,
+            g.args.max_concurrent_requests, not g.args.no_attendance_cache, g.args.resume)
+    else:
+        # Create UI user session to pull list of calendared events
+        with util.get_ccb_ui_session(ccb_subdomain, ccb_app_username, ccb_app_password) as http_session:
+            collect_attendance(http_session, ccb_subdomain, ccb_api_username, ccb_api_password,
+                output_events_filename, output_attendance_filename, start_date_str, None, g.args.keep_temp_file,
+                g.args.max_concurrent_requests, not g.args.no_attendance_cache, g.args.resume)
+    logging.info(util.format_rest_api_metrics(util.get_rest_api_metrics()))
+
+    util.sys_exit(0)
+
+
+def get_start_date_str(all_time):
+    if all_time:
+        return '01/01/1990'
+    else:
+        return '01/01/' + datetime.datetime.now().strftime('%Y')
+
+
+def collect_attendance(http_session, ccb_subdomain, ccb_api_username, ccb_api_password, output_events_filename,
+    output_attendance_filename, start_date_str, input_events_filename=None, keep_temp_file=False,
+    max_concurrent_requests=4, use_attendance_cache=True, resume=False):
+    global g
+
+    # Attendance for past occurrences rarely changes, so keep it in a local cache and only refetch occurrences
+    # within the staleness window
+    attendance_cache_filename = None
+    if use_attendance_cache:
+        attendance_cache_filename = util.get_ini_setting('attendance_cache', 'filename')
+    if attendance_cache_filename is not None:
+        if not os.path.isabs(attendance_cache_filename):
+            attendance_cache_filename = os.path.dirname(os.path.abspath(__file__)) + '/' + attendance_cache_filename
+        g.attendance_cache_stale_days = util.get_ini_setting_int('attendance_cache', 'stale_days', 30, 0)
+        attendance_cache_max_entries = util.get_ini_setting_int('attendance_cache', 'max_entries', 100000, 0)
+        g.attendance_cache = load_attendance_cache(attendance_cache_filename)
+    else:
+        g.attendance_cache = None
+    g.attendance_cache_hits = 0
+
+    # Each occurrence's attendance is checkpointed as it is retrieved, so an interrupted all-time run can be resumed
+    g.checkpoint_journal = util.open_checkpoint_journal('get_attendance', resume, {'start_date': start_date_str})
+
+    curr_date_str = datetime.datetime.now().strftime('%m/%d/%Y')
 
     logging.info('Gathering attendance data between ' + start_date_str + ' and ' + curr_date_str)
 
@@ -85,22 +155,9 @@ def main(argv):
         'output': 'export'
     }
 
-    # Set events and attendance filenames and test validity
-    if g.args.output_events_filename is not None:
-        output_events_filename = g.args.output_events_filename
-    else:
-        output_events_filename = './tmp/events_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
-    util.test_write(output_events_filename)
-    if g.args.output_attendance_filename is not None:
-        output_attendance_filename = g.args.output_attendance_filename
-    else:
-        output_attendance_filename = './tmp/attendance_' + \
-            datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
-    util.test_write(output_attendance_filename)
-
-    input_filename = util.ccb_rest_xml_to_temp_file(g.ccb_subdomain, 'event_profiles', g.ccb_api_username,
-        g.ccb_api_password)
-    if input_filename is None:
+    events_xml_filename = util.ccb_rest_xml_to_temp_file(ccb_subdomain, 'event_profiles', ccb_api_username,
+        ccb_api_password)
+    if events_xml_filename is None:
         logging.error('CCB REST API call for event_profiles failed. Aborting!')
         util.sys_exit(1)
 
@@ -118,146 +175,236 @@ def main(argv):
         'public_calendar_listed'
     ] # Also collect event_id, group_id, organizer_id
 
-    path = []
+    # Records to peel out of the XML. An event's group and organizer come before the end of the event
+    record_paths = util.compile_xml_record_paths({
+        'event': ('ccb_api/response/events/event', list_event_props),
+        'group': ('ccb_api/response/events/event/group', []),
+        'organizer': ('ccb_api/response/events/event/organizer', [])
+    })
+
     dict_list_event_names = defaultdict(list)
     with open(output_events_filename, 'w', newline='', encoding='utf-8') as csv_output_events_file:
         csv_writer_events = csv.writer(csv_output_events_file)
         csv_writer_events.writerow(['event_id'] + list_event_props + ['group_id', 'organizer_id']) # Write header row
-        for event, elem in ElementTree.iterparse(input_filename, events=('start', 'end')):
-            if event == 'start':
-                path.append(elem.tag)
-                full_path = '/'.join(path)
-                if full_path == 'ccb_api/response/events/event':
-                    current_event_id = elem.attrib['id']
-            elif event == 'end':
-                if full_path == 'ccb_api/response/events/event':
-                    # Emit 'events' row
-                    props_csv = util.get_elem_id_and_props(elem, list_event_props)
-                    event_id = props_csv[0] # get_elem_id_and_props() puts 'id' prop at index 0
-                    name = props_csv[1].decode('utf-8') # Cheating here...we know 'name' prop is index 1
-                    dict_list_event_names[name].append(event_id)
-                    props_csv.append(current_group_id)
-                    props_csv.append(current_organizer_id)
-
-                    # A bit of a hack to decode bytes to strings for all elements on the CSV row
-                    new_list = []
-                    for x in props_csv:
-                        if isinstance(x, bytes):
-                            x = x.decode('utf-8')
-                        new_list.append(x)
-
-                    csv_writer_events.writerow(new_list)
-                    elem.clear() # Throw away 'event' node from memory when done processing it
-                elif full_path == 'ccb_api/response/events/event/group':
-                    current_group_id = elem.attrib['id']
-                elif full_path == 'ccb_api/response/events/event/organizer':
-                    current_organizer_id = elem.attrib['id']
-                path.pop()
-                full_path = '/'.join(path)
+        for record_name, record in util.iter_xml_records(events_xml_filename, record_paths):
+            if record_name == 'event':
+                # Emit 'events' row
+                props_csv = util.get_record_id_and_props(record, list_event_props)
+                event_id = props_csv[0] # get_record_id_and_props() puts 'id' prop at index 0
+                name = props_csv[1] # Cheating here...we know 'name' prop is index 1
+                dict_list_event_names[name].append(event_id)
+                props_csv.append(current_group_id)
+                props_csv.append(current_organizer_id)
+                csv_writer_events.writerow(props_csv)
+            elif record_name == 'group':
+                current_group_id = record['attrib']['id']
+            elif record_name == 'organizer':
+                current_organizer_id = record['attrib']['id']
+    os.remove(events_xml_filename)
 
-    if g.args.input_events_filename is not None:
+    if input_events_filename is not None:
         # Pull calendared events CSV from file
-        input_filename = g.args.input_events_filename
+        input_filename = input_events_filename
     else:
-        # Create UI user session to pull list of calendared events
-        logging.info('Logging in to UI session')
-        with requests.Session() as http_session:
-            util.login(http_session, g.ccb_subdomain, ccb_app_username, ccb_app_password)
-
-            # Get list of all scheduled events
-            logging.info('Retrieving list of all scheduled events.  This might take a couple minutes!')
-            event_list_response = http_session.post('https://' + g.ccb_subdomain + '.ccbchurch.com/report.php',
-                data=event_list_request)
-            event_list_response.encoding = 'utf-8-sig'
-            event_list_succeeded = False
-            if event_list_response.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, mode='w') as temp:
-                    input_filename = temp.name
-                    first_chunk = True
-                    for chunk in event_list_response.iter_content(chunk_size=1024, decode_unicode=True):
-                        if chunk: # filter out keep-alive new chunks
-                            if first_chunk:
-                                if chunk[:13] != '"Event Name",':
-                                    logging.error('Mis-formed calendared events CSV returned. Aborting!')
-                                    util.sys_exit(1)
-                                first_chunk = False
-                            temp.write(chunk)
-                    temp.flush()
+        # Get list of all scheduled events
+        logging.info('Retrieving list of all scheduled events.  This might take a couple minutes!')
+        event_list_response = util.ccb_ui_post(http_session, ccb_subdomain, 'report.php',
+            data=event_list_request)
+        event_list_response.encoding = 'utf-8-sig'
+        event_list_succeeded = False
+        if event_list_response.status_code == 200:
+            with tempfile.NamedTemporaryFile(delete=False, mode='w') as temp:
+                input_filename = temp.name
+                first_chunk = True
+                for chunk in event_list_response.iter_content(chunk_size=1024, decode_unicode=True):
+                    if chunk: # filter out keep-alive new chunks
+                        if first_chunk:
+                            if chunk[:13] != '"Event Name",':
+                                logging.error('Mis-formed calendared events CSV returned. Aborting!')
+                                util.sys_exit(1)
+                            first_chunk = False
+                        temp.write(chunk)
+                temp.flush()
 
+    # Gather the worship service occurrences to retrieve attendance for, in calendared events CSV order
+    occurrences = []
     with open(input_filename, 'r') as csvfile:
         csv_reader = csv.reader(csvfile)
-        with open(output_attendance_filename, 'w', newline='', encoding='utf-8') as csv_output_file:
-            csv_writer = csv.writer(csv_output_file)
-            csv_writer.writerow(['event_id', 'event_occurrence', 'individual_id', 'count'])
-            header_row = True
-            for row in csv_reader:
-                if header_row:
-                    header_row = False
-                    output_csv_header = row
-                    event_name_column_index = row.index('Event Name')
-                    attendance_column_index = row.index('Actual Attendance')
-                    date_column_index = row.index('Date')
-                    start_time_column_index = row.index('Start Time')
-                    group_name_column_index = row.index('Group Name')
-                else:
-                    # Retrieve attendees for 'Worship Service' events which have non-zero number of attendees
-                    # if re.search('worship service', row[event_name_column_index], re.IGNORECASE):
-                    if row[group_name_column_index] == 'Worship Services':
-                        if row[attendance_column_index] != '0':
-                            if row[event_name_column_index] in dict_list_event_names:
-                                retrieve_attendance(csv_writer, dict_list_event_names[row[event_name_column_index]],
-                                    row[date_column_index], row[start_time_column_index],
-                                    row[attendance_column_index])
-                            else:
-                                logging.warning("Unrecognized event name '" + row[event_name_column_index] + "'")
+        header_row = True
+        for row in csv_reader:
+            if header_row:
+                header_row = False
+                output_csv_header = row
+                event_name_column_index = row.index('Event Name')
+                attendance_column_index = row.index('Actual Attendance')
+                date_column_index = row.index('Date')
+                start_time_column_index = row.index('Start Time')
+                group_name_column_index = row.index('Group Name')
+            else:
+                # Retrieve attendees for 'Worship Service' events which have non-zero number of attendees
+                # if re.search('worship service', row[event_name_column_index], re.IGNORECASE):
+                if row[group_name_column_index] == 'Worship Services':
+                    if row[attendance_column_index] != '0':
+                        if row[event_name_column_index] in dict_list_event_names:
+                            occurrences.append([dict_list_event_names[row[event_name_column_index]],
+                                row[date_column_index], row[start_time_column_index]])
+                        else:
+                            logging.warning("Unrecognized event name '" + row[event_name_column_index] + "'")
+
+    # Retrieve occurrences concurrently, but write their rows in the order the occurrences were listed so output
+    # is the same from run to run
+    logging.info('Retrieving attendance for ' + str(len(occurrences)) + ' occurrences with up to ' +
+        str(max_concurrent_requests) + ' concurrent requests')
+    with open(output_attendance_filename, 'w', newline='', encoding='utf-8') as csv_output_file:
+        csv_writer = csv.writer(csv_output_file)
+        csv_writer.writerow(['event_id', 'event_occurrence', 'individual_id', 'count'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_requests,
+            thread_name_prefix='get_attendance') as executor:
+            try:
+                for attendance_rows in executor.map(lambda x: retrieve_checkpointed_attendance(ccb_subdomain,
+                    ccb_api_username, ccb_api_password, *x), occurrences):
+                    csv_writer.writerows(attendance_rows)
+            except SystemExit:
+                # A retrieval aborted, so don't wait on the remaining queued occurrences before exiting
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    if g.attendance_cache is not None:
+        logging.info('Attendance cache supplied ' + str(g.attendance_cache_hits) + ' event occurrence lookups')
+        save_attendance_cache(attendance_cache_filename, attendance_cache_max_entries)
 
     # If caller didn't specify input filename, then delete the temporary file we retrieved into
-    if g.args.input_events_filename is None:
-        if g.args.keep_temp_file:
+    if input_events_filename is None:
+        if keep_temp_file:
             logging.info('Temporary downloaded calendared events CSV retained in file: ' + input_filename)
         else:
             os.remove(input_filename)
 
+    util.remove_checkpoint_journal(g.checkpoint_journal)
+
     logging.info('Event profile data written to ' + output_events_filename)
     logging.info('Attendance data written to ' + output_attendance_filename)
 
-    util.sys_exit(0)
 
+def retrieve_checkpointed_attendance(ccb_subdomain, ccb_api_username, ccb_api_password, event_id_list, date,
+    start_time):
+    global g
+
+    checkpoint_unit = str(date) + ' ' + str(start_time) + ' ' + ','.join(event_id_list)
+    checkpoint = util.get_checkpoint(g.checkpoint_journal, checkpoint_unit)
+    if checkpoint is not None:
+        return checkpoint['rows']
+    attendance_rows = retrieve_attendance(ccb_subdomain, ccb_api_username, ccb_api_password, event_id_list, date,
+        start_time)
+    util.add_checkpoint(g.checkpoint_journal, checkpoint_unit, {'rows': attendance_rows})
+    return attendance_rows
 
-def retrieve_attendance(csv_writer, event_id_list, date, start_time, attendance):
+
+def retrieve_attendance(ccb_subdomain, ccb_api_username, ccb_api_password, event_id_list, date, start_time):
     global g
-    
+
     for event_id in reversed(event_id_list):
         if start_time == 'ALL DAY':
             start_time = '12:00 AM'
         time_object = time.strptime(str(date) + ' ' + str(start_time), '%Y-%m-%d %I:%M %p')
         occurrence_datetime_string = time.strftime('%Y-%m-%d+%H:%M:00', time_object)
-        ccb_rest_service_string = 'attendance_profile&id=' + str(event_id) + '&occurrence=' + \
-            occurrence_datetime_string
-        xml_temp_file = util.ccb_rest_xml_to_temp_file(g.ccb_subdomain, ccb_rest_service_string, g.ccb_api_username,
-            g.ccb_api_password)
-        if xml_temp_file is not None:
-            valid_attendance_data = process_attendance_xml_file(csv_writer, xml_temp_file, event_id,
-                occurrence_datetime_string)
+        cache_hit, attendance_rows = get_cached_attendance(event_id, occurrence_datetime_string, time_object)
+        if not cache_hit:
+            ccb_rest_service_string = 'attendance_profile&id=' + str(event_id) + '&occurrence=' + \
+                occurrence_datetime_string
+            xml_temp_file = util.ccb_rest_xml_to_temp_file(ccb_subdomain, ccb_rest_service_string,
+                ccb_api_username, ccb_api_password)
+            if xml_temp_file is None:
+                continue
+            attendance_rows = process_attendance_xml_file(xml_temp_file, event_id, occurrence_datetime_string)
             os.remove(xml_temp_file)
-            if valid_attendance_data:
-                break
+            put_cached_attendance(event_id, occurrence_datetime_string, attendance_rows)
+        if attendance_rows is not None:
+            return attendance_rows
+    return []
+
+
+def load_attendance_cache(cache_filename):
+    if not os.path.isfile(cache_filename):
+        logging.info('No attendance cache file ' + cache_filename + ' yet. Starting an empty one')
+        return {}
+    try:
+        with open(cache_filename, 'r', encoding='utf-8') as cache_file:
+            attendance_cache = json.load(cache_file)
+    except ValueError:
+        logging.warning('Attendance cache file ' + cache_filename + ' is corrupt. Starting an empty one')
+        return {}
+    logging.info('Loaded ' + str(len(attendance_cache)) + ' event occurrences from attendance cache ' +
+        cache_filename)
+    return attendance_cache
+
+
+def save_attendance_cache(cache_filename, max_entries):
+    global g
+
+    # Evict least recently used occurrences beyond the size cap (0 means no cap)
+    if max_entries > 0 and len(g.attendance_cache) > max_entries:
+        lru_keys = sorted(g.attendance_cache, key=lambda x: g.attendance_cache[x]['last_used'])
+        for cache_key in lru_keys[:len(g.attendance_cache) - max_entries]:
+            del g.attendance_cache[cache_key]
+        logging.info('Evicted ' + str(len(lru_keys) - max_entries) + ' least recently used event occurrences ' +
+            'from attendance cache')
+
+    # Write to temp file and then rename, so an interrupted run never leaves a truncated cache behind
+    cache_directory = os.path.dirname(os.path.abspath(cache_filename))
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', dir=cache_directory, delete=False) as temp:
+        json.dump(g.attendance_cache, temp)
+    os.replace(temp.name, cache_filename)
+    logging.info('Saved ' + str(len(g.attendance_cache)) + ' event occurrences to attendance cache ' +
+        cache_filename)
+
+
+def get_cached_attendance(event_id, occurrence_datetime_string, occurrence_time_object):
+    global g
+
+    if g.attendance_cache is None:
+        return False, None
+    occurrence_datetime = datetime.datetime.fromtimestamp(time.mktime(occurrence_time_object))
+    if datetime.datetime.now() - occurrence_datetime < datetime.timedelta(days=g.attendance_cache_stale_days):
+        return False, None
+    cache_key = str(event_id) + '|' + occurrence_datetime_string
+    with g.attendance_cache_lock:
+        if cache_key not in g.attendance_cache:
+            return False, None
+        cache_entry = g.attendance_cache[cache_key]
+        cache_entry['last_used'] = time.time()
+        g.attendance_cache_hits += 1
+    # None rows mean CCB had no attendance for this event id at this occurrence
+    return True, cache_entry['rows']
+
+
+def put_cached_attendance(event_id, occurrence_datetime_string, attendance_rows):
+    global g
+
+    if g.attendance_cache is None:
+        return
+    cache_key = str(event_id) + '|' + occurrence_datetime_string
+    with g.attendance_cache_lock:
+        g.attendance_cache[cache_key] = {'rows': attendance_rows, 'last_used': time.time()}
 
 
-def process_attendance_xml_file(csv_writer, input_xml_filename, event_id, event_occurrence_datetime):
+def process_attendance_xml_file(input_xml_filename, event_id, event_occurrence_datetime):
     xml_tree = ElementTree.parse(input_xml_filename)
     xml_root = xml_tree.getroot()
     for message in xml_root.findall('./messages/message'):
         logging.info(message.text)
-        return False
+        return None
+    attendance_rows = []
     for attendee in xml_root.findall('./response/events/event/attendees/attendee'):
-        csv_writer.writerow([event_id, event_occurrence_datetime, attendee.attrib['id'], 1])
+        attendance_rows.append([event_id, event_occurrence_datetime, attendee.attrib['id'], 1])
     for headcount in xml_root.findall('./response/events/event/head_count'):
         headcount_number = int(headcount.text)
         if headcount_number > 0:
-            csv_writer.writerow([event_id, event_occurrence_datetime, '', headcount_number])
+            attendance_rows.append([event_id, event_occurrence_datetime, '', headcount_number])
             break
-    return True
+    return attendance_rows
 
 
 if __name__ == "__main__":
@@ -9,7 +9,6 @@ import logging
 import datetime
 import csv
 from util import util
-from xml.etree import ElementTree
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
@@ -53,10 +52,20 @@ def main(argv):
             datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
     util.test_write(output_participants_filename)
 
-    if g.args.input_filename is not None:
+    collect_groups(ccb_subdomain, ccb_api_username, ccb_api_password, output_groups_filename,
+        output_participants_filename, g.args.input_filename, g.args.keep_temp_file)
+    logging.info(util.format_rest_api_metrics(util.get_rest_api_metrics()))
+
+    util.sys_exit(0)
+
+
+def collect_groups(ccb_subdomain, ccb_api_username, ccb_api_password, output_groups_filename,
+    output_participants_filename, input_filename=None, keep_temp_file=False):
+    if input_filename is not None:
         # Pull groups XML from input file specified by user
-        input_filename = g.args.input_filename
+        retrieved_input_file = False
     else:
+        retrieved_input_file = True
         input_filename = util.ccb_rest_xml_to_temp_file(ccb_subdomain, 'group_profiles', ccb_api_username,
             ccb_api_password)
         if input_filename is None:
@@ -83,15 +92,16 @@ def main(argv):
         'inactive'
     ]
 
-    participant_nodes = [
-        'ccb_api/response/groups/group/director', 'ccb_api/response/groups/group/coach',
-        'ccb_api/response/groups/group/main_leader', 'ccb_api/response/groups/group/leaders/leader',
-        'ccb_api/response/groups/group/participants/participant'
-    ]
+    # Records to peel out of the XML
+    record_paths = util.compile_xml_record_paths({
+        'group': ('ccb_api/response/groups/group', list_group_props),
+        'director': ('ccb_api/response/groups/group/director', []),
+        'coach': ('ccb_api/response/groups/group/coach', []),
+        'main_leader': ('ccb_api/response/groups/group/main_leader', []),
+        'leader': ('ccb_api/response/groups/group/leaders/leader', []),
+        'participant': ('ccb_api/response/groups/group/participants/participant', [])
+    })
 
-    path = []
-    dict_path_ids = {}
-    group_id = None
     logging.info('Creating groups and group participants output files.')
     with open(output_groups_filename, 'w', newline='', encoding='utf-8') as csv_output_groups_file:
         csv_writer_groups = csv.writer(csv_output_groups_file)
@@ -99,37 +109,26 @@ def main(argv):
         with open(output_participants_filename, 'w', newline='', encoding='utf-8') as csv_output_participants_file:
             csv_writer_participants = csv.writer(csv_output_participants_file)
             csv_writer_participants.writerow(['group_id', 'participant_id', 'participant_type'])
-            for event, elem in ElementTree.iterparse(input_filename, events=('start', 'end')):
-                if event == 'start':
-                    path.append(elem.tag)
-                    full_path = '/'.join(path)
-                    if full_path == 'ccb_api/response/groups/group':
-                        current_group_id = elem.attrib['id']
-                elif event == 'end':
-                    if full_path == 'ccb_api/response/groups/group':
-                        # Emit 'groups' row
-                        props_csv = util.get_elem_id_and_props(elem, list_group_props)
-                        csv_writer_groups.writerow(props_csv)
-                        elem.clear() # Throw away 'group' node from memory when done processing it
-                    elif full_path in participant_nodes:
-                        # Emit 'group_participants' row
-                        props_csv = [ current_group_id, elem.attrib['id'], elem.tag ]
-                        csv_writer_participants.writerow(props_csv)
-                    path.pop()
-                    full_path = '/'.join(path)
+            for record_name, record in util.iter_xml_records(input_filename, record_paths):
+                if record_name == 'group':
+                    # Emit 'groups' row
+                    props_csv = util.get_record_id_and_props(record, list_group_props)
+                    csv_writer_groups.writerow(props_csv)
+                else:
+                    # Emit 'group_participants' row
+                    props_csv = [ record['parents']['group']['id'], record['attrib']['id'], record['tag'] ]
+                    csv_writer_participants.writerow(props_csv)
 
     logging.info('Groups written to ' + output_groups_filename)
     logging.info('Group Participants written to ' + output_participants_filename)
 
     # If caller didn't specify input filename, then delete the temporary file we retrieved into
-    if g.args.input_filename is None:
-        if g.args.keep_temp_file:
+    if retrieved_input_file:
+        if keep_temp_file:
             logging.info('Temporary downloaded XML retained in file: ' + input_filename)
         else:
             os.remove(input_filename)
 
-    util.sys_exit(0)
-
 
 if __name__ == "__main__":
     main(sys.argv[1:])
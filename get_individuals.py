@@ -6,7 +6,6 @@ import sys
 import json
 import datetime
 import csv
-import io
 import logging
 import argparse
 import os
@@ -35,8 +34,20 @@ def main(argv):
     ccb_app_password = util.get_ini_setting('ccb', 'app_password', False)
     ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
 
-    curr_date_str = datetime.datetime.now().strftime('%m/%d/%Y')
+    # Pull back complete CSV containing detail info for every individual in CCB database
+    if g.args.output_filename is not None:
+        output_filename = g.args.output_filename
+    else:
+        output_filename = './tmp/individuals_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+    util.test_write(output_filename)
 
+    with util.get_ccb_ui_session(ccb_subdomain, ccb_app_username, ccb_app_password) as http_session:
+        collect_individuals(http_session, ccb_subdomain, output_filename)
+
+    util.sys_exit(0)
+
+
+def collect_individuals(http_session, ccb_subdomain, output_filename):
     individual_detail_report_info = {
         'id':'',
         'type': 'export_individuals_change_log',
@@ -50,37 +61,18 @@ def main(argv):
         'output': 'export'
     }
 
-    with requests.Session() as http_session:
-        util.login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
-
-        # Pull back complete CSV containing detail info for every individual in CCB database
-        output_csv_header = None
-        if g.args.output_filename is not None:
-            output_filename = g.args.output_filename
-        else:
-            output_filename = './tmp/individuals_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
-        util.test_write(output_filename)
-        with open(output_filename, 'w') as csv_output_file:
-            csv_writer = csv.writer(csv_output_file)
-            logging.info('Note that it takes CCB a minute or two to pull retrieve all individual information')
-            individual_detail_response = http_session.post('https://' + ccb_subdomain + '.ccbchurch.com/report.php',
-                data=individual_detail_request)
-            individual_detail_response.encoding = 'utf-8-sig'
-            individual_detail_succeeded = False
-            if individual_detail_response.status_code == 200 and \
-                individual_detail_response.text[:9] == '"Ind ID",':
-                individual_detail_succeeded = True
-                csv_reader = csv.reader(io.StringIO(individual_detail_response.text))
-                for row in csv_reader:
-                    csv_writer.writerow(row)
-            if not individual_detail_succeeded:
+    # Rows are written out as they arrive rather than holding the whole export (which can be large) in memory
+    with open(output_filename, 'w') as csv_output_file:
+        csv_writer = csv.writer(csv_output_file)
+        logging.info('Note that it takes CCB a minute or two to pull retrieve all individual information')
+        with util.ccb_ui_post(http_session, ccb_subdomain, 'report.php', data=individual_detail_request,
+            stream=True) as individual_detail_response:
+            individual_detail_rows = util.get_report_csv_rows(individual_detail_response, ['Ind ID'])
+            if individual_detail_rows is None:
                 logging.error('Individual Detail retrieval failed')
                 util.sys_exit(1)
-            else:
-                logging.info('Individual info successfully retrieved into file ' + output_filename)
-
-    util.sys_exit(0)
-
+            csv_writer.writerows(individual_detail_rows)
+        logging.info('Individual info successfully retrieved into file ' + output_filename)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
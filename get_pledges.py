@@ -9,8 +9,11 @@ import csv
 import logging
 import argparse
 import os
+import time
+import concurrent.futures
+import tempfile
+import contextlib
 from util import util
-import io
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
@@ -26,15 +29,37 @@ def main(argv):
         help='Output CSV filename. Defaults to ./tmp/pledges_[datetime_stamp].csv')
     parser.add_argument('--message-output-filename', required=False, help='Filename of message output file. If ' +
         'unspecified, defaults to stderr')
+    parser.add_argument('--max-concurrent-requests', required=False, type=int, default=4, help='Maximum number ' +
+        'of pledge detail reports (one per COA category) CCB is asked for at once. Defaults to 4')
+    parser.add_argument('--resume', action='store_true', help='If specified, pledge categories retrieved by an ' +
+        'interrupted earlier run (see [checkpoints] in ccb_backup.ini) are reused rather than retrieved again')
     g.args = parser.parse_args()
 
     message_level = util.get_ini_setting('logging', 'level')
     util.set_logger(message_level, g.args.message_output_filename, os.path.basename(__file__))
 
+    if g.args.max_concurrent_requests < 1:
+        logging.error('Specified --max-concurrent-requests value must be a positive integer. Aborting!')
+        util.sys_exit(1)
+
     ccb_app_username = util.get_ini_setting('ccb', 'app_username', False)
     ccb_app_password = util.get_ini_setting('ccb', 'app_password', False)
     ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
 
+    if g.args.output_filename is not None:
+        output_filename = g.args.output_filename
+    else:
+        output_filename = './tmp/pledges_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+    util.test_write(output_filename)
+
+    with util.get_ccb_ui_session(ccb_subdomain, ccb_app_username, ccb_app_password) as http_session:
+        collect_pledges(http_session, ccb_subdomain, output_filename, g.args.max_concurrent_requests,
+            g.args.resume)
+
+    util.sys_exit(0)
+
+
+def collect_pledges(http_session, ccb_subdomain, output_filename, max_concurrent_requests=4, resume=False):
     curr_date_str = datetime.datetime.now().strftime('%m/%d/%Y')
 
     pledge_summary_report_info = {
@@ -65,10 +90,112 @@ def main(argv):
         'request': json.dumps(pledge_detail_dialog_report_info),
     }
 
+    # Get list of pledged categories
+    with util.ccb_ui_post(http_session, ccb_subdomain, 'report.php', data=pledge_summary_request,
+        stream=True) as pledge_summary_response:
+        pledge_summary_rows = util.get_report_csv_rows(pledge_summary_response, ['COA Category'])
+        if pledge_summary_rows is None:
+            logging.error('Pledge Summary retrieval failure. Aborting!')
+            util.sys_exit(1)
+        next(pledge_summary_rows) # Skip header row
+        list_pledge_categories = [str(row[0]) for row in pledge_summary_rows]
+
+    # Get dictionary of category option IDs
+    report_page = util.ccb_ui_get(http_session, ccb_subdomain, 'service/report_settings.php',
+        params=pledge_detail_dialog_request)
+    if report_page.status_code == 200:
+        match_report_options = re.search(
+            '<select\s+name=\\\\"transaction_detail_type_id\\\\"\s+id=\\\\"\\\\"\s*>(.*?)<\\\/select>',
+            report_page.text)
+        pledge_categories_str = match_report_options.group(1)
+    else:
+        logging.error('Error retrieving report settings page. Aborting!')
+        util.sys_exit(1)
+    dict_pledge_categories = {}
+    root_str = ''
+    for option_match in re.finditer(r'<option\s+value=\\"([0-9]+)\\"\s*>([^<]*)<\\/option>',
+        pledge_categories_str):
+        if re.match(r'&emsp;', option_match.group(2)):
+            dict_pledge_categories[root_str + ' : ' + option_match.group(2)[6:]] = int(option_match.group(1))
+        else:
+            root_str = option_match.group(2)
+            dict_pledge_categories[root_str] = int(option_match.group(1))
+
+    # Pull back CSV list of pledges for each category with pledges, concurrently, merging them in category order
+    logging.info('Retrieving pledges for ' + str(len(list_pledge_categories)) + ' categories with up to ' +
+        str(max_concurrent_requests) + ' concurrent requests')
+    output_csv_header = None
+    category_timings = []
+
+    # Each category's report is kept as a checkpoint once retrieved, so an interrupted run can be resumed
+    checkpoint_journal = util.open_checkpoint_journal('get_pledges', resume)
+    if checkpoint_journal is not None:
+        temp_directory_context = contextlib.nullcontext(checkpoint_journal['directory'])
+    else:
+        temp_directory_context = tempfile.TemporaryDirectory()
+    with open(output_filename, 'w') as csv_output_file, temp_directory_context as temp_directory:
+        csv_writer = csv.writer(csv_output_file)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_requests,
+            thread_name_prefix='get_pledges') as executor:
+            for pledge_category, pledge_detail_filename, elapsed_time in executor.map(
+                lambda x: retrieve_checkpointed_pledge_category(http_session, ccb_subdomain, dict_pledge_categories,
+                x, temp_directory, checkpoint_journal), list_pledge_categories):
+                category_timings.append([pledge_category, elapsed_time])
+                if pledge_detail_filename is None:
+                    continue
+                with open(pledge_detail_filename, 'r', newline='', encoding='utf-8') as pledge_detail_file:
+                    header_row = True
+                    for row in csv.reader(pledge_detail_file):
+                        if header_row:
+                            header_row = False
+                            if output_csv_header is None:
+                                output_csv_header = ['COA ID', 'COA Category'] + row
+                                amount_column_index = output_csv_header.index('Total Pledged')
+                                csv_writer.writerow(output_csv_header)
+                        else:
+                            row = [dict_pledge_categories[pledge_category], pledge_category] + row
+                            if row[amount_column_index] != '0': # Ignore non-pledge (contrib-only) rows
+                                csv_writer.writerow(row)
+                if checkpoint_journal is None:
+                    os.remove(pledge_detail_filename)
+    util.remove_checkpoint_journal(checkpoint_journal)
+
+    for pledge_category, elapsed_time in sorted(category_timings, key=lambda x: x[1], reverse=True):
+        logging.info('Pledge detail for category ' + pledge_category + ' took {:.1f} seconds'.format(elapsed_time))
+    logging.info('Pledge detail retrieval took {:.1f} seconds summed across categories'.format(
+        sum([x[1] for x in category_timings])))
+    logging.info('Pledge details retrieved successfully and written to ' + output_filename)
+
+
+def retrieve_checkpointed_pledge_category(http_session, ccb_subdomain, dict_pledge_categories, pledge_category,
+    temp_directory, checkpoint_journal):
+    checkpoint = util.get_checkpoint(checkpoint_journal, pledge_category)
+    if checkpoint is not None:
+        logging.info('Reusing pledges for ' + pledge_category + ' retrieved by interrupted earlier run')
+        return pledge_category, temp_directory + '/' + checkpoint['filenames'][0], 0.0
+    pledge_category, pledge_detail_filename, elapsed_time = retrieve_pledge_category(http_session, ccb_subdomain,
+        dict_pledge_categories, pledge_category, temp_directory)
+    if pledge_detail_filename is not None:
+        util.add_checkpoint(checkpoint_journal, pledge_category,
+            {'filenames': [os.path.basename(pledge_detail_filename)]})
+    return pledge_category, pledge_detail_filename, elapsed_time
+
+
+def retrieve_pledge_category(http_session, ccb_subdomain, dict_pledge_categories, pledge_category, temp_directory):
+    # Returns pledge_category, filename of its CSV report (header row first) streamed into temp_directory, or None on
+    # failure, and seconds taken
+    logging.info('Retrieving pledges for ' + pledge_category)
+    start_time = time.time()
+    if pledge_category not in dict_pledge_categories:
+        logging.warning('Unknown pledge category. ' + pledge_category)
+        return pledge_category, None, 0.0
+
+    curr_date_str = datetime.datetime.now().strftime('%m/%d/%Y')
+
     pledge_detail_report_info = {
         'id':'',
         'type': 'pledge_giving_detail',
-        'transaction_detail_type_id': '{coa_id}', # {coa_id} is substituted at run-time
+        'transaction_detail_type_id': str(dict_pledge_categories[pledge_category]),
         'print_type': 'family',
         'split_child_records': '1',
         'show': 'all',
@@ -81,98 +208,19 @@ def main(argv):
     }
 
     pledge_detail_request = {
-        'request': json.dumps(pledge_detail_report_info), # This is also replaced at run-time
+        'request': json.dumps(pledge_detail_report_info),
         'output': 'export'
     }
 
-    with requests.Session() as http_session:
-        util.login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
-
-        # Get list of pledged categories
-        pledge_summary_response = http_session.post('https://' + ccb_subdomain + '.ccbchurch.com/report.php',
-            data=pledge_summary_request)
-        pledge_summary_response.encoding = 'utf-8-sig'
-        pledge_summary_succeeded = False
-        if pledge_summary_response.status_code == 200:
-            match_pledge_summary_info = re.search('COA Category', pledge_summary_response.text)
-            if match_pledge_summary_info != None:
-                pledge_summary_succeeded = True
-        if not pledge_summary_succeeded:
-            logging.error('Pledge Summary retrieval failure. Aborting!')
-            util.sys_exit(1)
-        csv_reader = csv.reader(io.StringIO(pledge_summary_response.text))
-        header_row = True
-        list_pledge_categories = []
-        for row in csv_reader:
-            if header_row:
-                assert row[0] == 'COA Category'
-                header_row = False
-            else:
-                list_pledge_categories.append(str(row[0]))
-
-        # Get dictionary of category option IDs
-        report_page = http_session.get('https://' + ccb_subdomain + '.ccbchurch.com/service/report_settings.php',
-            params=pledge_detail_dialog_request)
-        if report_page.status_code == 200:
-            match_report_options = re.search(
-                '<select\s+name=\\\\"transaction_detail_type_id\\\\"\s+id=\\\\"\\\\"\s*>(.*?)<\\\/select>',
-                report_page.text)
-            pledge_categories_str = match_report_options.group(1)
+    pledge_detail_filename = None
+    with util.ccb_ui_post(http_session, ccb_subdomain, 'report.php', data=pledge_detail_request,
+        stream=True) as pledge_detail_response:
+        pledge_detail_rows = util.get_report_csv_rows(pledge_detail_response, ['Name(s)'])
+        if pledge_detail_rows is not None:
+            pledge_detail_filename = util.write_report_csv_temp_file(pledge_detail_rows, temp_directory)
         else:
-            logging.error('Error retrieving report settings page. Aborting!')
-            util.sys_exit(1)
-        dict_pledge_categories = {}
-        root_str = ''
-        for option_match in re.finditer(r'<option\s+value=\\"([0-9]+)\\"\s*>([^<]*)<\\/option>',
-            pledge_categories_str):
-            if re.match(r'&emsp;', option_match.group(2)):
-                dict_pledge_categories[root_str + ' : ' + option_match.group(2)[6:]] = int(option_match.group(1))
-            else:
-                root_str = option_match.group(2)
-                dict_pledge_categories[root_str] = int(option_match.group(1))
-
-        # Loop over each category with pledges and pull back CSV list of pledges for that category
-        output_csv_header = None
-        if g.args.output_filename is not None:
-            output_filename = g.args.output_filename
-        else:
-            output_filename = './tmp/pledges_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
-        util.test_write(output_filename)
-        with open(output_filename, 'w') as csv_output_file:
-            csv_writer = csv.writer(csv_output_file)
-            for pledge_category in list_pledge_categories:
-                logging.info('Retrieving pledges for ' + pledge_category)
-                if pledge_category in dict_pledge_categories:
-                    pledge_detail_report_info['transaction_detail_type_id'] = \
-                        str(dict_pledge_categories[pledge_category])
-                    pledge_detail_request['request'] = json.dumps(pledge_detail_report_info)
-                    pledge_detail_response = http_session.post('https://' + ccb_subdomain + \
-                        '.ccbchurch.com/report.php', data=pledge_detail_request)
-                    pledge_detail_response.encoding = 'utf-8-sig'
-                    pledge_detail_succeeded = False
-                    if pledge_detail_response.status_code == 200 and pledge_detail_response.text[:8] == 'Name(s),':
-                        pledge_detail_succeeded = True
-                        csv_reader = csv.reader(io.StringIO(pledge_detail_response.text))
-                        header_row = True
-                        for row in csv_reader:
-                            if header_row:
-                                header_row = False
-                                if output_csv_header is None:
-                                    output_csv_header = ['COA ID', 'COA Category'] + row
-                                    amount_column_index = output_csv_header.index('Total Pledged')
-                                    csv_writer.writerow(output_csv_header)
-                            else:
-                                row = [dict_pledge_categories[pledge_category], pledge_category] + row
-                                if row[amount_column_index] != '0': # Ignore non-pledge (contrib-only) rows
-                                    csv_writer.writerow(row)
-                    if not pledge_detail_succeeded:
-                        logging.warning('Pledge Detail retrieval failure for category ' + pledge_category)
-                else:
-                    logging.warning('Unknown pledge category. ' + pledge_category)
-
-    logging.info('Pledge details retrieved successfully and written to ' + output_filename)
-
-    util.sys_exit(0)
+            logging.warning('Pledge Detail retrieval failure for category ' + pledge_category)
+    return pledge_category, pledge_detail_filename, time.time() - start_time
 
 
 if __name__ == "__main__":
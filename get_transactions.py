@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import requests
+import urllib3
 import re
 import sys
 import json
@@ -9,8 +10,16 @@ import csv
 import logging
 import argparse
 import os
+import time
+import concurrent.futures
+import hashlib
+import tempfile
+import shutil
+import contextlib
 from util import util
-import io
+
+# CCB gives up on transaction detail reports covering too much data, sometimes without ever responding
+REPORT_TIMEOUT_SECONDS = 600
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
@@ -26,88 +35,337 @@ def main(argv):
         help='Output CSV filename. Defaults to ./tmp/[datetime_stamp]_pledges.csv')
     parser.add_argument('--message-output-filename', required=False, help='Filename of message output file. If ' +
         'unspecified, defaults to stderr')
+    parser.add_argument('--max-concurrent-requests', required=False, type=int, default=4, help='Maximum number ' +
+        'of transaction detail reports CCB is asked for at once. Defaults to 4')
+    parser.add_argument('--window-months', required=False, type=int, default=12, choices=[1, 2, 3, 4, 6, 12],
+        help='Number of months of transactions to request per report. Defaults to 12 (one report per year). ' +
+        'Windows that CCB times out on are automatically split into smaller ones')
+    parser.add_argument('--no-transactions-cache', action='store_true', help='If specified, the closed-year ' +
+        'transactions cache configured in ccb_backup.ini is neither read nor updated and every year is retrieved ' +
+        'from CCB')
+    parser.add_argument('--resume', action='store_true', help='If specified, years of transactions retrieved by ' +
+        'an interrupted earlier run (see [checkpoints] in ccb_backup.ini) are reused rather than retrieved again')
     g.args = parser.parse_args()
 
     message_level = util.get_ini_setting('logging', 'level')
     util.set_logger(message_level, g.args.message_output_filename, os.path.basename(__file__))
 
+    if g.args.max_concurrent_requests < 1:
+        logging.error('Specified --max-concurrent-requests value must be a positive integer. Aborting!')
+        util.sys_exit(1)
+
     ccb_app_username = util.get_ini_setting('ccb', 'app_username', False)
     ccb_app_password = util.get_ini_setting('ccb', 'app_password', False)
     ccb_subdomain = util.get_ini_setting('ccb', 'subdomain', False)
 
-    curr_date_str = datetime.datetime.now().strftime('%m/%d/%Y')
-
-    with requests.Session() as http_session:
-        util.login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
-
-        # Pull back complete CSV containing detail info for every transaction in CCB database
-        output_csv_header = None
-        if g.args.output_filename is not None:
-            output_filename = g.args.output_filename
-        else:
-            output_filename = './tmp/transactions_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
-        util.test_write(output_filename)
-        with open(output_filename, 'w') as csv_output_file:
-            csv_writer = csv.writer(csv_output_file)
-            logging.info('Note that it takes CCB a minute or two to pull retrieve all transaction information')
-            header_emitted = False
-            # Have to only collect a year of data at a time else CCB transactions report times out.  Start with
-            # year 2013 (since that's when financial data in CCB starts)
-            for year in range(2013, datetime.datetime.today().year + 1):
-                start_date_str = '01/01/' + str(year)
-                end_date_str = '12/31/' + str(year)
-
-                transaction_detail_report_info = {
-                    "id":"",
-                    "type":"transaction_detail",
-                    "email_pdf":"0",
-                    "is_contextual":"1",
-                    "transaction_detail_type_id":"0",
-                    "date_range":"",
-                    "ignore_static_range":"static",
-                    "start_date":start_date_str,
-                    "end_date":end_date_str,
-                    "campus_ids":["1"],
-                    "output":"csv"
-                }
-                transaction_detail_request = {
-                    'aj':1,
-                    'ax':'run',
-                    'request': json.dumps(transaction_detail_report_info)
-                }
-
-                logging.info('Retrieving info from ' + start_date_str + ' to ' + end_date_str)
-                transaction_detail_response = http_session.post('https://' + ccb_subdomain + \
-                    '.ccbchurch.com/report.php', data=transaction_detail_request)
-                transaction_detail_response.encoding = 'utf-8-sig'
-                transaction_detail_succeeded = False
-                if transaction_detail_response.status_code == 200:
-                    if transaction_detail_response.text[:12] == 'Name,Campus,':
-                        transaction_detail_succeeded = True
-                        skipped_first = False
-                        csv_reader = csv.reader(io.StringIO(transaction_detail_response.text))
-                        for row in csv_reader:
-                            if not header_emitted:
-                                csv_writer.writerow(row)
-                                header_emitted = True
-                            else:
-                                if skipped_first:
-                                    csv_writer.writerow(row)
-                                else:
-                                    skipped_first = True
-                        if not transaction_detail_succeeded:
-                            print(transaction_detail_response)
-                            print(transaction_detail_response.text)
-                            logging.error('Transaction Detail retrieval failed (will time out if too much data '
-                                'retrieved)')
-                            util.sys_exit(1)
-                        else:
-                            logging.info('Transaction info successfully retrieved into file ' + output_filename)
-                    else:
-                        logging.info('No CSV results returned...skipping.')
+    # Pull back complete CSV containing detail info for every transaction in CCB database
+    if g.args.output_filename is not None:
+        output_filename = g.args.output_filename
+    else:
+        output_filename = './tmp/transactions_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+    util.test_write(output_filename)
+
+    with util.get_ccb_ui_session(ccb_subdomain, ccb_app_username, ccb_app_password) as http_session:
+        collect_transactions(http_session, ccb_subdomain, output_filename, g.args.max_concurrent_requests,
+            g.args.window_months, not g.args.no_transactions_cache, g.args.resume)
 
     util.sys_exit(0)
 
 
+def collect_transactions(http_session, ccb_subdomain, output_filename, max_concurrent_requests=4, window_months=12,
+    use_transactions_cache=True, resume=False):
+    # Closed financial years don't change, so they are spliced in from the local cache when it's been verified
+    # against CCB recently enough
+    cache_directory = None
+    if use_transactions_cache:
+        cache_directory = util.get_ini_setting('transactions_cache', 'directory')
+    if cache_directory is not None:
+        if not os.path.isabs(cache_directory):
+            cache_directory = os.path.dirname(os.path.abspath(__file__)) + '/' + cache_directory
+        reverify_days = util.get_ini_setting_int('transactions_cache', 'reverify_days', 30, 0)
+        grace_days = util.get_ini_setting_int('transactions_cache', 'grace_days', 45, 0)
+        cache_index = load_transactions_cache_index(cache_directory)
+
+    # Have to only collect a year (or less) of data at a time else CCB transactions report times out.  Start with
+    # year 2013 (since that's when financial data in CCB starts)
+    today = datetime.date.today()
+    years = list(range(2013, today.year + 1))
+
+    # Each year's reports are kept as a checkpoint once retrieved, so an interrupted run can be resumed
+    checkpoint_journal = util.open_checkpoint_journal('get_transactions', resume)
+    checkpointed_years = [x for x in years if util.get_checkpoint(checkpoint_journal, str(x)) is not None]
+    cached_years = []
+    cacheable_years = []
+    windows = []
+    windows_per_year = {}
+    for year in years:
+        if year in checkpointed_years:
+            continue
+        if cache_directory is not None and is_closed_year(year, today, grace_days):
+            cacheable_years.append(year)
+            if is_cached_year_current(cache_directory, cache_index, year, reverify_days):
+                cached_years.append(year)
+                continue
+        windows_per_year[year] = 0
+        for start_month in range(1, 13, window_months):
+            start_date = datetime.date(year, start_month, 1)
+            if start_month + window_months > 12:
+                end_date = datetime.date(year, 12, 31)
+            else:
+                end_date = datetime.date(year, start_month + window_months, 1) - datetime.timedelta(days=1)
+            windows.append([start_date, end_date])
+            windows_per_year[year] += 1
+    if cache_directory is not None:
+        logging.info('Using cached transactions for ' + str(len(cached_years)) + ' of ' + str(len(years)) +
+            ' years')
+
+    # Each window's report is streamed into a temporary file (kept with the checkpoints, if enabled) as it arrives,
+    # rather than held in memory until its turn in the merge
+    if checkpoint_journal is not None:
+        temp_directory_context = contextlib.nullcontext(checkpoint_journal['directory'])
+    else:
+        temp_directory_context = tempfile.TemporaryDirectory()
+    with open(output_filename, 'w') as csv_output_file, temp_directory_context as temp_directory:
+        csv_writer = csv.writer(csv_output_file)
+        logging.info('Note that it takes CCB a minute or two to pull retrieve all transaction information')
+        logging.info('Retrieving transactions in ' + str(len(windows)) + ' date windows with up to ' +
+            str(max_concurrent_requests) + ' concurrent requests')
+        header_emitted = False
+
+        # Windows are retrieved concurrently but merged in chronological order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_requests,
+            thread_name_prefix='get_transactions') as executor:
+            try:
+                window_results = executor.map(lambda x: retrieve_transaction_window(http_session, ccb_subdomain,
+                    *x, temp_directory), windows)
+                for year in years:
+                    if year in checkpointed_years:
+                        report_filenames = [temp_directory + '/' + x for x in
+                            util.get_checkpoint(checkpoint_journal, str(year))['filenames']]
+                    elif year in cached_years:
+                        report_filenames = [get_cached_year_filename(cache_directory, year)]
+                    else:
+                        report_filenames = []
+                        for window_num in range(windows_per_year[year]):
+                            report_filenames += next(window_results)
+                        if year in cacheable_years:
+                            write_cached_year(cache_directory, cache_index, year, report_filenames)
+                        util.add_checkpoint(checkpoint_journal, str(year),
+                            {'filenames': [os.path.basename(x) for x in report_filenames]})
+                    for report_filename in report_filenames:
+                        header_emitted = write_report_rows(csv_writer, report_filename, header_emitted)
+                        if year not in cached_years and checkpoint_journal is None:
+                            os.remove(report_filename)
+            except SystemExit:
+                # A retrieval aborted, so don't wait on the remaining queued windows before exiting
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    if cache_directory is not None:
+        save_transactions_cache_index(cache_directory, cache_index)
+    util.remove_checkpoint_journal(checkpoint_journal)
+
+    logging.info('Transaction info successfully retrieved into file ' + output_filename)
+
+
+def is_closed_year(year, today, grace_days):
+    # Prior year stays open for grace_days into the new year while late entries and corrections are made
+    if year >= today.year:
+        return False
+    elif year == today.year - 1:
+        return today >= datetime.date(today.year, 1, 1) + datetime.timedelta(days=grace_days)
+    else:
+        return True
+
+
+def load_transactions_cache_index(cache_directory):
+    cache_index_filename = cache_directory + '/index.json'
+    if not os.path.isfile(cache_index_filename):
+        return {}
+    try:
+        with open(cache_index_filename, 'r') as cache_index_file:
+            return json.load(cache_index_file)
+    except ValueError:
+        logging.warning('Transactions cache index ' + cache_index_filename + ' is corrupt. Ignoring cache')
+        return {}
+
+
+def save_transactions_cache_index(cache_directory, cache_index):
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    with tempfile.NamedTemporaryFile(mode='w', dir=cache_directory, delete=False) as temp:
+        json.dump(cache_index, temp, indent=2, sort_keys=True)
+    os.replace(temp.name, cache_directory + '/index.json')
+
+
+def get_cached_year_filename(cache_directory, year):
+    return cache_directory + '/transactions_' + str(year) + '.csv'
+
+
+def get_file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_cached_year_current(cache_directory, cache_index, year, reverify_days):
+    year_str = str(year)
+    if year_str not in cache_index:
+        return False
+    cached_year_filename = get_cached_year_filename(cache_directory, year)
+    if not os.path.isfile(cached_year_filename) or \
+        get_file_sha256(cached_year_filename) != cache_index[year_str]['sha256']:
+        logging.warning('Cached transactions for ' + year_str + ' are missing or fail checksum. Retrieving again')
+        return False
+    if reverify_days > 0 and time.time() - cache_index[year_str]['verified'] > reverify_days * 86400:
+        logging.info('Cached transactions for ' + year_str + ' are due to be verified against CCB')
+        return False
+    return True
+
+
+def write_report_rows(csv_writer, report_filename, header_emitted):
+    # Copies rows of report_filename, which holds one or more CSV reports back to back (a cached year holds several),
+    # each starting with its own 'Name,Campus,...' header row, to csv_writer. Only the first header row of all is
+    # written. Returns whether it has been
+    with open(report_filename, 'r', newline='', encoding='utf-8') as report_file:
+        for row in csv.reader(report_file):
+            if row[:2] == ['Name', 'Campus']:
+                if header_emitted:
+                    continue
+                header_emitted = True
+            csv_writer.writerow(row)
+    return header_emitted
+
+
+def write_cached_year(cache_directory, cache_index, year, report_filenames):
+    # A closed year retrieved with fewer transactions than were cached (e.g. CCB returned partial reports) doesn't
+    # replace the cached year, which is then verified against CCB again next run
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    with tempfile.NamedTemporaryFile(mode='wb', dir=cache_directory, delete=False) as temp:
+        for report_filename in report_filenames:
+            with open(report_filename, 'rb') as report_file:
+                shutil.copyfileobj(report_file, temp)
+    sha256 = get_file_sha256(temp.name)
+    year_str = str(year)
+    cached_year_filename = get_cached_year_filename(cache_directory, year)
+    if year_str in cache_index and cache_index[year_str]['sha256'] != sha256:
+        num_rows = count_report_rows(temp.name)
+        num_cached_rows = count_report_rows(cached_year_filename) if os.path.isfile(cached_year_filename) else 0
+        if num_rows < num_cached_rows:
+            logging.error('Transactions for closed year ' + year_str + ' retrieved from CCB have ' + str(num_rows) +
+                ' rows, fewer than the ' + str(num_cached_rows) + ' rows cached. Keeping cached year')
+            os.remove(temp.name)
+            return
+        logging.warning('Transactions for closed year ' + year_str + ' changed in CCB since they were cached')
+    os.replace(temp.name, cached_year_filename)
+    cache_index[year_str] = {'sha256': sha256, 'verified': time.time()}
+
+
+def count_report_rows(report_filename):
+    # Number of rows, not counting header rows, in report_filename (see write_report_rows())
+    num_rows = 0
+    with open(report_filename, 'r', newline='', encoding='utf-8') as report_file:
+        for row in csv.reader(report_file):
+            if row[:2] != ['Name', 'Campus']:
+                num_rows += 1
+    return num_rows
+
+
+def retrieve_transaction_window(http_session, ccb_subdomain, start_date, end_date, temp_directory):
+    # Returns a list of filenames of CSV reports (header row first), streamed into temp_directory, covering start_date
+    # to end_date (an empty list if CCB returns nothing for it). If CCB times out on the window, it is split in half
+    # and each half is retrieved instead. Any other response that isn't a report ends the run, so no year is ever
+    # cached or checkpointed with a window missing
+    start_date_str = start_date.strftime('%m/%d/%Y')
+    end_date_str = end_date.strftime('%m/%d/%Y')
+
+    transaction_detail_report_info = {
+        "id":"",
+        "type":"transaction_detail",
+        "email_pdf":"0",
+        "is_contextual":"1",
+        "transaction_detail_type_id":"0",
+        "date_range":"",
+        "ignore_static_range":"static",
+        "start_date":start_date_str,
+        "end_date":end_date_str,
+        "campus_ids":["1"],
+        "output":"csv"
+    }
+    transaction_detail_request = {
+        'aj':1,
+        'ax':'run',
+        'request': json.dumps(transaction_detail_report_info)
+    }
+
+    # Only a timeout means the window holds too much data for CCB (so splitting it helps). Other server errors and
+    # dropped connections are retried with backoff as is
+    retry_num = 0
+    while True:
+        logging.info('Retrieving info from ' + start_date_str + ' to ' + end_date_str)
+        start_time = time.time()
+        report_filename = None
+        timed_out = False
+        failure = None
+        bad_response = None
+        try:
+            with util.ccb_ui_post(http_session, ccb_subdomain, 'report.php', data=transaction_detail_request,
+                timeout=REPORT_TIMEOUT_SECONDS, stream=True) as transaction_detail_response:
+                if transaction_detail_response.status_code in [408, 504]:
+                    timed_out = True
+                elif transaction_detail_response.status_code >= 500:
+                    failure = 'failed with HTTP status ' + str(transaction_detail_response.status_code)
+                else:
+                    transaction_detail_rows = util.get_report_csv_rows(transaction_detail_response,
+                        ['Name', 'Campus'], allow_empty=True)
+                    if transaction_detail_rows is None:
+                        if transaction_detail_response.status_code != 200:
+                            bad_response = 'HTTP status ' + str(transaction_detail_response.status_code)
+                        else:
+                            bad_response = 'a response that is not a transaction report (e.g. an error or login page)'
+                    elif transaction_detail_rows != []:
+                        report_filename = util.write_report_csv_temp_file(transaction_detail_rows, temp_directory)
+        except requests.exceptions.ConnectTimeout as e:
+            failure = 'could not connect (' + type(e).__name__ + ')'
+        except requests.exceptions.Timeout:
+            timed_out = True
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            # A read timeout while streaming the report surfaces as a ConnectionError
+            if len(e.args) > 0 and isinstance(e.args[0], urllib3.exceptions.ReadTimeoutError):
+                timed_out = True
+            else:
+                failure = 'lost connection (' + type(e).__name__ + ')'
+        if failure is None:
+            break
+        time.sleep(util.get_retry_wait_seconds('Transaction Detail retrieval from ' + start_date_str + ' to ' +
+            end_date_str, failure, retry_num))
+        retry_num += 1
+
+    if timed_out:
+        if start_date == end_date:
+            logging.error('Transaction Detail retrieval failed for ' + start_date_str + ' (will time out if too ' +
+                'much data retrieved)')
+            util.sys_exit(1)
+        middle_date = start_date + (end_date - start_date) // 2
+        logging.warning('Transaction Detail retrieval from ' + start_date_str + ' to ' + end_date_str + ' timed ' +
+            'out after {:.0f} seconds. Splitting into two smaller windows'.format(time.time() - start_time))
+        return retrieve_transaction_window(http_session, ccb_subdomain, start_date, middle_date, temp_directory) + \
+            retrieve_transaction_window(http_session, ccb_subdomain, middle_date + datetime.timedelta(days=1),
+            end_date, temp_directory)
+
+    if bad_response is not None:
+        logging.error('Transaction Detail retrieval from ' + start_date_str + ' to ' + end_date_str + ' failed with ' +
+            bad_response)
+        util.sys_exit(1)
+    if report_filename is not None:
+        return [report_filename]
+    else:
+        logging.info('No CSV results returned from ' + start_date_str + ' to ' + end_date_str + '...skipping.')
+        return []
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,56 @@
+import os
+import sys
+import textwrap
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from util import util
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'ini(text): contents of ccb_backup.ini for the test, with {tmp_path} replaced '
+        'by the test\'s tmp_path')
+
+
+@pytest.fixture(autouse=True)
+def ini_filename(request, tmp_path, monkeypatch):
+    # Every test gets its own ccb_backup.ini, holding the text of its ini marker (empty without one), and no
+    # CCB_BACKUP_* overrides from the environment
+    ini_filename = str(tmp_path / 'ccb_backup.ini')
+    marker = request.node.get_closest_marker('ini')
+    with open(ini_filename, 'w') as ini_file:
+        if marker is not None:
+            ini_file.write(textwrap.dedent(marker.args[0]).replace('{tmp_path}', str(tmp_path)))
+    monkeypatch.setattr(util, 'get_config_file_path', lambda: ini_filename)
+    monkeypatch.setattr(util, '_config_parser', None)
+    for name in list(os.environ):
+        if name.startswith('CCB_BACKUP_'):
+            monkeypatch.delenv(name)
+    return ini_filename
+
+
+@pytest.fixture
+def repo_directory():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    # Yields S3 client of a moto-mocked S3 holding empty bucket 'bkt', which ccb_backup.py is set up to use
+    import boto3
+    import moto
+
+    import ccb_backup
+
+    monkeypatch.setattr(ccb_backup.g, 'args', types.SimpleNamespace(dry_run_deletes=False,
+        message_output_filename='messages.log'))
+    monkeypatch.setattr(ccb_backup.g, 'aws_s3_bucket_name', 'bkt')
+    monkeypatch.setattr(ccb_backup.g, 'aws_region_name', 'us-east-1')
+    monkeypatch.setattr(ccb_backup.g, 's3_client', None)
+    with moto.mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='bkt')
+        yield s3_client
@@ -0,0 +1,76 @@
+import os
+import struct
+import types
+import zipfile
+
+import pyzipper
+import pytest
+
+import ccb_backup
+
+PASSWORD = 'secret'
+
+
+def make_data_files(tmp_path):
+    data_files = {
+        'individuals.csv': b'id,name\n' + b''.join([b'%d,Person %d\n' % (i, i) for i in range(50000)]),
+        'groups.csv': b'id,name\n1,Choir\n',
+        'empty.csv': b'',
+        'random.bin': os.urandom(3 * 1024 * 1024)
+    }
+    for name, data in data_files.items():
+        (tmp_path / name).write_bytes(data)
+    return data_files
+
+
+def merge_archive(tmp_path, data_files):
+    output_filename = str(tmp_path / 'backup.zip')
+    archive = ccb_backup.open_aes_zip_file(output_filename, PASSWORD, 6)
+    for i, name in enumerate(data_files):
+        part_filename = str(tmp_path / (str(i) + '.zip'))
+        ccb_backup.compress_archive_member(str(tmp_path / name), part_filename, PASSWORD, 6)
+        ccb_backup.merge_archive_member(archive, part_filename)
+    archive.close()
+    return output_filename
+
+
+def test_merged_archive_passes_testzip(tmp_path):
+    data_files = make_data_files(tmp_path)
+    output_filename = merge_archive(tmp_path, data_files)
+    with pyzipper.AESZipFile(output_filename) as archive:
+        archive.setpassword(PASSWORD.encode('utf-8'))
+        assert archive.testzip() is None
+        assert archive.namelist() == list(data_files)
+        for name, data in data_files.items():
+            assert archive.read(name) == data
+            assert archive.getinfo(name).compress_type == pyzipper.ZIP_DEFLATED
+    ccb_backup.verify_archive_members(output_filename, PASSWORD)
+
+
+def test_merged_archive_is_aes_encrypted(tmp_path):
+    data_files = make_data_files(tmp_path)
+    output_filename = merge_archive(tmp_path, data_files)
+    with zipfile.ZipFile(output_filename) as archive:
+        assert archive.getinfo('groups.csv').compress_type == 99
+        assert archive.getinfo('groups.csv').flag_bits & 0x1
+    with pyzipper.AESZipFile(output_filename) as archive:
+        archive.setpassword(b'wrong')
+        with pytest.raises(RuntimeError):
+            archive.read('groups.csv')
+
+
+def test_verify_archive_members_catches_misplaced_member(tmp_path, monkeypatch):
+    monkeypatch.setattr(ccb_backup.g, 'args', types.SimpleNamespace(message_output_filename=None))
+    monkeypatch.setattr(ccb_backup.g, 'program_filename', 'ccb_backup.py')
+    data_files = make_data_files(tmp_path)
+    output_filename = merge_archive(tmp_path, data_files)
+    with open(output_filename, 'r+b') as output_file:
+        # Point the second central directory entry's local header offset at the first member
+        output_file.seek(-22, os.SEEK_END)
+        central_dir_offset = struct.unpack('<16xI2x', output_file.read(22))[0]
+        output_file.seek(central_dir_offset)
+        entry_lengths = struct.unpack('<28xHHH12x', output_file.read(46))
+        output_file.seek(central_dir_offset + 46 + sum(entry_lengths) + 42)
+        output_file.write(struct.pack('<I', 0))
+    with pytest.raises(SystemExit):
+        ccb_backup.verify_archive_members(output_filename, PASSWORD)
@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from util import util
+
+CHECKPOINTS_INI = '''
+    [checkpoints]
+    directory = {tmp_path}/checkpoints
+    sync_seconds = 3600
+    '''
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    # Returns list of file descriptors fsync()ed during the test, whose journals are all closed afterwards
+    fsyncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: fsyncs.append(fd) or fsync(fd))
+    yield fsyncs
+    util.close_checkpoint_journals()
+
+
+@pytest.mark.ini(CHECKPOINTS_INI)
+def test_fsyncs_are_batched_until_close(fsyncs):
+    journal = util.open_checkpoint_journal('get_attendance', False, {'start_date': '2020-01-01'})
+    num_opening_fsyncs = len(fsyncs)
+    for i in range(100):
+        util.add_checkpoint(journal, str(i), {'rows': [[str(i)]]})
+    assert len(fsyncs) == num_opening_fsyncs
+    util.close_checkpoint_journals()
+    assert len(fsyncs) == num_opening_fsyncs + 1
+
+    journal = util.open_checkpoint_journal('get_attendance', True, {'start_date': '2020-01-01'})
+    assert util.get_checkpoint(journal, '99') == {'rows': [['99']]}
+    assert len(journal['units']) == 100
+
+
+@pytest.mark.ini(CHECKPOINTS_INI.replace('3600', '0'))
+def test_sync_seconds_zero_fsyncs_every_unit(fsyncs):
+    journal = util.open_checkpoint_journal('get_pledges', False)
+    num_opening_fsyncs = len(fsyncs)
+    for i in range(5):
+        util.add_checkpoint(journal, str(i), {'rows': [[str(i)]]})
+    assert len(fsyncs) == num_opening_fsyncs + 5
+
+
+@pytest.mark.ini(CHECKPOINTS_INI)
+def test_checkpoints_survive_process_being_killed(fsyncs, tmp_path, repo_directory):
+    env = dict(os.environ, CCB_BACKUP_CHECKPOINTS_DIRECTORY=str(tmp_path / 'checkpoints'),
+        CCB_BACKUP_CHECKPOINTS_SYNC_SECONDS='3600', CCB_BACKUP_CHECKPOINTS_MAX_AGE_HOURS='24')
+    # os._exit() skips exit handlers, as being killed would
+    code = 'import os\nfrom util import util\njournal = util.open_checkpoint_journal("get_transactions", False)\n' \
+        'for year in range(2000, 2010):\n    util.add_checkpoint(journal, str(year), {"filenames": []})\n' \
+        'os._exit(1)\n'
+    assert subprocess.call([sys.executable, '-c', code], env=env, cwd=repo_directory) == 1
+    journal = util.open_checkpoint_journal('get_transactions', True)
+    assert sorted(journal['units']) == [str(x) for x in range(2000, 2010)]
+
+
+@pytest.mark.ini(CHECKPOINTS_INI)
+def test_removed_journal_is_closed(fsyncs):
+    journal = util.open_checkpoint_journal('get_pledges', False)
+    util.add_checkpoint(journal, 'Building Fund', {'rows': [['a']]})
+    util.remove_checkpoint_journal(journal)
+    assert journal['file'].closed
+    assert not os.path.isdir(journal['directory'])
+    assert journal not in util._checkpoint_journals
+
+
+@pytest.mark.ini(CHECKPOINTS_INI)
+def test_units_with_damaged_files_are_redone(fsyncs):
+    journal = util.open_checkpoint_journal('get_transactions', False)
+    for year in ['2020', '2021', '2022']:
+        with open(journal['directory'] + '/' + year + '.csv', 'w') as report_file:
+            report_file.write('Date,Amount\n01/01/' + year + ',10.00\n')
+        util.add_checkpoint(journal, year, {'filenames': [year + '.csv']})
+    util.close_checkpoint_journals()
+    # As a system crash could leave them, though their journal lines were synced
+    with open(journal['directory'] + '/2021.csv', 'w') as report_file:
+        report_file.write('Date,Amount\n')
+    os.remove(journal['directory'] + '/2022.csv')
+
+    journal = util.open_checkpoint_journal('get_transactions', True)
+    assert sorted(journal['units']) == ['2020']
+    assert util.get_checkpoint(journal, '2020')['filenames'] == ['2020.csv']
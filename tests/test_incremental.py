@@ -0,0 +1,173 @@
+import datetime
+import os
+import shutil
+import types
+
+import pytest
+
+import ccb_backup
+import ccb_backup_delta
+
+BASELINE_EVERY = 4
+
+
+pytestmark = pytest.mark.ini('''
+    [incremental]
+    state_directory = {tmp_path}/state
+    baseline_every = ''' + str(BASELINE_EVERY) + '''
+
+    [incremental_key_columns]
+    ''')
+
+
+@pytest.fixture
+def incremental(tmp_path, monkeypatch):
+    monkeypatch.setattr(ccb_backup.g, 'args', types.SimpleNamespace(message_output_filename='messages.log',
+        incremental=True))
+    monkeypatch.setattr(ccb_backup.g, 'run_util_errors', [])
+    monkeypatch.setattr(ccb_backup.g, 'incremental_manifest', None)
+    return tmp_path
+
+
+def get_rows(run_num):
+    # Every run changes one row, adds one and drops one
+    rows = [[str(i), 'Person ' + str(i)] for i in range(run_num, run_num + 20)]
+    rows[5][1] = 'Changed in run ' + str(run_num)
+    return rows
+
+
+def get_stamp(run_num):
+    return (datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=run_num)).strftime('%Y%m%d%H%M%S')
+
+
+def start_backup(folder_names):
+    # Returns True if the backup about to be run is planned as a delta
+    ccb_backup.start_incremental()
+    return ccb_backup.plan_incremental_backup(folder_names)
+
+
+def run_backup(tmp_path, run_num):
+    # Runs ccb_backup.py's incremental steps for one started backup. Returns the backup's directory
+    ccb_backup.g.incremental_manifest['stamp'] = get_stamp(run_num)
+    ccb_backup.g.temp_directory = str(tmp_path / ('backup_' + str(run_num)))
+    os.makedirs(ccb_backup.g.temp_directory)
+    output_filename = ccb_backup.g.temp_directory + '/individuals_' + get_stamp(run_num) + '.csv'
+    ccb_backup_delta.write_csv(output_filename, ['Ind ID', 'Name'], get_rows(run_num))
+    ccb_backup.make_incremental_files('individuals', [output_filename])
+    ccb_backup.write_incremental_manifest()
+    return ccb_backup.g.temp_directory
+
+
+def reconstruct(tmp_path, backup_dirs, run_num):
+    # Extracts backup_dirs into one directory, as a user restoring from one S3 folder would
+    restore_dir = str(tmp_path / 'restore')
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    os.makedirs(restore_dir)
+    for backup_dir in backup_dirs:
+        for filename in os.listdir(backup_dir):
+            shutil.copyfile(backup_dir + '/' + filename, restore_dir + '/' + filename)
+    output_filename = str(tmp_path / 'individuals.csv')
+    assert ccb_backup_delta.reconstruct_csv(restore_dir, 'individuals', get_stamp(run_num), output_filename) == \
+        get_stamp(run_num)
+    assert ccb_backup_delta.read_csv(output_filename) == (['Ind ID', 'Name'], get_rows(run_num))
+
+
+@pytest.mark.parametrize('schedules', [
+    {'daily': (1, 3)},
+    {'daily': (1, 3), 'weekly': (3, 2)},
+    {'daily': (1, 1), 'weekly': (2, 2), 'monthly': (5, 1)},
+    {'daily': (1, 6), 'weekly': (4, 3)}
+])
+def test_every_retained_backup_reconstructs_after_pruning(incremental, schedules):
+    # schedules maps each S3 folder name to (runs between backups, num_files_to_keep)
+    folders = {x: [] for x in schedules}
+    is_delta_dict = {}
+    backup_dirs_dict = {}
+    for run_num in range(1, 30):
+        folder_names = [x for x in schedules if run_num % schedules[x][0] == 0]
+        new_backup_is_delta = start_backup(folder_names)
+        files_to_delete = {x: ccb_backup.get_files_to_delete(folders[x], schedules[x][1], x in folder_names,
+            lambda y: is_delta_dict[y.key], new_backup_is_delta) for x in schedules}
+
+        backup_dir = run_backup(incremental, run_num)
+        assert ccb_backup.is_incremental_delta() == new_backup_is_delta
+        for folder_name in folder_names:
+            s3_object = ccb_backup.S3Object(folder_name + '/' + get_stamp(run_num) + '.zip', None, 0,
+                datetime.datetime.strptime(get_stamp(run_num), '%Y%m%d%H%M%S'))
+            folders[folder_name].append(s3_object)
+            is_delta_dict[s3_object.key] = new_backup_is_delta
+            backup_dirs_dict[s3_object.key] = (backup_dir, run_num)
+        ccb_backup.commit_incremental_state(folder_names)
+        for folder_name in schedules:
+            folders[folder_name] = [x for x in folders[folder_name] if x not in files_to_delete[folder_name]]
+
+        for folder_name in schedules:
+            assert len(folders[folder_name]) <= schedules[folder_name][1] + BASELINE_EVERY - 1
+            backup_dirs = [backup_dirs_dict[x.key][0] for x in folders[folder_name]]
+            for s3_object in folders[folder_name]:
+                reconstruct(incremental, backup_dirs, backup_dirs_dict[s3_object.key][1])
+
+
+def test_folders_not_getting_every_backup_get_baselines(incremental):
+    assert not start_backup(['daily', 'weekly'])
+    run_backup(incremental, 1)
+    ccb_backup.commit_incremental_state(['daily', 'weekly'])
+    assert start_backup(['daily'])
+    run_backup(incremental, 2)
+    assert ccb_backup.is_incremental_delta()
+    ccb_backup.commit_incremental_state(['daily'])
+    # Weekly folder lacks backup 2, which a delta would be diffed against
+    assert not start_backup(['daily', 'weekly'])
+    run_backup(incremental, 3)
+    assert not ccb_backup.is_incremental_delta()
+
+
+def test_uncommitted_backup_is_not_diffed_against(incremental):
+    start_backup(['daily'])
+    run_backup(incremental, 1)
+    ccb_backup.commit_incremental_state(['daily'])
+    # Backup 2 never makes it to S3, so backup 3 is diffed against backup 1
+    start_backup(['daily'])
+    run_backup(incremental, 2)
+    assert start_backup(['daily'])
+    backup_dir = run_backup(incremental, 3)
+    assert ccb_backup.g.incremental_manifest['data_sets']['individuals']['base_stamp'] == get_stamp(1)
+    ccb_backup.commit_incremental_state(['daily'])
+    reconstruct(incremental, [str(incremental / 'backup_1'), backup_dir], 3)
+
+
+def test_retention_keeps_baseline_of_oldest_kept_delta():
+    files = [ccb_backup.S3Object('daily/' + str(i), None, 0, datetime.datetime(2024, 1, i)) for i in range(1, 7)]
+    is_delta = lambda x: x.key not in ['daily/1', 'daily/4']
+    # Keeping 2 with a new backup would keep only daily/6 (a delta), which needs daily/4 and daily/5
+    assert ccb_backup.get_files_to_delete(files, 2, True, is_delta, True) == files[:3]
+    # daily/4 is a baseline, so nothing before it is needed
+    assert ccb_backup.get_files_to_delete(files, 3, False, is_delta, True) == files[:3]
+    # The new backup is a delta needing all of daily/4 to daily/6
+    assert ccb_backup.get_files_to_delete(files, 1, True, is_delta, True) == files[:3]
+    assert ccb_backup.get_files_to_delete(files, 1, True, is_delta, False) == files
+    assert ccb_backup.get_files_to_delete(files, 0, True, is_delta, True) == []
+
+
+def test_empty_data_set_reconstructs(incremental):
+    # A data set with no rows and no header (e.g. no pledge categories) must survive baseline and delta runs
+    for run_num in range(1, 3):
+        start_backup(['daily'])
+        ccb_backup.g.incremental_manifest['stamp'] = get_stamp(run_num)
+        ccb_backup.g.temp_directory = str(incremental / ('backup_' + str(run_num)))
+        os.makedirs(ccb_backup.g.temp_directory)
+        output_filename = ccb_backup.g.temp_directory + '/individuals_' + get_stamp(run_num) + '.csv'
+        open(output_filename, 'w').close()
+        ccb_backup.make_incremental_files('individuals', [output_filename])
+        ccb_backup.write_incremental_manifest()
+        ccb_backup.commit_incremental_state(['daily'])
+    assert ccb_backup.is_incremental_delta()
+    restore_dir = str(incremental / 'restore')
+    os.makedirs(restore_dir)
+    for run_num in range(1, 3):
+        backup_dir = str(incremental / ('backup_' + str(run_num)))
+        for filename in os.listdir(backup_dir):
+            shutil.copyfile(backup_dir + '/' + filename, restore_dir + '/' + filename)
+    output_filename = str(incremental / 'individuals.csv')
+    assert ccb_backup_delta.reconstruct_csv(restore_dir, 'individuals', None, output_filename) == get_stamp(2)
+    assert os.path.getsize(output_filename) == 0
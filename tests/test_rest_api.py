@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from util import util
+
+REST_API_INI = '''
+    [ccb_rest_api]
+    requests_per_minute = {requests_per_minute}
+    burst = {burst}
+    state_filename = {tmp_path}/state.json
+    '''
+
+
+def rest_api_ini(requests_per_minute, burst):
+    return pytest.mark.ini(REST_API_INI.replace('{requests_per_minute}', str(requests_per_minute)).replace('{burst}',
+        str(burst)))
+
+
+@pytest.fixture(autouse=True)
+def state_accesses(monkeypatch):
+    # Starts each test with a fresh rate limiter in this process. Returns list of times the shared state was accessed
+    monkeypatch.setattr(util, '_rest_api_state', None)
+    monkeypatch.setattr(util, '_rest_api_lease', {'tokens': 0.0, 'resume_time': 0.0})
+    monkeypatch.setattr(util, '_rest_api_metrics', None)
+    monkeypatch.setattr(util, '_rest_api_unsaved_totals', {})
+    state_accesses = []
+    rest_api_state = util.rest_api_state
+    monkeypatch.setattr(util, 'rest_api_state', lambda: state_accesses.append(time.time()) or rest_api_state())
+    return state_accesses
+
+
+@rest_api_ini(0, 10)
+def test_tokens_are_leased_in_batches(state_accesses):
+    for i in range(100):
+        util.acquire_rest_api_token()
+    assert len(state_accesses) == 10
+    assert util.get_rest_api_metrics()['requests'] == 100
+    assert util.get_rest_api_metrics(totals=True)['requests'] == 100
+
+
+@rest_api_ini(1200, 5)
+def test_threads_share_rate_limit():
+    start_time = time.time()
+    threads = [threading.Thread(target=lambda: [util.acquire_rest_api_token() for i in range(10)]) for j in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The first 5 calls are a burst, then the other 25 come at 20 per second
+    assert time.time() - start_time >= 25 / 20 * 0.9
+    assert util.get_rest_api_metrics()['requests'] == 30
+
+
+@rest_api_ini(0, 2)
+def test_pause_requested_by_other_process_is_honored_at_next_lease():
+    util.acquire_rest_api_token()
+    with util.rest_api_state() as state:
+        state['resume_time'] = time.time() + 0.5
+    start_time = time.time()
+    util.acquire_rest_api_token()
+    assert time.time() - start_time < 0.1
+    util.acquire_rest_api_token()
+    assert time.time() - start_time >= 0.45
+
+
+@rest_api_ini(0, 10)
+def test_own_pause_is_honored_at_once():
+    util.acquire_rest_api_token()
+    util.request_rest_api_pause(0.5)
+    start_time = time.time()
+    util.acquire_rest_api_token()
+    assert time.time() - start_time >= 0.45
+
+
+@rest_api_ini(0, 10)
+def test_metrics_of_exiting_process_are_totaled(tmp_path, repo_directory):
+    util.acquire_rest_api_token()
+    env = dict(os.environ, CCB_BACKUP_CCB_REST_API_REQUESTS_PER_MINUTE='0', CCB_BACKUP_CCB_REST_API_BURST='10',
+        CCB_BACKUP_CCB_REST_API_STATE_FILENAME=str(tmp_path / 'state.json'))
+    code = 'from util import util\nfor i in range(3):\n    util.acquire_rest_api_token()\n' \
+        'util.add_rest_api_metrics({"retries": 2})\n'
+    subprocess.check_call([sys.executable, '-c', code], env=env, cwd=repo_directory)
+    totals = util.get_rest_api_metrics(totals=True)
+    assert totals['requests'] == 4
+    assert totals['retries'] == 2
@@ -0,0 +1,75 @@
+import datetime
+
+import pytest
+
+import ccb_backup
+
+BACKUP_DATETIMES = [datetime.datetime(2020, 1, day, 3, 0, 0) for day in range(1, 6)]
+
+
+def make_files():
+    # Newest backup has the oldest LastModified and vice versa, as after re-uploading or restoring old objects
+    return [ccb_backup.S3Object('daily/' + x.strftime('%Y%m%d%H%M%S') + '.zip',
+        datetime.datetime(2021, 1, 1) - datetime.timedelta(days=i), 100, x) for i, x in enumerate(BACKUP_DATETIMES)]
+
+
+@pytest.mark.parametrize('num_files_to_keep, do_backup, num_deleted', [
+    (7, True, 0),
+    (7, False, 0),
+    (6, True, 0),
+    (6, False, 0),
+    (5, True, 1),
+    (5, False, 0),
+    (4, True, 2),
+    (4, False, 1),
+    (1, True, 5),
+    (1, False, 4),
+    (0, True, 0),
+    (0, False, 0)
+])
+def test_get_files_to_delete_deletes_oldest_backups(num_files_to_keep, do_backup, num_deleted):
+    files = make_files()
+    files_to_delete = ccb_backup.get_files_to_delete(list(reversed(files)), num_files_to_keep, do_backup)
+    assert files_to_delete == files[:num_deleted]
+
+
+def test_get_files_to_delete_with_no_files():
+    assert ccb_backup.get_files_to_delete([], 3, True) == []
+    assert ccb_backup.get_files_to_delete([], 3, False) == []
+
+
+@pytest.mark.parametrize('num_files_to_keep, do_backup, num_remaining', [
+    (3, True, 2),
+    (3, False, 3),
+    (5, True, 4),
+    (5, False, 5),
+    (0, True, 5)
+])
+def test_retention_after_reupload_of_oldest_backup(s3_bucket, num_files_to_keep, do_backup, num_remaining):
+    keys = ['daily/' + x.strftime('%Y%m%d%H%M%S') + '.zip' for x in BACKUP_DATETIMES]
+    for key in keys:
+        s3_bucket.put_object(Bucket='bkt', Key=key, Body=b'zip')
+    # Re-uploading the oldest backup makes it the most recently modified object in the folder
+    s3_bucket.put_object(Bucket='bkt', Key=keys[0], Body=b'zip')
+
+    files = ccb_backup.list_s3_folder(ccb_backup.get_s3_client(), 'daily')
+    ccb_backup.delete_from_s3(ccb_backup.get_files_to_delete(files, num_files_to_keep, do_backup))
+
+    remaining_keys = [x['Key'] for x in s3_bucket.list_objects_v2(Bucket='bkt')['Contents']]
+    assert sorted(remaining_keys) == keys[len(keys) - num_remaining:]
+
+
+@pytest.mark.ini('''
+    [schedules]
+    schedule1=daily,1d,7
+    ''')
+@pytest.mark.parametrize('backup_age_hours, do_backup', [(2, False), (30, True)])
+def test_backup_due_by_backup_datetime_not_last_modified(s3_bucket, monkeypatch, backup_age_hours, do_backup):
+    monkeypatch.setattr(ccb_backup.g.args, 'incremental', False, raising=False)
+    monkeypatch.setattr(ccb_backup.g, 's3_catalog', None)
+    backup_datetime = datetime.datetime.now() - datetime.timedelta(hours=backup_age_hours)
+    # Just (re-)uploaded, so its LastModified is now whatever its age
+    s3_bucket.put_object(Bucket='bkt', Key='daily/' + backup_datetime.strftime('%Y%m%d%H%M%S') + '.zip', Body=b'zip')
+
+    backups_to_do = ccb_backup.get_backups_to_do()
+    assert (backups_to_do is not None and backups_to_do['daily']['do_backup']) == do_backup
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+import ccb_backup
+
+MB = 1024 * 1024
+
+
+pytestmark = pytest.mark.ini('''
+    [s3_upload]
+    multipart_threshold_mb = 5
+    part_size_mb = 5
+    max_concurrency = 1
+    part_retries = 0
+    state_filename = {tmp_path}/state/s3_upload_state.json
+    ''')
+
+
+@pytest.fixture
+def s3_upload(s3_bucket, monkeypatch):
+    monkeypatch.setattr(ccb_backup.g, 'reuse_output_filename', None)
+    monkeypatch.setattr(ccb_backup.g, 'file_checksums', {})
+    monkeypatch.setattr(ccb_backup.g, 'incremental_manifest', None)
+    return s3_bucket
+
+
+def write_zip_file(tmp_path, num_bytes, seed):
+    filename = str(tmp_path / ('backup_' + str(seed) + '.zip'))
+    with open(filename, 'wb') as output_file:
+        output_file.write(bytes([(seed + i) % 251 for i in range(251)]) * (num_bytes // 251) +
+            bytes(num_bytes % 251))
+    return filename
+
+
+def record_parts(monkeypatch, s3_client, failing_part_number=None):
+    # Makes uploads of part failing_part_number (if any) fail. Returns the list of part numbers sent to S3
+    part_numbers = []
+    upload_part = s3_client.upload_part
+
+    def fake_upload_part(**kwargs):
+        part_numbers.append(kwargs['PartNumber'])
+        if kwargs['PartNumber'] == failing_part_number:
+            raise ConnectionError('Connection reset')
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3_client, 'upload_part', fake_upload_part)
+    return part_numbers
+
+
+def new_run(monkeypatch):
+    monkeypatch.setattr(ccb_backup.g, 'reuse_output_filename', None)
+
+
+def test_multipart_upload_is_verified(s3_upload, tmp_path):
+    filename = write_zip_file(tmp_path, 12 * MB, 1)
+    s3_key = ccb_backup.upload_to_s3('daily', filename)
+    response = s3_upload.head_object(Bucket='bkt', Key=s3_key)
+    assert response['ETag'].strip('"').endswith('-3')
+    assert response['Metadata']['sha256'] == ccb_backup.get_file_md5_and_sha256(filename)[1]
+    assert ccb_backup.load_s3_upload_state(str(tmp_path / 'state/s3_upload_state.json')) == {}
+
+
+def test_failed_part_is_resumed(s3_upload, tmp_path, monkeypatch):
+    filename = write_zip_file(tmp_path, 12 * MB, 1)
+    s3_client = ccb_backup.get_s3_client()
+    with monkeypatch.context() as m:
+        record_parts(m, s3_client, 2)
+        with pytest.raises(ConnectionError):
+            ccb_backup.upload_to_s3('daily', filename)
+    failed_s3_key = 'daily/' + ccb_backup.g.reuse_output_filename
+
+    # Next run rebuilds a ZIP file with the same contents, and only sends the parts S3 doesn't have
+    new_run(monkeypatch)
+    os.utime(filename, (0, 0))
+    part_numbers = record_parts(monkeypatch, s3_client)
+    assert ccb_backup.upload_to_s3('daily', filename) == failed_s3_key
+    assert 1 not in part_numbers and 2 in part_numbers
+    assert s3_upload.head_object(Bucket='bkt', Key=failed_s3_key)['ContentLength'] == 12 * MB
+    assert s3_upload.list_multipart_uploads(Bucket='bkt').get('Uploads', []) == []
+
+
+def test_failed_upload_of_other_contents_is_aborted(s3_upload, tmp_path, monkeypatch):
+    s3_client = ccb_backup.get_s3_client()
+    with monkeypatch.context() as m:
+        record_parts(m, s3_client, 2)
+        with pytest.raises(ConnectionError):
+            ccb_backup.upload_to_s3('daily', write_zip_file(tmp_path, 12 * MB, 1))
+    assert len(s3_upload.list_multipart_uploads(Bucket='bkt').get('Uploads', [])) == 1
+
+    new_run(monkeypatch)
+    ccb_backup.upload_to_s3('daily', write_zip_file(tmp_path, 6 * MB, 2))
+    assert s3_upload.list_multipart_uploads(Bucket='bkt').get('Uploads', []) == []
+    assert ccb_backup.load_s3_upload_state(str(tmp_path / 'state/s3_upload_state.json')) == {}
+
+
+def test_etag_mismatch_fails_upload(s3_upload, tmp_path, monkeypatch):
+    s3_client = ccb_backup.get_s3_client()
+    upload_part = s3_client.upload_part
+    monkeypatch.setattr(s3_client, 'upload_part', lambda **kwargs: dict(upload_part(**kwargs), ETag='"0"'))
+    with pytest.raises(Exception, match='Checksum mismatch'):
+        ccb_backup.upload_to_s3('daily', write_zip_file(tmp_path, 12 * MB, 1))
+
+
+def test_sha256_mismatch_fails_verify(s3_upload, tmp_path):
+    filename = write_zip_file(tmp_path, 1 * MB, 1)
+    s3_key = ccb_backup.upload_to_s3('daily', filename)
+    ccb_backup.verify_s3_upload(s3_upload, s3_key, filename)
+    with open(filename, 'r+b') as output_file:
+        output_file.write(b'x')
+    with pytest.raises(Exception, match='does not match'):
+        ccb_backup.verify_s3_upload(s3_upload, s3_key, filename)
+
+
+def test_copy_is_verified(s3_upload, tmp_path):
+    filename = write_zip_file(tmp_path, 1 * MB, 1)
+    source_s3_key = ccb_backup.upload_to_s3('daily', filename)
+    s3_key = ccb_backup.copy_in_s3(source_s3_key, 'weekly', filename)
+    assert s3_key == 'weekly/' + ccb_backup.g.reuse_output_filename
+    assert s3_upload.head_object(Bucket='bkt', Key=s3_key)['Metadata']['sha256'] == \
+        ccb_backup.get_file_md5_and_sha256(filename)[1]
+
+
+def test_multipart_copy_is_verified(s3_upload, tmp_path):
+    # Used for objects over 5 GB, in parts copied server-side by UploadPartCopy
+    filename = write_zip_file(tmp_path, 12 * MB, 1)
+    source_s3_key = ccb_backup.upload_to_s3('daily', filename)
+    copy_source = {'Bucket': 'bkt', 'Key': source_s3_key}
+    ccb_backup.copy_multipart_in_s3(ccb_backup.get_s3_client(), copy_source, 'monthly/copy.zip', filename,
+        ccb_backup.get_s3_upload_settings())
+    ccb_backup.verify_s3_upload(s3_upload, 'monthly/copy.zip', filename)
+    with open(filename, 'rb') as input_file:
+        assert s3_upload.get_object(Bucket='bkt', Key='monthly/copy.zip')['Body'].read() == input_file.read()
+    assert s3_upload.head_object(Bucket='bkt', Key='monthly/copy.zip')['ETag'].strip('"').endswith('-3')
+
+
+def test_failed_multipart_copy_is_aborted(s3_upload, tmp_path):
+    filename = write_zip_file(tmp_path, 12 * MB, 1)
+    copy_source = {'Bucket': 'bkt', 'Key': 'daily/missing.zip'}
+    with pytest.raises(Exception):
+        ccb_backup.copy_multipart_in_s3(ccb_backup.get_s3_client(), copy_source, 'monthly/copy.zip', filename,
+            ccb_backup.get_s3_upload_settings())
+    assert s3_upload.list_multipart_uploads(Bucket='bkt').get('Uploads', []) == []
@@ -0,0 +1,119 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ccb_backup_store
+
+PASSWORD = 'store password'
+
+
+def make_csv(num_rows, inserted_row=None):
+    rows = [b'id,name,email\n'] + [b'%d,Person %d,person%d@example.com\n' % (i, i, i) for i in range(num_rows)]
+    if inserted_row is not None:
+        rows.insert(num_rows // 2, inserted_row)
+    return b''.join(rows)
+
+
+def test_runner_does_not_import_store_until_used():
+    # ansible_vault isn't needed to check what importing the runner pulls in
+    code = "import sys, types; sys.modules['ansible_vault'] = types.SimpleNamespace(Vault=None); " \
+        "import ccb_backup_runner; print('Cryptodome' in sys.modules, 'ccb_backup_store' in sys.modules)"
+    output = subprocess.check_output([sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.split() == [b'False', b'False']
+
+
+def test_chunks_rejoin_to_input_within_size_limits():
+    data = make_csv(100000) + b'x' * (3 * ccb_backup_store.MAX_CHUNK_SIZE) + b'\nlast line without newline'
+    chunks = list(ccb_backup_store.get_chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert len(chunks) > 10
+    assert all([len(x) <= ccb_backup_store.MAX_CHUNK_SIZE for x in chunks])
+    assert all([len(x) >= ccb_backup_store.MIN_CHUNK_SIZE for x in chunks[:-1]])
+
+
+def test_inserted_row_only_changes_nearby_chunks():
+    chunks = set(ccb_backup_store.get_chunks(io.BytesIO(make_csv(100000))))
+    changed_chunks = set(ccb_backup_store.get_chunks(io.BytesIO(make_csv(100000, b'new,New Person,new@x.com\n'))))
+    assert len(changed_chunks - chunks) <= 2
+    assert len(chunks - changed_chunks) <= 2
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ccb_backup_store.open_store(str(tmp_path), PASSWORD)
+
+
+def test_blob_round_trip_and_tamper_detection(store):
+    blob = ccb_backup_store.encrypt_blob(store, b'secret data')
+    assert b'secret data' not in blob
+    assert ccb_backup_store.decrypt_blob(store, blob) == b'secret data'
+    with pytest.raises(ValueError):
+        ccb_backup_store.decrypt_blob(store, blob[:-1] + bytes([blob[-1] ^ 1]))
+
+
+def test_reopen_store_checks_password(tmp_path, store):
+    reopened_store = ccb_backup_store.open_store(str(tmp_path), PASSWORD)
+    assert reopened_store['encryption_key'] == store['encryption_key']
+    with pytest.raises(Exception, match='Wrong password'):
+        ccb_backup_store.open_store(str(tmp_path), 'wrong password')
+
+
+def write_source_dir(path, files):
+    os.makedirs(path)
+    for name, data in files.items():
+        with open(os.path.join(path, name), 'wb') as output_file:
+            output_file.write(data)
+    return str(path)
+
+
+def read_dir(path):
+    files = {}
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as input_file:
+            files[name] = input_file.read()
+    return files
+
+
+def test_snapshots_dedup_restore_and_delete(tmp_path, store):
+    first_files = {'individuals.csv': make_csv(100000), 'groups.csv': b'id,name\n1,Choir\n', 'empty.csv': b''}
+    second_files = dict(first_files, **{'individuals.csv': make_csv(100000, b'new,New Person,new@x.com\n')})
+    first_snapshot = str(tmp_path / '20240101000000.snapshot')
+    second_snapshot = str(tmp_path / '20240102000000.snapshot')
+
+    first_stats = ccb_backup_store.write_snapshot(store, first_snapshot, write_source_dir(tmp_path / 'first',
+        first_files))
+    second_stats = ccb_backup_store.write_snapshot(store, second_snapshot, write_source_dir(tmp_path / 'second',
+        second_files))
+    assert first_stats['files'] == 3
+    assert first_stats['new_chunks'] == first_stats['chunks']
+    assert second_stats['new_chunks'] <= 2
+    assert second_stats['new_bytes'] < second_stats['bytes'] / 10
+
+    ccb_backup_store.restore_snapshot(store, first_snapshot, str(tmp_path / 'restored_first'))
+    assert read_dir(tmp_path / 'restored_first') == first_files
+
+    # Once the first snapshot is gone, only its chunks the second snapshot doesn't share are deleted
+    os.remove(first_snapshot)
+    num_deleted, bytes_deleted = ccb_backup_store.delete_unreferenced_chunks(store, [second_snapshot])
+    assert 1 <= num_deleted <= 2
+    assert bytes_deleted > 0
+    ccb_backup_store.restore_snapshot(store, second_snapshot, str(tmp_path / 'restored_second'))
+    assert read_dir(tmp_path / 'restored_second') == second_files
+
+
+def test_restore_detects_corrupt_chunk(tmp_path, store):
+    snapshot = str(tmp_path / '20240101000000.snapshot')
+    ccb_backup_store.write_snapshot(store, snapshot, write_source_dir(tmp_path / 'source', {'a.csv': make_csv(10)}))
+    chunk_filename = ccb_backup_store.get_chunk_filename(store,
+        ccb_backup_store.read_manifest(store, snapshot)['files'][0]['chunks'][0])
+    with open(chunk_filename, 'r+b') as chunk_file:
+        chunk_file.seek(-1, os.SEEK_END)
+        last_byte = chunk_file.read(1)
+        chunk_file.seek(-1, os.SEEK_END)
+        chunk_file.write(bytes([last_byte[0] ^ 1]))
+    with pytest.raises(ValueError):
+        ccb_backup_store.restore_snapshot(store, snapshot, str(tmp_path / 'restored'))
@@ -0,0 +1,139 @@
+import datetime
+import json
+import time
+
+import pytest
+
+import get_transactions
+from util import util
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.encoding = None
+        self.text = text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in range(0, len(self.text), chunk_size):
+            yield self.text[i:i + chunk_size]
+
+
+pytestmark = pytest.mark.ini('''
+    [ccb_rest_api]
+    max_retries = 2
+    backoff_base_seconds = 0
+    ''')
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+
+
+def fake_report_php(monkeypatch, respond):
+    # Replaces CCB's report.php with respond(start_date, end_date), which returns status or (status, text). Returns
+    # list of windows requested
+    windows = []
+
+    def fake_post(http_session, ccb_subdomain, page, data=None, **kwargs):
+        report_info = json.loads(data['request'])
+        window = (report_info['start_date'], report_info['end_date'])
+        windows.append(window)
+        response = respond(*window)
+        if isinstance(response, tuple):
+            return FakeResponse(*response)
+        return FakeResponse(response, 'Name,Campus,Amount\nA,Main,' + window[0] + '\n' if response == 200 else '')
+    monkeypatch.setattr(util, 'ccb_ui_post', fake_post)
+    return windows
+
+
+def retrieve(tmp_path, days):
+    start_date = datetime.date(2020, 1, 1)
+    return get_transactions.retrieve_transaction_window(None, 'church', start_date,
+        start_date + datetime.timedelta(days=days - 1), str(tmp_path))
+
+
+def test_server_error_is_retried_without_splitting(monkeypatch, tmp_path):
+    windows = fake_report_php(monkeypatch, lambda start_date, end_date: 503)
+    with pytest.raises(SystemExit):
+        retrieve(tmp_path, 8)
+    assert windows == [('01/01/2020', '01/08/2020')] * 3
+
+
+def test_server_error_recovers_after_retry(monkeypatch, tmp_path):
+    statuses = [500, 200]
+    windows = fake_report_php(monkeypatch, lambda start_date, end_date: statuses.pop(0))
+    assert len(retrieve(tmp_path, 8)) == 1
+    assert windows == [('01/01/2020', '01/08/2020')] * 2
+
+
+def test_gateway_timeout_splits_window(monkeypatch, tmp_path):
+    windows = fake_report_php(monkeypatch, lambda start_date, end_date: 200 if start_date == end_date else 504)
+    report_filenames = retrieve(tmp_path, 4)
+    assert len(report_filenames) == 4
+    assert windows[0] == ('01/01/2020', '01/04/2020')
+    assert len(windows) == 7
+
+
+@pytest.mark.parametrize('response', [404, (200, '<html><body>Please log in</body></html>')])
+def test_bad_response_ends_run(monkeypatch, tmp_path, response):
+    fake_report_php(monkeypatch, lambda start_date, end_date: response)
+    with pytest.raises(SystemExit):
+        retrieve(tmp_path, 8)
+
+
+def test_empty_window_has_no_reports(monkeypatch, tmp_path):
+    fake_report_php(monkeypatch, lambda start_date, end_date: (200, ''))
+    assert retrieve(tmp_path, 8) == []
+
+
+def get_year_report(year, num_rows):
+    return 'Name,Campus,Amount\n' + ''.join(['A,Main,' + str(year) + '-' + str(i) + '\n' for i in range(num_rows)])
+
+
+@pytest.mark.ini('''
+    [ccb_rest_api]
+    max_retries = 0
+
+    [transactions_cache]
+    directory = {tmp_path}/cache
+    reverify_days = 30
+    grace_days = 0
+
+    [checkpoints]
+    directory = {tmp_path}/checkpoints
+    ''')
+@pytest.mark.parametrize('bad_year_response', [404, (200, '<html>Error</html>'), (200, get_year_report(2015, 2))])
+def test_failed_or_shrunken_year_does_not_replace_cache(monkeypatch, tmp_path, bad_year_response):
+    # Every closed year is cached but due to be verified against CCB again
+    fake_report_php(monkeypatch, lambda start_date, end_date: (200, get_year_report(start_date[-4:], 5)))
+    output_filename = str(tmp_path / 'transactions.csv')
+    get_transactions.collect_transactions(None, 'church', output_filename, 1)
+    cache_index = get_transactions.load_transactions_cache_index(str(tmp_path / 'cache'))
+    for year_str in cache_index:
+        cache_index[year_str]['verified'] = 0
+    get_transactions.save_transactions_cache_index(str(tmp_path / 'cache'), cache_index)
+    with open(get_transactions.get_cached_year_filename(str(tmp_path / 'cache'), 2015)) as cached_year_file:
+        cached_year = cached_year_file.read()
+
+    fake_report_php(monkeypatch, lambda start_date, end_date: bad_year_response if start_date.endswith('2015') else
+        (200, get_year_report(start_date[-4:], 5)))
+    if bad_year_response in [404, (200, '<html>Error</html>')]:
+        with pytest.raises(SystemExit):
+            get_transactions.collect_transactions(None, 'church', output_filename, 1, resume=True)
+        # Nothing for the failed year was checkpointed to be resumed from
+        journal = util.open_checkpoint_journal('get_transactions', True)
+        assert util.get_checkpoint(journal, '2015') is None
+        util.close_checkpoint_journal(journal)
+    else:
+        get_transactions.collect_transactions(None, 'church', output_filename, 1)
+    with open(get_transactions.get_cached_year_filename(str(tmp_path / 'cache'), 2015)) as cached_year_file:
+        assert cached_year_file.read() == cached_year
+    assert get_transactions.load_transactions_cache_index(str(tmp_path / 'cache'))['2015']['verified'] == 0
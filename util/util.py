@@ -8,9 +8,52 @@ import sys
 import re
 import requests
 import tempfile
+import shutil
 from xml.etree import ElementTree
 import socket
 import time
+import threading
+import json
+import contextlib
+import types
+import csv
+import itertools
+import random
+import math
+import atexit
+import hashlib
+try:
+    import fcntl
+except ImportError: # Not available on Windows, where the session cache is then simply not locked
+    fcntl = None
+
+
+# CCB rate limits REST API calls per API user, not per connection, so every thread issuing them draws from one token
+# bucket and honors one pause (HTTP 429 with Retry-After). When [ccb_rest_api]state_filename is set, the bucket lives
+# in that file so that the get_*.py processes of one backup share it too (see rest_api_state()). Each process leases
+# tokens from it in batches and keeps its metrics until it next touches the file, so most calls need no file access
+_rest_api_lock = threading.RLock()
+_rest_api_state = None
+_rest_api_lease = {'tokens': 0.0, 'resume_time': 0.0}
+_rest_api_metrics = None
+_rest_api_unsaved_totals = {}
+
+# Checkpoint journals open in this process, closed (and so synced to disk) at exit if their run doesn't finish
+_checkpoint_journals = []
+_checkpoint_journals_lock = threading.Lock()
+REST_API_METRIC_NAMES = ['requests', 'throttled_seconds', 'retries', 'backoff_seconds', 'http_429', 'http_5xx',
+    'connection_errors']
+
+# Parsed ccb_backup.ini, shared by everything in the process (see get_config())
+_config_lock = threading.Lock()
+_config_parser = None
+_config_mtime = None
+
+# Serializes re-logins when threads sharing one CCB UI session all find it expired at once
+_ui_login_lock = threading.Lock()
+
+# Size of the pieces CCB UI report exports are read and decoded in, so a report is never held in memory whole
+REPORT_CHUNK_SIZE = 64 * 1024
 
 
 def sys_exit(level=0):
@@ -60,18 +103,45 @@ def test_write(filename):
         os.remove(filename)
 
 
-def get_ini_setting(section, option, none_allowable=True):
-    config_file_path = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../ccb_backup.ini')
+def get_config_file_path():
+    return os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../ccb_backup.ini')
+
+
+def get_config():
+    global _config_parser, _config_mtime
+
+    config_file_path = get_config_file_path()
     if not os.path.isfile(config_file_path):
         logging.error("Required ini file '" + config_file_path + "' is missing. Clone file 'ccb_backup__sample.ini' " +
             "to create file 'ccb_backup.ini'")
         sys.exit(1)
-    config_parser = configparser.ConfigParser()
-    config_parser.read(config_file_path)
-    try:
-        ret_val = config_parser.get(section, option).strip()
-    except:
-        ret_val = None
+
+    # Parse ccb_backup.ini once per process and only parse it again if it is edited while we're running
+    with _config_lock:
+        config_mtime = os.path.getmtime(config_file_path)
+        if _config_parser is None or config_mtime != _config_mtime:
+            config_parser = configparser.ConfigParser()
+            try:
+                config_parser.read(config_file_path)
+            except configparser.Error as e:
+                logging.error("Ini file '" + config_file_path + "' is invalid: " + str(e).replace('\n', ' '))
+                sys.exit(1)
+            _config_parser = config_parser
+            _config_mtime = config_mtime
+        return _config_parser
+
+
+def get_ini_setting(section, option, none_allowable=True):
+    # Environment variable CCB_BACKUP_<SECTION>_<OPTION> (e.g. CCB_BACKUP_CCB_API_PASSWORD) overrides ccb_backup.ini
+    env_var_name = 'CCB_BACKUP_' + section.upper() + '_' + option.upper()
+    if env_var_name in os.environ:
+        ret_val = os.environ[env_var_name].strip()
+    else:
+        config_parser = get_config()
+        try:
+            ret_val = config_parser.get(section, option).strip()
+        except:
+            ret_val = None
     if ret_val == '':
         ret_val = None
     if not none_allowable and ret_val == None:
@@ -81,6 +151,32 @@ def get_ini_setting(section, option, none_allowable=True):
     return ret_val
 
 
+def get_ini_setting_int(section, option, default=None, min_value=None):
+    value_str = get_ini_setting(section, option, default is not None)
+    if value_str is None:
+        return default
+    try:
+        value = int(value_str)
+    except ValueError:
+        value = None
+    if value is None or (min_value is not None and value < min_value):
+        if min_value is not None:
+            logging.error("Setting in ccb_backup.ini '[" + section + ']' + option + "' must be an integer of at " +
+                "least " + str(min_value))
+        else:
+            logging.error("Setting in ccb_backup.ini '[" + section + ']' + option + "' must be an integer")
+        sys.exit(1)
+    return value
+
+
+def get_ini_section_items(section):
+    config_parser = get_config()
+    if not config_parser.has_section(section):
+        logging.error("Required section in ccb_backup.ini '[" + section + "]' is missing")
+        sys.exit(1)
+    return config_parser.items(section)
+
+
 def send_email(recipient, subject, body):
     import smtplib
 
@@ -133,62 +229,619 @@ def login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password):
         sys.exit(1)
 
 
-def ccb_rest_xml_to_temp_file(ccb_subdomain, ccb_rest_service_string, ccb_api_username, ccb_api_password, retry_num=0):
-    logging.info('Retrieving ' + ccb_rest_service_string + ' from CCB REST API')
-    response = requests.get('https://' + ccb_subdomain + '.ccbchurch.com/api.php?srv=' + ccb_rest_service_string,
-        stream=True, auth=(ccb_api_username, ccb_api_password))
-    if response.status_code == 200:
-        response.raw.decode_content = True
-        with tempfile.NamedTemporaryFile(delete=False) as temp:
-            input_filename = temp.name
+def get_ccb_ui_session(ccb_subdomain, ccb_app_username, ccb_app_password):
+    # Returns a requests.Session logged in to CCB UI. Login cookies are cached in the [ccb_session] cache file so
+    # that the get_*.py utilities making up one backup (and backups soon after) log in once rather than each time
+    http_session = requests.Session()
+    http_session.ccb_app_credentials = (ccb_subdomain, ccb_app_username, ccb_app_password)
+    cache_filename = get_ini_setting('ccb_session', 'cache_filename')
+    if cache_filename is None:
+        logging.info('Logging in to CCB UI session for ' + ccb_app_username)
+        login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
+        return http_session
+    if not os.path.isabs(cache_filename):
+        cache_filename = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../' + cache_filename)
+    http_session.ccb_session_cache_filename = cache_filename
+    with lock_file(cache_filename + '.lock'):
+        if load_session_cookies(http_session, cache_filename, ccb_subdomain, ccb_app_username):
+            logging.info('Reusing cached CCB UI session for ' + ccb_app_username)
+        else:
+            logging.info('Logging in to CCB UI session for ' + ccb_app_username)
+            login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
+            save_session_cookies(http_session, cache_filename, ccb_subdomain, ccb_app_username)
+    return http_session
+
+
+def load_session_cookies(http_session, cache_filename, ccb_subdomain, ccb_app_username):
+    if not os.path.isfile(cache_filename):
+        return False
+    try:
+        with open(cache_filename, 'r') as cache_file:
+            session_cache = json.load(cache_file)
+    except ValueError:
+        return False
+    if session_cache.get('subdomain') != ccb_subdomain or session_cache.get('username') != ccb_app_username or \
+        session_cache.get('expires', 0) < time.time():
+        return False
+    http_session.cookies.update(requests.utils.cookiejar_from_dict(session_cache['cookies']))
+    return True
+
+
+def save_session_cookies(http_session, cache_filename, ccb_subdomain, ccb_app_username):
+    expiry_minutes = get_ini_setting_int('ccb_session', 'expiry_minutes', 60, 1)
+    session_cache = {
+        'subdomain': ccb_subdomain,
+        'username': ccb_app_username,
+        'expires': time.time() + expiry_minutes * 60,
+        'cookies': requests.utils.dict_from_cookiejar(http_session.cookies)
+    }
+
+    # Login cookies are as good as the password, so only the owner may read them
+    cache_directory = os.path.dirname(cache_filename)
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    temp_filename = cache_filename + '.tmp'
+    with os.fdopen(os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+        json.dump(session_cache, cache_file)
+    os.chmod(temp_filename, 0o600)
+    os.replace(temp_filename, cache_filename)
+
+
+@contextlib.contextmanager
+def lock_file(lock_filename):
+    # Exclusive lock between processes for as long as the 'with' block runs
+    if fcntl is None:
+        yield
+        return
+    lock_directory = os.path.dirname(os.path.abspath(lock_filename))
+    if not os.path.isdir(lock_directory):
+        os.makedirs(lock_directory)
+    with open(lock_filename, 'a') as lock_file_handle:
+        fcntl.flock(lock_file_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file_handle, fcntl.LOCK_UN)
+
+
+def open_checkpoint_journal(name, resume, context=None):
+    # Returns journal of the units of work (e.g. attendance occurrences) that name (e.g. 'get_attendance') completes,
+    # kept under [checkpoints]directory so that a run dying partway through can be resumed without redoing them. If
+    # resume is True, units completed by the last run are kept, unless that run's context (whatever else determines
+    # its results, e.g. date range) differs or it is more than [checkpoints]max_age_hours old. Returns None if
+    # checkpoints are disabled
+    checkpoint_directory = get_ini_setting('checkpoints', 'directory')
+    if checkpoint_directory is None:
+        return None
+    if not os.path.isabs(checkpoint_directory):
+        checkpoint_directory = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../' +
+            checkpoint_directory)
+    max_age_hours = get_ini_setting_int('checkpoints', 'max_age_hours', 24, 1)
+    journal = {'name': name, 'directory': checkpoint_directory + '/' + name, 'units': {}, 'lock': threading.Lock(),
+        'sync_seconds': get_ini_setting_int('checkpoints', 'sync_seconds', 5, 0)}
+    journal['filename'] = journal['directory'] + '/journal.jsonl'
+    header = {'context': context, 'created': time.time()}
+    if resume and os.path.isfile(journal['filename']):
+        previous_header = {'context': None, 'created': 0}
+        with open(journal['filename'], 'r', encoding='utf-8') as journal_file:
+            try:
+                previous_header = json.loads(journal_file.readline())
+                for line in journal_file:
+                    checkpoint = json.loads(line)
+                    journal['units'][checkpoint['unit']] = checkpoint['entry']
+            except ValueError:
+                pass # Last line was cut short by the interruption
+        # A system crash can leave a unit's files cut short even though its journal line made it to disk
+        for unit in [x for x in journal['units'] if not are_checkpoint_files_intact(journal, journal['units'][x])]:
+            logging.warning('Not resuming ' + name + ' unit ' + unit + ', whose files are missing or incomplete')
+            del journal['units'][unit]
+        if previous_header.get('context') != context:
+            logging.warning('Not resuming ' + name + ' from checkpoints of a run with different settings')
+            journal['units'] = {}
+        elif previous_header['created'] < time.time() - max_age_hours * 3600:
+            logging.warning('Not resuming ' + name + ' from checkpoints more than ' + str(max_age_hours) +
+                ' hours old')
+            journal['units'] = {}
+        else:
+            header = previous_header
+            logging.info('Resuming ' + name + ' with ' + str(len(journal['units'])) + ' units of work completed ' +
+                'by an interrupted earlier run')
+    if len(journal['units']) == 0:
+        shutil.rmtree(journal['directory'], ignore_errors=True)
+        os.makedirs(journal['directory'])
+
+    # Rewritten whole, so a line cut short is dropped before more are appended
+    with open(journal['filename'] + '.tmp', 'w', encoding='utf-8') as journal_file:
+        journal_file.write(json.dumps(header) + '\n')
+        for unit, entry in journal['units'].items():
+            journal_file.write(json.dumps({'unit': unit, 'entry': entry}) + '\n')
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(journal['filename'] + '.tmp', journal['filename'])
+    journal['file'] = open(journal['filename'], 'a', encoding='utf-8')
+    journal['synced'] = time.time()
+    with _checkpoint_journals_lock:
+        _checkpoint_journals.append(journal)
+    return journal
+
+
+def get_checkpoint(journal, unit):
+    # Returns entry add_checkpoint() recorded for unit, or None if unit is yet to be done
+    if journal is None:
+        return None
+    with journal['lock']:
+        return journal['units'].get(unit)
+
+
+def add_checkpoint(journal, unit, entry):
+    # Records unit (a str) as completed, with entry (e.g. its rows, or 'filenames' of its files in
+    # journal['directory'], whose SHA-256s are recorded too so that resuming can tell they are intact). The journal
+    # is handed to the OS before this returns, so it survives the process being killed. It is synced to disk
+    # (surviving a system crash too) at most every [checkpoints]sync_seconds, and when the process exits
+    if journal is None:
+        return
+    if 'filenames' in entry:
+        entry = dict(entry, sha256s=[get_file_sha256(journal['directory'] + '/' + x) for x in entry['filenames']])
+    with journal['lock']:
+        journal['units'][unit] = entry
+        journal['file'].write(json.dumps({'unit': unit, 'entry': entry}) + '\n')
+        journal['file'].flush()
+        if time.time() - journal['synced'] >= journal['sync_seconds']:
+            os.fsync(journal['file'].fileno())
+            journal['synced'] = time.time()
+
+
+def are_checkpoint_files_intact(journal, entry):
+    if 'filenames' not in entry:
+        return True
+    for filename, sha256 in zip(entry['filenames'], entry.get('sha256s', [None] * len(entry['filenames']))):
+        filename = journal['directory'] + '/' + filename
+        if not os.path.isfile(filename) or get_file_sha256(filename) != sha256:
+            return False
+    return True
+
+
+def get_file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def close_checkpoint_journal(journal, sync=True):
+    if journal is None:
+        return
+    with journal['lock']:
+        if not journal['file'].closed:
+            if sync:
+                journal['file'].flush()
+                os.fsync(journal['file'].fileno())
+            journal['file'].close()
+    with _checkpoint_journals_lock:
+        _checkpoint_journals[:] = [x for x in _checkpoint_journals if x is not journal]
+
+
+def close_checkpoint_journals():
+    # Run at exit, including after a utility fails, so an interrupted run's checkpoints are on disk to resume from
+    with _checkpoint_journals_lock:
+        journals = list(_checkpoint_journals)
+    for journal in journals:
+        close_checkpoint_journal(journal)
+
+
+atexit.register(close_checkpoint_journals)
+
+
+def remove_checkpoint_journal(journal):
+    # Once its run completes, a journal and the files it kept are no longer needed
+    if journal is not None:
+        close_checkpoint_journal(journal, sync=False)
+        shutil.rmtree(journal['directory'], ignore_errors=True)
+
+
+def link_or_copy_file(source_filename, target_filename):
+    # Hard links are free, but not possible across file systems
+    try:
+        os.link(source_filename, target_filename)
+    except OSError:
+        shutil.copyfile(source_filename, target_filename)
+
+
+def ccb_ui_post(http_session, ccb_subdomain, page, **kwargs):
+    return ccb_ui_request(http_session, 'POST', ccb_subdomain, page, **kwargs)
+
+
+def ccb_ui_get(http_session, ccb_subdomain, page, **kwargs):
+    return ccb_ui_request(http_session, 'GET', ccb_subdomain, page, **kwargs)
+
+
+def ccb_ui_request(http_session, method, ccb_subdomain, page, **kwargs):
+    # If CCB UI session has expired, CCB redirects report requests to its login page. When the session came from
+    # get_ccb_ui_session(), log in again and retry the request once
+    url = 'https://' + ccb_subdomain + '.ccbchurch.com/' + page
+    cookies_sent = requests.utils.dict_from_cookiejar(http_session.cookies)
+    response = http_session.request(method, url, **kwargs)
+    if is_login_page_response(response) and hasattr(http_session, 'ccb_app_credentials'):
+        response.close()
+        with _ui_login_lock:
+            # Another thread may have already logged in again while we waited
+            if requests.utils.dict_from_cookiejar(http_session.cookies) == cookies_sent:
+                logging.warning('CCB UI session expired. Logging in again')
+                relogin(http_session)
+        response = http_session.request(method, url, **kwargs)
+    return response
+
+
+def relogin(http_session):
+    ccb_subdomain, ccb_app_username, ccb_app_password = http_session.ccb_app_credentials
+    http_session.cookies.clear()
+    login(http_session, ccb_subdomain, ccb_app_username, ccb_app_password)
+    if hasattr(http_session, 'ccb_session_cache_filename'):
+        with lock_file(http_session.ccb_session_cache_filename + '.lock'):
+            save_session_cookies(http_session, http_session.ccb_session_cache_filename, ccb_subdomain,
+                ccb_app_username)
+
+
+def is_login_page_response(response):
+    for redirect_response in response.history + [response]:
+        if re.search(r'/login\.php', redirect_response.url) or \
+            re.search(r'/login\.php', redirect_response.headers.get('Location', '')):
+            return True
+    return False
+
+
+def get_report_csv_rows(response, header_prefix, allow_empty=False):
+    # Returns iterator over the CSV rows (header row first) of a CCB UI report export requested with stream=True,
+    # decoding and parsing it as it arrives. Returns None if the request failed or the header row doesn't start with
+    # the header_prefix list of column names (e.g. CCB returned an error page instead of the report). If allow_empty,
+    # returns [] if CCB returned nothing at all
+    if response.status_code != 200:
+        return None
+    response.encoding = 'utf-8-sig'
+    csv_reader = csv.reader(iter_response_lines(response))
+    try:
+        header_row = next(csv_reader, None)
+    except csv.Error:
+        return None
+    if header_row is None and allow_empty:
+        return []
+    if header_row is None or header_row[:len(header_prefix)] != header_prefix:
+        return None
+    return itertools.chain([header_row], csv_reader)
+
+
+def iter_response_lines(response):
+    # Yields decoded lines, with line endings, of streamed response, as csv.reader expects of a file opened with
+    # newline=''
+    partial_line = ''
+    for chunk in response.iter_content(chunk_size=REPORT_CHUNK_SIZE, decode_unicode=True):
+        lines = (partial_line + chunk).split('\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if partial_line != '':
+        yield partial_line
+
+
+def write_report_csv_temp_file(csv_rows, temp_directory):
+    # Writes csv_rows into a new CSV file in temp_directory and returns its filename
+    with tempfile.NamedTemporaryFile(mode='w', newline='', encoding='utf-8', suffix='.csv', dir=temp_directory,
+        delete=False) as temp:
+        csv.writer(temp).writerows(csv_rows)
+    return temp.name
+
+
+def ccb_rest_xml_to_temp_file(ccb_subdomain, ccb_rest_service_string, ccb_api_username, ccb_api_password):
+    # Calls are paced by the shared rate limiter, and retried with jittered exponential backoff when CCB asks for a
+    # pause (HTTP 429), fails (HTTP 5xx), or drops the connection
+    retry_num = 0
+    while True:
+        acquire_rest_api_token()
+        logging.info('Retrieving ' + ccb_rest_service_string + ' from CCB REST API')
+        retry_after = None
+        try:
+            with requests.get('https://' + ccb_subdomain + '.ccbchurch.com/api.php?srv=' + ccb_rest_service_string,
+                stream=True, auth=(ccb_api_username, ccb_api_password)) as response:
+                if response.status_code == 200:
+                    input_filename = response_to_temp_file(response)
+                    break
+                elif response.status_code == 429:
+                    failure = 'requested pause (HTTP status 429)'
+                    metric_name = 'http_429'
+                    retry_after = response.headers.get('Retry-After')
+                elif response.status_code >= 500:
+                    failure = 'failed with HTTP status ' + str(response.status_code)
+                    metric_name = 'http_5xx'
+                else:
+                    logging.error('CCB REST API call retrieval for ' + ccb_rest_service_string + ' failed with ' +
+                        'HTTP status ' + str(response.status_code))
+                    sys.exit(1)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            failure = 'lost connection (' + type(e).__name__ + ')'
+            metric_name = 'connection_errors'
+        wait_seconds = get_retry_wait_seconds('CCB REST API call retrieval for ' + ccb_rest_service_string, failure,
+            retry_num, retry_after)
+        if metric_name == 'http_429':
+            # Everyone is throttled by a requested pause, so it is waited out in acquire_rest_api_token()
+            request_rest_api_pause(wait_seconds)
+            add_rest_api_metrics({'retries': 1, metric_name: 1})
+        else:
+            add_rest_api_metrics({'retries': 1, metric_name: 1, 'backoff_seconds': wait_seconds})
+            time.sleep(wait_seconds)
+        retry_num += 1
+
+    rest_api_errors = get_errors_from_rest_xml(input_filename)
+    if rest_api_errors is None:
+        return input_filename
+    else:
+        logging.error('CCB REST API call retrieval for ' + ccb_rest_service_string + ' failed with errors: '
+            + rest_api_errors)
+        sys.exit(1)
+
+
+def response_to_temp_file(response):
+    # Returns name of temp file holding streamed response's content. The file is removed if the download fails
+    response.raw.decode_content = True
+    with tempfile.NamedTemporaryFile(delete=False) as temp:
+        try:
             for chunk in response.iter_content(chunk_size=1024):
                 if chunk: # filter out keep-alive new chunks
                     temp.write(chunk)
-            temp.flush()
-        rest_api_errors = get_errors_from_rest_xml(input_filename)
-        if rest_api_errors is None:
-            return input_filename
-        else:
-            logging.error('CCB REST API call retrieval for ' + ccb_rest_service_string + ' failed with errors: '
-                + rest_api_errors)
-            sys.exit(1)
-    else:
-        if response.status_code == 429:
-            if retry_num >= 3:
-                logging.error('CCB REST API call retrieval for ' + ccb_rest_service_string + ' failed ' + \
-                    str(retry_num) + ' times on pause request (HTTP status 429). Giving up...')
-                sys.exit(1)
-            logging.warning('CCB REST API call retrieval for ' + ccb_rest_service_string + ' requested pause for ' + \
-                response.headers['Retry-After'] + ' seconds. Pausing requested time and then retrying...')
-            time.sleep(int(response.headers['Retry-After']))
-            return ccb_rest_xml_to_temp_file(ccb_subdomain, ccb_rest_service_string, ccb_api_username,
-                ccb_api_password, retry_num + 1)
-        else:
-            logging.error('CCB REST API call retrieval for ' + ccb_rest_service_string + ' failed with HTTP status ' +
-                str(response.status_code))
+        except:
+            temp.close()
+            os.remove(temp.name)
+            raise
+    return temp.name
+
+
+def get_retry_wait_seconds(description, failure, retry_num, retry_after=None):
+    # Returns seconds to back off before retrying a CCB request (description, e.g. 'Transaction Detail retrieval...')
+    # that just failed (failure, e.g. 'failed with HTTP status 503') for the (retry_num + 1)th time. Once
+    # [ccb_rest_api]max_retries retries have failed too, logs an error and exits instead
+    max_retries = get_ini_setting_int('ccb_rest_api', 'max_retries', 6, 0)
+    if retry_num >= max_retries:
+        logging.error(description + ' ' + failure + ' ' + str(retry_num + 1) + ' times. Giving up...')
         sys.exit(1)
+    wait_seconds = get_rest_api_backoff_seconds(retry_num, retry_after)
+    logging.warning(description + ' ' + failure + '. Retrying in {:.1f} seconds...'.format(wait_seconds))
+    return wait_seconds
+
+
+def get_rest_api_backoff_seconds(retry_num, retry_after=None):
+    # Exponential backoff with 'equal jitter' (a random half to all of the delay), so retries from many threads and
+    # processes spread out rather than arriving together. A Retry-After CCB gave (in seconds) is the least waited
+    base_seconds = get_ini_setting_int('ccb_rest_api', 'backoff_base_seconds', 1, 0)
+    max_seconds = get_ini_setting_int('ccb_rest_api', 'backoff_max_seconds', 60, 0)
+    backoff_seconds = min(max_seconds, base_seconds * 2 ** retry_num) * random.uniform(0.5, 1.0)
+    if retry_after is not None and retry_after.strip().isdigit():
+        backoff_seconds = max(backoff_seconds, int(retry_after))
+    return backoff_seconds
+
+
+def acquire_rest_api_token():
+    # Blocks until the shared token bucket allows another REST API call ([ccb_rest_api]requests_per_minute, with
+    # bursts of up to 'burst' calls) and no pause is in effect. Once this process's leased tokens run out, it leases
+    # every whole token in the shared bucket, and learns of any pause another process was asked for
+    requests_per_minute = get_ini_setting_int('ccb_rest_api', 'requests_per_minute', 600, 0)
+    burst = get_ini_setting_int('ccb_rest_api', 'burst', 10, 1)
+    start_time = time.time()
+    while True:
+        with _rest_api_lock:
+            now = time.time()
+            wait_seconds = _rest_api_lease['resume_time'] - now
+            if wait_seconds <= 0:
+                if _rest_api_lease['tokens'] >= 1:
+                    _rest_api_lease['tokens'] -= 1
+                    add_rest_api_metrics({'requests': 1, 'throttled_seconds': now - start_time})
+                    return
+                with rest_api_state() as state:
+                    if requests_per_minute == 0:
+                        state['tokens'] = float(burst)
+                    else:
+                        state['tokens'] = min(burst, state['tokens'] + (now - state['updated']) *
+                            requests_per_minute / 60)
+                    state['updated'] = now
+                    save_rest_api_metrics(state)
+                    _rest_api_lease['resume_time'] = state['resume_time']
+                    wait_seconds = state['resume_time'] - now
+                    if wait_seconds <= 0:
+                        leased_tokens = math.floor(state['tokens'])
+                        state['tokens'] -= leased_tokens
+                        _rest_api_lease['tokens'] += leased_tokens
+                        wait_seconds = 0 if leased_tokens > 0 else (1 - state['tokens']) * 60 / requests_per_minute
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+def request_rest_api_pause(seconds):
+    # Pauses this process at once, and every other process sharing the bucket once it next leases tokens
+    with _rest_api_lock:
+        _rest_api_lease['resume_time'] = max(_rest_api_lease['resume_time'], time.time() + seconds)
+        _rest_api_lease['tokens'] = 0.0
+        with rest_api_state() as state:
+            state['resume_time'] = max(state['resume_time'], _rest_api_lease['resume_time'])
+            state['tokens'] = 0.0
+            save_rest_api_metrics(state)
+
+
+def add_rest_api_metrics(metrics):
+    # Adds metrics to this process's REST API metrics and to its share of the totals of all processes, which are
+    # saved into the shared state by save_rest_api_metrics()
+    global _rest_api_metrics
+
+    with _rest_api_lock:
+        if _rest_api_metrics is None:
+            _rest_api_metrics = dict.fromkeys(REST_API_METRIC_NAMES, 0)
+        for name, value in metrics.items():
+            _rest_api_metrics[name] += value
+            _rest_api_unsaved_totals[name] = _rest_api_unsaved_totals.get(name, 0) + value
+
+
+def save_rest_api_metrics(state=None):
+    # Adds this process's metrics not yet in the shared state's totals to them. Also run at exit, so a get_*.py
+    # process's last calls are counted
+    if state is None:
+        with _rest_api_lock:
+            if len(_rest_api_unsaved_totals) > 0:
+                with rest_api_state() as state:
+                    save_rest_api_metrics(state)
+        return
+    for name, value in _rest_api_unsaved_totals.items():
+        state['totals'][name] = state['totals'].get(name, 0) + value
+    _rest_api_unsaved_totals.clear()
+
+
+atexit.register(save_rest_api_metrics)
+
+
+def get_rest_api_metrics(totals=False):
+    # Returns this process's REST API metrics, or if totals is True, the running totals of every process sharing the
+    # [ccb_rest_api]state_filename file (as of each process's last access to it). Diff two sets of totals to get
+    # metrics for the period between them
+    with _rest_api_lock:
+        if not totals:
+            return dict(_rest_api_metrics or dict.fromkeys(REST_API_METRIC_NAMES, 0))
+        with rest_api_state() as state:
+            save_rest_api_metrics(state)
+            return {x: state['totals'].get(x, 0) for x in REST_API_METRIC_NAMES}
+
+
+def format_rest_api_metrics(metrics):
+    return ('{requests} CCB REST API calls, {throttled_seconds:.1f} seconds waiting on rate limit and pauses, ' +
+        '{retries} retries ({http_429} HTTP 429, {http_5xx} HTTP 5xx, {connection_errors} lost connections) with ' +
+        '{backoff_seconds:.1f} seconds of backoff').format(**metrics)
+
+
+@contextlib.contextmanager
+def rest_api_state():
+    # Yields the REST API rate limiter's state for reading and updating, with other threads (and, through
+    # [ccb_rest_api]state_filename, other processes) locked out until the 'with' block ends
+    global _rest_api_state
+
+    state_filename = get_ini_setting('ccb_rest_api', 'state_filename')
+    with _rest_api_lock:
+        if state_filename is None or fcntl is None:
+            if _rest_api_state is None:
+                _rest_api_state = {'tokens': 0.0, 'updated': 0.0, 'resume_time': 0.0, 'totals': {}}
+            yield _rest_api_state
+            return
+        if not os.path.isabs(state_filename):
+            state_filename = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../' + state_filename)
+        with lock_file(state_filename + '.lock'):
+            state = {'tokens': 0.0, 'updated': 0.0, 'resume_time': 0.0, 'totals': {}}
+            if os.path.isfile(state_filename):
+                try:
+                    with open(state_filename, 'r') as state_file:
+                        state = json.load(state_file)
+                except ValueError:
+                    pass
+            yield state
+            with open(state_filename + '.tmp', 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(state_filename + '.tmp', state_filename)
 
 
 def get_errors_from_rest_xml(input_filename):
+    # Errors are reported in <response><errors> ahead of any data, so stop parsing as soon as the first data record
+    # (any element nested two levels under <response> other than an error) starts. That keeps this check from
+    # building a full tree of multi-hundred-MB payloads like group_profiles that callers parse again themselves
     errors_str = ''
-    xml_tree = ElementTree.parse(input_filename)
-    xml_root = xml_tree.getroot()
     sep = ''
-    for error in xml_root.findall('./response/errors/error'):
-        errors_str = errors_str + sep + error.text
-        sep = '; '
+    path = []
+    with open(input_filename, 'rb') as input_file:
+        for event, elem in ElementTree.iterparse(input_file, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                if len(path) == 4 and path[1] == 'response' and path[2] != 'errors':
+                    break
+            else:
+                if path == ['ccb_api', 'response', 'errors', 'error']:
+                    errors_str = errors_str + sep + (elem.text or '')
+                    sep = '; '
+                path.pop()
     if errors_str == '':
         return None
     else:
         return errors_str
 
 
-def get_elem_id_and_props(elem, list_props):
-    output_list = [ elem.attrib['id'] ]
-    for prop in list_props:
-        sub_elem = elem.find(prop)
-        if sub_elem is None or sub_elem.text is None:
-            output_list.append('')
-        else:
-            output_list.append(sub_elem.text.encode('ascii', 'ignore'))
-    return output_list
+def compile_xml_record_paths(record_paths):
+    # Compiles {record_name: ('ccb_api/response/.../tag', [child tags whose text to collect])} into a tree of tags
+    # for iter_xml_records(). Each node is [dict of child tag to node, record_name or None, True if text is collected]
+    root = [{}, None, False]
+    for record_name, (record_path, child_tags) in record_paths.items():
+        node = root
+        for tag in record_path.split('/'):
+            node = node[0].setdefault(tag, [{}, None, False])
+        node[1] = record_name
+        for child_tag in child_tags:
+            node[0].setdefault(child_tag, [{}, None, False])[2] = True
+    return root
+
+
+def iter_xml_records(input_filename, compiled_record_paths):
+    # Streams input_filename, yielding (record_name, record) for each element at a compiled record path, in document
+    # order of the elements' ends. record is a dict of the element's 'tag', 'attrib', 'text' (dict of the text of the
+    # first child element with each collected tag), and 'parents' (dict of enclosing records' names to their
+    # attrib). No element tree is built, so memory stays flat however big the file is.
+    #
+    # Where the parser is in the tree is tracked as a stack of compiled path nodes (None once off every compiled
+    # path), so each element costs one dict lookup, and elements off the compiled paths (most of them) little more
+    node_stack = [compiled_record_paths]
+    record_stack = [] # (record_name, record) of records being parsed, innermost last
+    open_records = {}
+    records = []
+    text_parts = [] # Text of the collected child element being parsed
+    collecting_text = False
+
+    def start(tag, attrib):
+        nonlocal collecting_text
+        parent_node = node_stack[-1]
+        node = parent_node[0].get(tag) if parent_node is not None else None
+        node_stack.append(node)
+        if node is None:
+            # Like ElementTree's elem.text, collected text stops at the child's first sub-element
+            collecting_text = False
+            return
+        if node[2] and tag not in record_stack[-1][1]['text']:
+            text_parts.clear()
+            collecting_text = True
+        if node[1] is not None:
+            record = {'tag': tag, 'attrib': attrib, 'text': {}, 'parents': dict(open_records)}
+            record_stack.append((node[1], record))
+            open_records[node[1]] = attrib
+
+    def data(data):
+        if collecting_text:
+            text_parts.append(data)
+
+    def end(tag):
+        nonlocal collecting_text
+        node = node_stack.pop()
+        if node is None:
+            return
+        if node[2] and tag not in record_stack[-1][1]['text']:
+            record_stack[-1][1]['text'][tag] = ''.join(text_parts) if len(text_parts) > 0 else None
+            collecting_text = False
+        if node[1] is not None:
+            record_name, record = record_stack.pop()
+            del open_records[record_name]
+            records.append((record_name, record))
+
+    parser = ElementTree.XMLParser(target=types.SimpleNamespace(start=start, data=data, end=end, close=lambda: None))
+    with open(input_filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(64 * 1024), b''):
+            parser.feed(chunk)
+            yield from records
+            records.clear()
+    parser.close()
+    yield from records
+
+
+def get_record_id_and_props(record, list_props):
+    # Returns CSV row (list of str) of record's 'id' attribute followed by the text of each of list_props child
+    # elements ('' if missing or empty), for a record from iter_xml_records(), whose child text is already indexed
+    # by tag
+    record_text = record['text']
+    return [ record['attrib']['id'] ] + [ record_text.get(prop) or '' for prop in list_props ]